@@ -3,15 +3,54 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from config import Config
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.token_cache import TokenCache
+from app.http_cache import HTTPCache
+from app.pool import pool_options, set_mysql_statement_timeout, enable_sqlite_foreign_keys
+from app.profiling import SQLProfiler
+from app.replicas import ReplicaRouter, RoutingSession
+from app.serializers import make_json_provider
+from app.ratelimit import RateLimiter
+from app.events import SeatEvents
 
 
 app = Flask(__name__)
 app.config.from_object(Config)
+if app.config['TOKEN_MODE'] == 'signed' and not app.config['SECRET_KEY']:
+    raise RuntimeError("TOKEN_MODE 'signed' needs a SECRET_KEY")
+app.json = make_json_provider(app)
 
 CORS(app)
 
-db = SQLAlchemy(app)
+# request.remote_addr (the per IP rate limits), the scheme and host come from the X-Forwarded-* headers of TRUSTED_PROXIES proxies
+trusted_proxies = app.config['TRUSTED_PROXIES']
+if trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies, x_host=trusted_proxies)
+
+# connection waits are timed for /_internal/pool, mysql's statement timeout and sqlite's foreign keys are set once the engines exist
+app.config['SQLALCHEMY_ENGINE_OPTIONS'], statement_timeout_ms = pool_options(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+statement_timeouts = {None: statement_timeout_ms}
+binds = {}
+for bind_key, bind_options in app.config['SQLALCHEMY_BINDS'].items():
+    binds[bind_key], statement_timeouts[bind_key] = pool_options(bind_options)
+app.config['SQLALCHEMY_BINDS'] = binds
+
+# RoutingSession sends the reads of @replicas.read_only views to the 'replica' bind
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+with app.app_context():
+    for bind_key, statement_timeout_ms in statement_timeouts.items():
+        if statement_timeout_ms:
+            set_mysql_statement_timeout(db.engines[bind_key], statement_timeout_ms)
+    for engine in db.engines.values():
+        if engine.dialect.name == 'sqlite':
+            enable_sqlite_foreign_keys(engine)
 migrate = Migrate(app, db)
+replicas = ReplicaRouter(app)
+token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+http_cache = HTTPCache(app)
+rate_limiter = RateLimiter(app)
+seat_events = SeatEvents(app)
+sql_profiler = SQLProfiler(app, db) if app.config['SQL_PROFILING'] else None
 
 
-from . import routes, models
\ No newline at end of file
+from . import routes, models, search, sync, stats, geo, similar, accounts
\ No newline at end of file
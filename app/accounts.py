@@ -0,0 +1,139 @@
+import time
+import click
+from sqlalchemy import event, func
+from sqlalchemy.orm import object_session
+from app import app, db, http_cache, seat_events
+from app.models import User, Retreat, Booking
+from app.stats import StatDeltas
+
+
+# Deleting users, in a fixed number of statements however many bookings and retreats they have.
+# The foreign keys do the deleting: a user's bookings and idempotency keys go with ON DELETE
+# CASCADE, their retreats stay with ON DELETE SET NULL, and a retreat's bookings go with it. The
+# ORM never loads any of them (User.retreats has passive_deletes). What the database can't do is
+# done by user_deleted() in the same flush, a few statements each covering every row:
+#   - the seats of the user's bookings are given back and the /stats rollups updated
+#   - the user's retreats are taken off them here rather than by SET NULL, so their version goes up
+#   - the cached responses and the live seat counts of the retreats involved are told
+# A deleted retreat needs nothing more, its bookings are the seats_booked app.stats takes off.
+#
+# Even a few statements can mean one long transaction that locks a lot of rows for a big account.
+# Users with more than USER_PURGE_THRESHOLD bookings and retreats are soft deleted instead: they
+# can't log in and their tokens stop working straight away, and `flask purge-users` deletes their
+# bookings and releases their retreats a batch per transaction before deleting the user.
+
+
+def release_bookings(connection, where):
+    """Gives back the seats of the bookings matching where and takes them out of /stats.
+
+    Call it before the bookings are deleted. Returns the ids of the retreats they were for.
+    """
+    rows = connection.execute(
+        db.select(Retreat.id, Retreat.location, Retreat.date, Retreat.user_id, func.count(Booking.id))
+        .join(Booking, Booking.retreat_id == Retreat.id)
+        .where(where)
+        .group_by(Retreat.id)
+    ).all()
+    if not rows:
+        return []
+    deltas = StatDeltas()
+    for retreat_id, location, retreat_date, user_id, bookings in rows:
+        deltas.add(location, retreat_date, user_id, bookings=-bookings)
+    deltas.apply(connection)
+    released = db.select(func.count(Booking.id)).where(Booking.retreat_id == Retreat.id, where).scalar_subquery()
+    connection.execute(
+        db.update(Retreat)
+        .where(Retreat.id.in_(db.select(Booking.retreat_id).where(where)))
+        .values(seats_booked=Retreat.seats_booked - released, version=Retreat.version + 1)
+    )
+    return [row[0] for row in rows]
+
+
+def orphan_retreats(connection, where):
+    """Takes the retreats matching where off their organizer, moving them to the '' organizer in /stats.
+
+    Returns how many there were.
+    """
+    columns = (Retreat.location, Retreat.date, Retreat.user_id)
+    rows = connection.execute(
+        db.select(*columns, func.count(), func.coalesce(func.sum(Retreat.seats_booked), 0)).where(where).group_by(*columns)
+    ).all()
+    if not rows:
+        return 0
+    deltas = StatDeltas()
+    for location, retreat_date, user_id, retreats, bookings in rows:
+        deltas.add(location, retreat_date, user_id, retreats=-retreats, bookings=-bookings)
+        deltas.add(location, retreat_date, None, retreats=retreats, bookings=bookings)
+    deltas.apply(connection)
+    connection.execute(db.update(Retreat).where(where).values(user_id=None, version=Retreat.version + 1))
+    return sum(row[3] for row in rows)
+
+
+def changed_retreats(session, retreat_ids, orphaned):
+    if retreat_ids or orphaned:
+        http_cache.invalidate(session, 'retreats', 'retreats:all')
+    for retreat_id in retreat_ids:
+        seat_events.changed(session, retreat_id)
+
+
+def user_deleted(mapper, connection, user):
+    # before the user row is deleted, the seats first so the retreats move to '' with what is left of them
+    retreat_ids = release_bookings(connection, Booking.user_id == user.id)
+    orphaned = orphan_retreats(connection, Retreat.user_id == user.id)
+    changed_retreats(object_session(user), retreat_ids, orphaned)
+
+
+event.listen(User, 'before_delete', user_deleted)
+
+
+def is_large(user_id, threshold):
+    # more than threshold bookings and retreats, counted no further than that
+    total = 0
+    for model in (Booking, Retreat):
+        first = db.select(model.id).where(model.user_id == user_id).limit(threshold + 1).subquery()
+        total += db.session.scalar(db.select(func.count()).select_from(first))
+    return total > threshold
+
+
+def purge_user(user, batch_size):
+    """Deletes a soft deleted user a batch of bookings or retreats per transaction. Returns (bookings, retreats)."""
+    purged_bookings = purged_retreats = 0
+    while True:
+        booking_ids = db.session.scalars(
+            db.select(Booking.id).where(Booking.user_id == user.id).order_by(Booking.id).limit(batch_size)
+        ).all()
+        if not booking_ids:
+            break
+        connection = db.session.connection()
+        retreat_ids = release_bookings(connection, Booking.id.in_(booking_ids))
+        connection.execute(db.delete(Booking).where(Booking.id.in_(booking_ids)))
+        changed_retreats(db.session, retreat_ids, 0)
+        db.session.commit()
+        purged_bookings += len(booking_ids)
+    while True:
+        retreat_ids = db.session.scalars(
+            db.select(Retreat.id).where(Retreat.user_id == user.id).order_by(Retreat.id).limit(batch_size)
+        ).all()
+        if not retreat_ids:
+            break
+        orphaned = orphan_retreats(db.session.connection(), Retreat.id.in_(retreat_ids))
+        changed_retreats(db.session, [], orphaned)
+        db.session.commit()
+        purged_retreats += orphaned
+    # nothing is left for user_deleted() or the foreign keys but the idempotency keys
+    user.delete()
+    return purged_bookings, purged_retreats
+
+
+@app.cli.command('purge-users')
+@click.option('--batch-size', default=1000, help='Bookings or retreats per transaction.')
+def purge_users(batch_size):
+    """Finish deleting the users that were soft deleted."""
+    started = time.perf_counter()
+    users = db.session.scalars(db.select(User).where(User.deleted_at.is_not(None)).order_by(User.id)).all()
+    bookings = retreats = 0
+    for user in users:
+        user_bookings, user_retreats = purge_user(user, batch_size)
+        bookings += user_bookings
+        retreats += user_retreats
+    click.echo(f"Purged {len(users)} users, {bookings} bookings and {retreats} retreats in {time.perf_counter() - started:.1f}s")
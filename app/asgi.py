@@ -0,0 +1,331 @@
+import asyncio
+import io
+import sys
+from datetime import datetime
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask import request, make_response, request_started
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from app import app, token_cache, tokens, http_cache, replicas, seat_events, sql_profiler, trusted_proxies
+from app.auth import token_auth
+from app.events import RETRY_MS
+from app.models import User, Retreat, signed_token_user
+from app.routes import retreat_query_from_args, page_limit, retreats_page, bookings_query_from_args, bookings_page
+
+
+# ASGI entry point, run with
+#   uvicorn app.asgi:application --workers 4
+# The read heavy routes (GET /retreats, GET /retreats/<id>, GET /bookings) are served here by
+# async views on SQLAlchemy's asyncio engine (asyncpg for Postgres, aiosqlite for SQLite),
+# so one worker can have many of them waiting on the database at once. GET /retreats/<id>/events
+# streams are coroutines too, an idle one is an asyncio.Event and a few objects. Everything else,
+# including ?stream=1 exports, is passed to the normal Flask app through asgiref.
+# The async views run inside a Flask request context and go through the app's before/after
+# request hooks and error handlers, so CORS headers, load shedding, replica routing,
+# Server-Timing and the response cache work the same way they do for the Flask views, and the
+# same request gets the same response from either entry point.
+# With SQLALCHEMY_REPLICA_URI set these views read from the replica, except GET /bookings
+# for a user who just wrote (see app/replicas.py).
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_uri(database_uri):
+    dialect, rest = database_uri.split(':', 1)
+    dialect = dialect.split('+', 1)[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise RuntimeError(f"The ASGI app has no async driver for {dialect!r} databases")
+    return ASYNC_DRIVERS[dialect] + ':' + rest
+
+
+def async_engine_options(database_uri, engine_options):
+    # the pool settings from Config carry over, the driver specific connect_args don't
+    if not database_uri.startswith('postgresql'):
+        return {}
+    options = {key: engine_options[key] for key in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping') if key in engine_options}
+    server_settings = {}
+    connect_args = engine_options.get('connect_args', {})
+    if 'application_name' in connect_args:
+        server_settings['application_name'] = connect_args['application_name']
+    if 'statement_timeout=' in connect_args.get('options', ''):
+        server_settings['statement_timeout'] = connect_args['options'].split('statement_timeout=', 1)[1]
+    if server_settings:
+        options['connect_args'] = {'server_settings': server_settings}
+    return options
+
+
+database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+async_engine = create_async_engine(
+    async_database_uri(database_uri),
+    **async_engine_options(database_uri, app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+)
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+if replicas.enabled:
+    replica_uri = app.config['SQLALCHEMY_REPLICA_URI']
+    async_replica_engine = create_async_engine(
+        async_database_uri(replica_uri),
+        **async_engine_options(replica_uri, app.config['SQLALCHEMY_BINDS']['replica'])
+    )
+    ReplicaSession = async_sessionmaker(async_replica_engine, expire_on_commit=False)
+else:
+    async_replica_engine = None
+    ReplicaSession = AsyncSession
+if sql_profiler is not None:
+    sql_profiler.listen(async_engine.sync_engine)
+    if async_replica_engine is not None:
+        sql_profiler.listen(async_replica_engine.sync_engine)
+flask_application = WsgiToAsgi(app)
+# the X-Forwarded-* handling app/__init__.py puts in front of the Flask app, for the environ of the async views
+forwarded = ProxyFix(lambda environ, start_response: environ, x_for=trusted_proxies, x_proto=trusted_proxies,
+                     x_host=trusted_proxies) if trusted_proxies else None
+
+# endpoint -> the async view that answers it instead of the Flask one
+ASYNC_VIEWS = {}
+
+
+def async_view(endpoint):
+    def decorator(view):
+        ASYNC_VIEWS[endpoint] = view
+        return view
+    return decorator
+
+
+def read_session():
+    # the replica for the views marked @replicas.read_only in app/routes.py, unless the user just wrote
+    return ReplicaSession() if replicas.using_replica() else AsyncSession()
+
+
+
+
+async def current_user_id(session):
+    # the async version of auth.verify_token, returns the user id or None
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    if app.config['TOKEN_MODE'] == 'signed':
+        payload = tokens.load_token(app.config['SECRET_KEY'], token)
+        if payload is None:
+            return None
+    cached = token_cache.get(token)
+    if cached is not None:
+        user_id, token_expiration, columns = cached
+        return user_id if token_expiration > datetime.utcnow() else None
+    if app.config['TOKEN_MODE'] == 'signed':
+        user = (await session.execute(signed_token_user(payload))).scalar_one_or_none()
+        if user is not None:
+            token_cache.set(token, user.id, payload['expires'], user.cache_columns())
+            return user.id
+        return None
+    user = (await session.execute(select(User).where(User.token == token))).scalar_one_or_none()
+    if user is not None and user.token_expiration > datetime.utcnow():
+        token_cache.set(token, user.id, user.token_expiration, user.cache_columns())
+        return user.id
+    return None
+
+
+@async_view('get_all_retreats')
+@http_cache.cached('retreats')
+async def get_all_retreats():
+    try:
+        stmt, fields = retreat_query_from_args(request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    limit = page_limit()
+    async with read_session() as session:
+        rows = (await session.execute(stmt.limit(limit + 1))).all()
+    return retreats_page(fields, rows, limit)
+
+
+@async_view('get_retreat_by_id')
+@http_cache.cached('retreats:all', 'retreat:{retreat_id}')
+async def get_retreat_by_id(retreat_id):
+    async with read_session() as session:
+        retreat = await session.get(Retreat, retreat_id)
+    if not retreat:
+        return {'error': f"Retreat with ID {retreat_id} not found"}, 404
+    response = make_response(retreat.to_dict())
+    response.set_etag(f'retreat-{retreat.id}-{retreat.version}')
+    return response
+
+
+@async_view('get_user_bookings')
+async def get_user_bookings():
+    async with read_session() as session:
+        user_id = await current_user_id(session)
+    if user_id is None and replicas.using_replica():
+        # a token handed out a moment ago may not be on the replica yet
+        replicas.use_primary()
+        async with AsyncSession() as session:
+            user_id = await current_user_id(session)
+    if user_id is None:
+        return token_auth.auth_error_callback(401)
+    # someone who just booked reads their bookings from the primary
+    replicas.set_user(user_id)
+    try:
+        stmt, limit = bookings_query_from_args(user_id)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    async with read_session() as session:
+        bookings = (await session.execute(stmt)).scalars().all()
+    return bookings_page(bookings, limit)
+
+
+class EventStream:
+    """The body of a GET /retreats/<id>/events response, sent by send_response() after the headers."""
+
+    def __init__(self, subscription, loop):
+        self.subscription = subscription
+        self.loop = loop
+
+    async def send(self, receive, send):
+        subscription = self.subscription
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            subscription.ended = True
+            subscription.woken.set()
+        disconnected = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await send({'type': 'http.response.body', 'body': f'retry: {RETRY_MS}\n\n'.encode(), 'more_body': True})
+            while not subscription.ended:
+                subscription.woken.clear()
+                message = subscription.message()
+                if message is None:
+                    # a timer handle rather than asyncio.wait_for, which would start a task for every wait
+                    timer = self.loop.call_later(seat_events.heartbeat, subscription.woken.set)
+                    await subscription.woken.wait()
+                    timer.cancel()
+                    message = subscription.message() or ': keepalive\n\n'
+                if not disconnected.done():
+                    await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+    def close(self):
+        # called by response.close(), whether or not the stream was sent
+        self.subscription.close()
+
+
+@async_view('get_retreat_events')
+async def get_retreat_events(retreat_id):
+    # the async version of routes.get_retreat_events, see app/events.py
+    loop = asyncio.get_running_loop()
+    subscription = seat_events.subscribe(retreat_id, loop, request.headers.get('Last-Event-ID'))
+    if subscription is None:
+        return {'error': 'Too many live streams open, try again later'}, 503, {'Retry-After': '5'}
+    try:
+        async with AsyncSession() as session:
+            row = (await session.execute(seat_events.state_query(retreat_id))).one_or_none()
+    except BaseException:
+        subscription.close()
+        raise
+    if row is None:
+        subscription.close()
+        return {'error': f"Retreat with ID {retreat_id} not found"}, 404
+    seat_events.load(subscription, row)
+    return app.response_class(EventStream(subscription, loop), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def environ_from_scope(scope):
+    # the WSGI environ Flask would get for this request, only GETs come here so there is no body
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(b''),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return forwarded(environ, None) if forwarded is not None else environ
+
+
+async def full_dispatch_request(view):
+    # Flask.full_dispatch_request() with an async view
+    try:
+        request_started.send(app, _async_wrapper=app.ensure_sync)
+        rv = app.preprocess_request()
+        if rv is None:
+            rv = await view(**request.view_args)
+    except Exception as e:
+        rv = app.handle_user_exception(e)
+    return app.finalize_request(rv)
+
+
+async def send_response(response, environ, receive, send):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.to_wsgi_list()],
+    })
+    try:
+        if isinstance(response.response, EventStream):
+            await response.response.send(receive, send)
+        else:
+            # get_app_iter() leaves out the body of a 304 like the WSGI app does
+            await send({'type': 'http.response.body', 'body': b''.join(response.get_app_iter(environ))})
+    finally:
+        response.close()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_engine.dispose()
+            if async_replica_engine is not None:
+                await async_replica_engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        # matched against the Flask app's own routes, so both entry points answer the same URLs
+        environ = environ_from_scope(scope)
+        ctx = app.request_context(environ)
+        ctx.push()
+        view = ASYNC_VIEWS.get(request.endpoint)
+        if view is not None and request.args.get('stream', '').lower() not in ('1', 'true'):
+            error = None
+            try:
+                try:
+                    response = await full_dispatch_request(view)
+                except Exception as e:
+                    error = e
+                    response = app.handle_exception(e)
+            finally:
+                ctx.pop(error)
+            # the event streams are sent after the context is gone, they hold no session
+            return await send_response(response, environ, receive, send)
+        ctx.pop()
+    await flask_application(scope, receive, send)
@@ -1,5 +1,6 @@
-from app.models import User
-from app import db
+from app.models import User, signed_token_user
+from app import db, token_cache, tokens, replicas
+from flask import current_app, g
 from datetime import datetime
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 
@@ -9,8 +10,15 @@ token_auth = HTTPTokenAuth()
 
 @basic_auth.verify_password
 def verify_password(username, password):
-    user = db.session.execute(db.select(User).where(User.username == username)).scalar_one_or_none()
+    user = db.session.execute(
+        db.select(User).where(User.username == username, User.deleted_at.is_(None))
+    ).scalar_one_or_none()
     if user is not None and user.check_password(password):
+        # the hash settings changed since this password was saved, redo it while we have the password
+        if user.password_needs_rehash():
+            user.set_password(password)
+            user.save()
+        replicas.set_user(user.id)
         return user
     return None
 
@@ -20,8 +28,44 @@ def handle_error(status):
 
 @token_auth.verify_token
 def verify_token(token):
+    # the sub-requests of POST /batch carry the batch's own token, which was checked already
+    batch_user = g.get('batch_user')
+    if batch_user is not None:
+        replicas.set_user(batch_user.id)
+        return batch_user
+    if current_app.config['TOKEN_MODE'] == 'signed':
+        payload = tokens.load_token(current_app.config['SECRET_KEY'], token)
+        if payload is None:
+            return None
+    # check the in memory cache before going to the database
+    cached = token_cache.get(token)
+    if cached is not None:
+        user_id, token_expiration, columns = cached
+        if token_expiration > datetime.utcnow():
+            replicas.set_user(user_id)
+            return User.from_cache(columns)
+        token_cache.invalidate(token)
+        return None
+    if current_app.config['TOKEN_MODE'] == 'signed':
+        # by primary key, a user deleted or a token logged out by another worker isn't found, once the
+        # token is cached that worker's change is seen when the entry's TOKEN_CACHE_TTL runs out
+        user = db.session.execute(signed_token_user(payload)).scalar_one_or_none()
+        if user is None and replicas.using_replica():
+            # a user created a moment ago may not be on the replica yet
+            replicas.use_primary()
+            user = db.session.execute(signed_token_user(payload)).scalar_one_or_none()
+        if user is not None:
+            token_cache.set(token, user.id, payload['expires'], user.cache_columns())
+            replicas.set_user(user.id)
+        return user
     user = db.session.execute(db.select(User).where(User.token == token)).scalar_one_or_none()
+    if user is None and replicas.using_replica():
+        # a token handed out a moment ago may not be on the replica yet
+        replicas.use_primary()
+        user = db.session.execute(db.select(User).where(User.token == token)).scalar_one_or_none()
     if user is not None and user.token_expiration > datetime.utcnow():
+        token_cache.set(token, user.id, user.token_expiration, user.cache_columns())
+        replicas.set_user(user.id)
         return user
     return None 
 
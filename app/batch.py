@@ -0,0 +1,129 @@
+from flask import g, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from app import app, db
+from app.models import User, Retreat
+
+
+# POST /batch, several GET requests against the other routes in one round trip.
+# The sub-requests go through the app like any other request (same views, caches, replica routing
+# and Server-Timing), but inside the batch's app context: they share its database session and the
+# user the batch was authenticated as, so the token is checked once (see verify_token). Identical
+# sub-requests run once, and the rows behind /retreats/<id> and /users/<id> are loaded up front with
+# one IN query per model, so each of those views finds its row in the session instead of the database.
+# Only GET is allowed, a write in the middle of a batch would leave the rest of it half done if it failed.
+
+# endpoint -> (model, the URL argument holding its primary key)
+PREFETCH = {
+    'get_retreat_by_id': (Retreat, 'retreat_id'),
+    'get_user': (User, 'user_id'),
+}
+# response headers passed back with each item
+ITEM_HEADERS = ('ETag', 'Location', 'Retry-After', 'Cache-Control')
+
+
+def parse_items(data, max_requests):
+    """[(method, path, headers)] from the request body, raises ValueError if it is no good."""
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError("Send {'requests': [{'method': 'GET', 'path': '/retreats/1'}, ...]}")
+    if len(items) > max_requests:
+        raise ValueError(f"A batch can have at most {max_requests} requests")
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str) or not item['path'].startswith('/'):
+            raise ValueError(f"requests[{index}] needs a path starting with /")
+        headers = item.get('headers') or {}
+        if not isinstance(headers, dict) or not all(isinstance(value, str) for value in headers.values()):
+            raise ValueError(f"requests[{index}].headers must be an object of strings")
+        parsed.append((item.get('method', 'GET').upper(), item['path'], headers))
+    return parsed
+
+
+def _match(adapter, method, path):
+    # (endpoint, view args), or (None, the item to answer with) when the batch can't run it
+    if method != 'GET':
+        return None, {'status': 405, 'body': {'error': f"Only GET requests can be batched, not {method} {path}"}}
+    try:
+        endpoint, view_args = adapter.match(path.partition('?')[0], method='GET')
+    except HTTPException as error:
+        return None, {'status': error.code, 'body': {'error': f"{method} {path}: {error.name}"}}
+    # the live streams never finish
+    if endpoint in ('run_batch', 'static', 'get_retreat_events'):
+        return None, {'status': 400, 'body': {'error': f"{path} can't be part of a batch"}}
+    return endpoint, view_args
+
+
+def prefetch(matches):
+    # one IN query per model for every row the item views are going to look up by id, the rows are
+    # returned so the caller can hold on to them, the session only keeps weak references
+    ids = {}
+    for endpoint, view_args in matches:
+        if endpoint in PREFETCH:
+            model, argument = PREFETCH[endpoint]
+            ids.setdefault(model, set()).add(view_args[argument])
+    rows = []
+    for model, model_ids in ids.items():
+        if len(model_ids) > 1:
+            rows += db.session.execute(db.select(model).where(model.id.in_(sorted(model_ids)))).scalars().all()
+    return rows
+
+
+def _body(response):
+    # JSON as it is, anything else (CSV exports) as text, None for an empty body or a 304
+    if response.status_code == 304:
+        return None
+    if response.is_json:
+        return response.get_json(silent=True)
+    return response.get_data(as_text=True) or None
+
+
+def _run(method, path, headers):
+    # one sub-request through the whole app, in a request context of its own on the batch's app context
+    builder = EnvironBuilder(path=path, method=method, base_url=request.host_url,
+                             headers={**headers, 'Authorization': request.headers.get('Authorization', '')},
+                             environ_overrides={'REMOTE_ADDR': request.environ.get('REMOTE_ADDR', '')})
+    try:
+        with app.request_context(builder.get_environ()):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as error:
+                db.session.rollback()
+                app.log_exception(error)
+                return {'status': 500, 'body': {'error': 'Internal server error'}}
+            item = {'status': response.status_code, 'body': _body(response)}
+            item_headers = {name: response.headers[name] for name in ITEM_HEADERS if name in response.headers}
+            if item_headers:
+                item['headers'] = item_headers
+            return item
+    finally:
+        builder.close()
+
+
+def run_batch(items, user):
+    """The responses to [(method, path, headers)], in the same order."""
+    adapter = app.url_map.bind_to_environ(request.environ)
+    matches = [_match(adapter, method, path) for method, path, headers in items]
+    # held until the batch is done so the rows stay in the session
+    prefetched = prefetch([match for match in matches if match[0] is not None])
+
+    # the views' own Server-Timing profile would replace the batch's, it is put back after
+    profile = g.pop('sql_profile', None)
+    g.batch_user = user
+    responses = {}
+    try:
+        results = []
+        for (method, path, headers), (endpoint, matched) in zip(items, matches):
+            if endpoint is None:
+                results.append(matched)
+                continue
+            # identical requests are only run once
+            key = (path, tuple(sorted(headers.items())))
+            if key not in responses:
+                responses[key] = _run(method, path, headers)
+            results.append(responses[key])
+    finally:
+        g.pop('batch_user', None)
+        if profile is not None:
+            g.sql_profile = profile
+    return results
@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+from datetime import date
+from app import db, http_cache
+from app.models import Retreat, parse_cost_cents, parse_duration_days
+from app.stats import StatDeltas
+from app import geo
+
+
+# Bulk retreat import and export for /retreats/bulk.
+# Imports are read and checked one row at a time and written in batches with executemany,
+# so a 100k row file never turns into 100k ORM objects or 100k commits.
+
+IMPORT_FIELDS = ('name', 'location', 'description', 'duration', 'date', 'cost', 'latitude', 'longitude')
+EXPORT_FIELDS = ('id', 'name', 'location', 'description', 'duration', 'date', 'cost', 'userId', 'latitude', 'longitude')
+MAX_REPORTED_ERRORS = 1000
+
+
+def read_ndjson(stream):
+    # yields (line number, row dict or error message)
+    for line_number, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8'), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, 'not valid JSON'
+            continue
+        yield line_number, row if isinstance(row, dict) else 'each line must be a JSON object'
+
+
+def read_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    # the header is line 1
+    for line_number, row in enumerate(reader, start=2):
+        # empty cells mean no value
+        yield line_number, {key: value for key, value in row.items() if value not in ('', None)}
+
+
+def validate_row(row, user_id):
+    # returns the values to insert for one retreat, raises ValueError if the row is no good
+    missing_fields = [field for field in ('name', 'location') if not row.get(field)]
+    if missing_fields:
+        raise ValueError(f"{', '.join(missing_fields)} must be in the row")
+    values = {field: row.get(field) for field in IMPORT_FIELDS}
+    for field in ('name', 'location', 'description', 'duration', 'cost'):
+        if values[field] is not None:
+            values[field] = str(values[field])
+    if len(values['name']) > 255 or len(values['location']) > 255:
+        raise ValueError('name and location must be 255 characters or less')
+    if values['duration'] is not None and len(values['duration']) > 50:
+        raise ValueError('duration must be 50 characters or less')
+    if values['cost'] is not None and len(values['cost']) > 20:
+        raise ValueError('cost must be 20 characters or less')
+    if values['date'] is not None:
+        try:
+            values['date'] = date.fromisoformat(str(values['date']))
+        except ValueError:
+            raise ValueError('date must be in the format YYYY-MM-DD')
+    values['latitude'], values['longitude'] = geo.parse_coordinates(values['latitude'], values['longitude'])
+    values['cost_cents'] = parse_cost_cents(values['cost'])
+    values['duration_days'] = parse_duration_days(values['duration'])
+    values['user_id'] = user_id
+    return geo.located_values(values)
+
+
+def import_retreats(rows, user_id, batch_size):
+    # inserts every valid row in one transaction, returns (inserted count, error count, errors)
+    inserted = 0
+    error_count = 0
+    errors = []
+    batch = []
+    stat_deltas = StatDeltas()
+    for line_number, row in rows:
+        try:
+            if isinstance(row, str):
+                raise ValueError(row)
+            values = validate_row(row, user_id)
+        except ValueError as e:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'line': line_number, 'error': str(e)})
+            continue
+        batch.append(values)
+        stat_deltas.add(values['location'], values['date'], user_id, retreats=1)
+        if len(batch) >= batch_size:
+            db.session.execute(db.insert(Retreat), batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Retreat), batch)
+        inserted += len(batch)
+    if inserted:
+        http_cache.invalidate(db.session, 'retreats')
+        stat_deltas.apply(db.session.connection())
+    db.session.commit()
+    return inserted, error_count, errors
+
+
+def export_row(row):
+    row = dict(zip(EXPORT_FIELDS, row))
+    if row['date'] is not None:
+        row['date'] = row['date'].isoformat()
+    return row
+
+
+def export_ndjson(result):
+    for rows in result.partitions():
+        yield ''.join(json.dumps(export_row(row)) + '\n' for row in rows)
+
+
+def export_csv(result):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for rows in result.partitions():
+        for row in rows:
+            writer.writerow(export_row(row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
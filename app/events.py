@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# Live seat counts for GET /retreats/<id>/events (Server-Sent Events), so clients stop polling
+# GET /retreats/<id> while a retreat fills up.
+#
+# Booking and cancelling (Retreat.reserve_seat/release_seat) and retreat edits mark the retreat as
+# changed, and the mark is published when the transaction commits. Each worker runs one flusher
+# thread that picks up the changes for the retreats it has subscribers for, reads their seat counts
+# in one query and wakes those subscribers. It runs at most SEAT_EVENTS_PER_SECOND times a second,
+# so however many bookings come in, a subscriber gets at most that many updates a second, each one
+# with the latest counts.
+#
+# 'memory' only sees the bookings made on the same worker. 'sqlite' publishes the changes to a local
+# SQLite file every worker on the machine polls, the same way http_cache's 'sqlite' backend shares
+# its generations.
+#
+# A subscriber is a threading.Event (the Flask route) or an asyncio.Event (app/asgi.py) and the
+# last update it was sent. Under gunicorn's sync workers each open stream takes a worker, serve
+# /retreats/<id>/events from the ASGI app where thousands of idle streams fit on one worker.
+
+logger = logging.getLogger(__name__)
+
+# milliseconds a client waits before reconnecting after the stream drops
+RETRY_MS = 3000
+
+
+class MemoryChanges:
+    shared = False
+
+    def __init__(self):
+        self._pending = set()
+        self._condition = threading.Condition()
+
+    def publish(self, retreat_ids):
+        with self._condition:
+            self._pending.update(retreat_ids)
+            self._condition.notify()
+
+    def changes(self, timeout):
+        # waits for changes, returns the retreat ids changed since the last call
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending, timeout)
+            pending, self._pending = self._pending, set()
+        return pending
+
+
+class SqliteChanges:
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._seen = None
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS changes (retreat_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_changes_seq ON changes (seq)")
+
+    def _connection(self):
+        # one connection per thread, and a new one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def publish(self, retreat_ids):
+        # one row per retreat with the sequence number of its last change, so the table stays as big as the retreat table at most
+        self._connection().executemany(
+            "INSERT INTO changes (retreat_id, seq) VALUES (?, (SELECT coalesce(max(seq), 0) + 1 FROM changes)) "
+            "ON CONFLICT(retreat_id) DO UPDATE SET seq = excluded.seq",
+            [(retreat_id,) for retreat_id in retreat_ids]
+        )
+
+    def changes(self, timeout):
+        # the flusher's own sleep is the polling interval, this just reads what changed since the last call
+        connection = self._connection()
+        if self._seen is None:
+            self._seen = connection.execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+            return set()
+        rows = connection.execute("SELECT retreat_id, seq FROM changes WHERE seq > ?", (self._seen,)).fetchall()
+        if rows:
+            self._seen = max(seq for retreat_id, seq in rows)
+        return {retreat_id for retreat_id, seq in rows}
+
+
+def make_changes(config):
+    backend = config['SEAT_EVENTS_BACKEND']
+    if backend == 'memory':
+        return MemoryChanges()
+    if backend == 'sqlite':
+        return SqliteChanges(config['SEAT_EVENTS_PATH'])
+    raise RuntimeError(f"Unknown SEAT_EVENTS_BACKEND {backend!r}")
+
+
+def state_select():
+    # the columns seat_state() needs
+    from app import db
+    from app.models import Retreat
+    return db.select(Retreat.id, Retreat.version, Retreat.seats_booked, Retreat.capacity)
+
+
+def seat_state(row):
+    # the event data for a (id, version, seats_booked, capacity) row
+    seats_left = max(row.capacity - row.seats_booked, 0) if row.capacity is not None else None
+    return {'id': row.id, 'seatsBooked': row.seats_booked, 'capacity': row.capacity, 'seatsLeft': seats_left}
+
+
+class Channel:
+    # the latest seat counts of one retreat and who is listening for them
+    def __init__(self, retreat_id):
+        self.retreat_id = retreat_id
+        self.subscribers = set()
+        self.state = None
+        self.version = 0
+        self.deleted = False
+        # goes up once per update sent, a subscriber has seen every update up to the one it last sent
+        self.sequence = 0
+
+    def update(self, row):
+        # row is None once the retreat is gone, returns True if there is something new to send
+        if row is None:
+            if self.deleted or not self.sequence:
+                return False
+            self.deleted = True
+        else:
+            version = row.version or 0
+            if version <= self.version and self.sequence:
+                return False
+            self.version = version
+            state = seat_state(row)
+            # an edit that didn't touch the seats has nothing to send
+            if state == self.state:
+                return False
+            self.state = state
+        self.sequence += 1
+        return True
+
+
+class Subscription:
+    def __init__(self, events, channel, woken, loop=None, last_event_id=None):
+        self.events = events
+        self.channel = channel
+        self.woken = woken
+        self.loop = loop
+        self.last_event_id = last_event_id
+        self.sent = 0
+        self.ended = False
+
+    def message(self):
+        # the next SSE message for this subscriber, None if it is up to date
+        with self.events.lock:
+            channel = self.channel
+            if channel.sequence == self.sent:
+                return None
+            self.sent = channel.sequence
+            state, version, deleted = channel.state, channel.version, channel.deleted
+        if deleted:
+            self.ended = True
+            return f'event: deleted\ndata: {self.events.app.json.dumps({"id": channel.retreat_id})}\n\n'
+        # a client that reconnects with the Last-Event-ID it already has doesn't get it again
+        last_event_id, self.last_event_id = self.last_event_id, None
+        if last_event_id == str(version):
+            return None
+        return f'event: seats\nid: {version}\ndata: {self.events.app.json.dumps(state)}\n\n'
+
+    def close(self):
+        self.events.unsubscribe(self)
+
+
+def _wake_all(woken_events):
+    for woken in woken_events:
+        woken.set()
+
+
+class SeatEvents:
+    def __init__(self, app=None):
+        self.channels = {}
+        self.subscribers = 0
+        self.lock = threading.Lock()
+        self._flusher_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.changes = make_changes(app.config)
+        self.interval = 1 / app.config['SEAT_EVENTS_PER_SECOND']
+        self.heartbeat = app.config['SEAT_EVENTS_HEARTBEAT']
+        self.max_subscribers = app.config['SEAT_EVENTS_MAX_SUBSCRIBERS']
+        # retreats changed in a transaction are published once it commits, and dropped if it rolls back
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def changed(self, session, retreat_id):
+        session.info.setdefault('seat_events_changed', set()).add(retreat_id)
+
+    def _after_commit(self, session):
+        retreat_ids = session.info.pop('seat_events_changed', None)
+        if not retreat_ids:
+            return
+        # only this worker hears about 'memory' changes, so only the ones somebody here listens for matter
+        if not self.changes.shared:
+            retreat_ids = {retreat_id for retreat_id in retreat_ids if retreat_id in self.channels}
+        if retreat_ids:
+            try:
+                self.changes.publish(retreat_ids)
+            except sqlite3.Error:
+                # the booking went through, the live counts catch up with the next change
+                logger.exception('Could not publish seat changes')
+
+    def _after_rollback(self, session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop('seat_events_changed', None)
+
+    def subscribe(self, retreat_id, loop=None, last_event_id=None):
+        """A Subscription for the retreat, None if this worker has as many as it takes already.
+
+        Its woken event is a threading.Event, or an asyncio.Event when the subscriber runs on loop.
+        Load the retreat with state_query() after subscribing and pass the row to load().
+        """
+        woken = asyncio.Event() if loop is not None else threading.Event()
+        with self.lock:
+            if self.subscribers >= self.max_subscribers:
+                return None
+            channel = self.channels.get(retreat_id)
+            if channel is None:
+                channel = self.channels[retreat_id] = Channel(retreat_id)
+            subscription = Subscription(self, channel, woken, loop, last_event_id)
+            channel.subscribers.add(subscription)
+            self.subscribers += 1
+        self._start_flusher()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            channel = subscription.channel
+            if subscription in channel.subscribers:
+                channel.subscribers.discard(subscription)
+                self.subscribers -= 1
+            if not channel.subscribers and self.channels.get(channel.retreat_id) is channel:
+                del self.channels[channel.retreat_id]
+
+    def state_query(self, retreat_id):
+        from app.models import Retreat
+        return state_select().where(Retreat.id == retreat_id)
+
+    def load(self, subscription, row):
+        # the counts read when subscribing, unless the flusher has something newer already
+        self._update(subscription.channel, row)
+
+    def _update(self, channel, row):
+        with self.lock:
+            if not channel.update(row):
+                return
+            subscribers = list(channel.subscribers)
+        loops = {}
+        for subscription in subscribers:
+            if subscription.loop is None:
+                subscription.woken.set()
+            else:
+                loops.setdefault(subscription.loop, []).append(subscription.woken)
+        # one call per event loop rather than one per subscriber, each call writes to the loop's wakeup pipe
+        for loop, woken_events in loops.items():
+            try:
+                loop.call_soon_threadsafe(_wake_all, woken_events)
+            except RuntimeError:
+                # the loop has shut down
+                pass
+
+    def _start_flusher(self):
+        # started with the first subscriber, and again in a forked worker
+        if self._flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='seat-events', daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            try:
+                retreat_ids = self.changes.changes(self.heartbeat)
+                flushed = time.monotonic()
+                self.flush(retreat_ids)
+            except Exception:
+                flushed = time.monotonic()
+                logger.exception('Seat events flush failed')
+            # the changes that come in meanwhile go out together on the next round
+            time.sleep(max(self.interval - (time.monotonic() - flushed), 0))
+
+    def flush(self, retreat_ids):
+        """Reads the seat counts of the changed retreats somebody is listening for and wakes their subscribers."""
+        with self.lock:
+            channels = [self.channels[retreat_id] for retreat_id in retreat_ids if retreat_id in self.channels]
+        if not channels:
+            return
+        from app import db
+        from app.models import Retreat
+        # from the primary, a replica may not have the booking yet
+        with self.app.app_context():
+            rows = db.session.execute(
+                state_select().where(Retreat.id.in_([channel.retreat_id for channel in channels]))
+            ).all()
+        rows = {row.id: row for row in rows}
+        for channel in channels:
+            self._update(channel, rows.get(channel.retreat_id))
+
+    def stream(self, subscription):
+        # the response body of the Flask route, one thread per stream
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            while not subscription.ended:
+                subscription.woken.clear()
+                message = subscription.message()
+                if message is not None:
+                    yield message
+                elif not subscription.woken.wait(self.heartbeat):
+                    # a comment line, it keeps proxies from closing the connection and finds clients that left
+                    yield ': keepalive\n\n'
+        finally:
+            subscription.close()
+
+    def stats(self):
+        with self.lock:
+            return {'backend': type(self.changes).__name__, 'subscribers': self.subscribers, 'retreats': len(self.channels)}
@@ -0,0 +1,253 @@
+import csv
+import math
+import os
+import re
+import unicodedata
+from functools import lru_cache
+import click
+from sqlalchemy import event, or_
+from app import app, db, http_cache
+from app.models import Retreat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Coordinates for retreats and the index behind /retreats/nearby.
+# Locations are geocoded offline from app/data/gazetteer.csv (no network calls), either when a
+# retreat is saved or in bulk with `flask geocode-retreats`.
+# geocell is a 52 bit geohash stored as an integer: longitude and latitude bits interleaved, so
+# every geohash prefix is one range of geocells and a B-tree index answers "which retreats are in
+# these few cells". /retreats/nearby covers the search circle with at most MAX_COVER_CELLS cells,
+# reads the coordinates of the retreats in them and keeps the ones whose exact (haversine)
+# distance is within the radius, with numpy when it is installed.
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.csv')
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+GEOCELL_BITS = 52
+AXIS_BITS = GEOCELL_BITS // 2
+MAX_COVER_CELLS = 16
+
+
+# GEOCODING
+def normalize_place(name):
+    # lower case, no accents or punctuation, single spaces
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name).split())
+
+
+@lru_cache(maxsize=1)
+def gazetteer():
+    with open(GAZETTEER_PATH, newline='', encoding='utf-8') as gazetteer_file:
+        return {normalize_place(row['name']): (float(row['latitude']), float(row['longitude']))
+                for row in csv.DictReader(gazetteer_file)}
+
+
+@lru_cache(maxsize=10000)
+def geocode(location):
+    # (latitude, longitude) for a free text location, or None if the gazetteer has nothing for it
+    if not location:
+        return None
+    places = gazetteer()
+    # "Ubud, Bali, Indonesia" is tried whole, then one part at a time from the most specific
+    parts = [normalize_place(location)] + [normalize_place(part) for part in re.split(r'[,/|()]| - ', location)]
+    for part in parts:
+        if part in places:
+            return places[part]
+    # "Yoga week in the Sacred Valley", longest run of words first
+    words = parts[0].split()
+    for length in range(min(len(words), 4), 0, -1):
+        for start in range(len(words) - length + 1):
+            place = ' '.join(words[start:start + length])
+            if place in places:
+                return places[place]
+    return None
+
+
+# GEOCELLS
+def _spread_bits(value):
+    # puts the 26 bits of value on the even bit positions of a 52 bit number
+    value &= 0x3FFFFFF
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def _axis_index(value, low, span, bits):
+    return min(max(int((value - low) / span * (1 << bits)), 0), (1 << bits) - 1)
+
+
+def geocell(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    lat_index = _axis_index(latitude, -90.0, 180.0, AXIS_BITS)
+    lng_index = _axis_index(longitude, -180.0, 360.0, AXIS_BITS)
+    return (_spread_bits(lng_index) << 1) | _spread_bits(lat_index)
+
+
+def _cover(latitude, longitude, radius_km, prefix_bits):
+    # the (lat index, lng index) cells of a prefix_bits long geohash that cover the circle's bounding box
+    lat_bits, lng_bits = prefix_bits // 2, (prefix_bits + 1) // 2
+    lat_delta = radius_km / KM_PER_DEGREE
+    lat_min, lat_max = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    lat_cells = range(_axis_index(lat_min, -90.0, 180.0, lat_bits), _axis_index(lat_max, -90.0, 180.0, lat_bits) + 1)
+    # the bounding box gets wider away from the equator, and wraps around at the poles
+    widest = max(abs(lat_min), abs(lat_max))
+    if widest >= 89.9 or lat_delta / math.cos(math.radians(widest)) >= 180:
+        lng_cells = range(1 << lng_bits)
+    else:
+        lng_delta = lat_delta / math.cos(math.radians(widest))
+        lng_width = 360.0 / (1 << lng_bits)
+        first = math.floor((longitude - lng_delta + 180.0) / lng_width)
+        last = math.floor((longitude + lng_delta + 180.0) / lng_width)
+        # a range, not a list, the small cells of a big circle are counted but never listed
+        lng_cells = range(first, min(last, first + (1 << lng_bits) - 1) + 1)
+    return lat_bits, lng_bits, lat_cells, lng_cells
+
+
+def geocell_ranges(latitude, longitude, radius_km):
+    """Inclusive (low, high) geocell ranges that between them hold every point within radius_km."""
+    # the longest prefix (smallest cells) that still covers the circle in MAX_COVER_CELLS cells
+    for prefix_bits in range(GEOCELL_BITS, -1, -1):
+        lat_bits, lng_bits, lat_cells, lng_cells = _cover(latitude, longitude, radius_km, prefix_bits)
+        if len(lat_cells) * len(lng_cells) <= MAX_COVER_CELLS:
+            break
+    size = 1 << (GEOCELL_BITS - prefix_bits)
+    # longitude cells past 180 wrap around to -180
+    lows = sorted({
+        (_spread_bits((lng_index % (1 << lng_bits)) << (AXIS_BITS - lng_bits)) << 1) | _spread_bits(lat_index << (AXIS_BITS - lat_bits))
+        for lat_index in lat_cells for lng_index in lng_cells
+    })
+    # cells next to each other along the curve become one range
+    ranges = []
+    for low in lows:
+        if ranges and ranges[-1][1] + 1 == low:
+            ranges[-1][1] = low + size - 1
+        else:
+            ranges.append([low, low + size - 1])
+    return [tuple(cell_range) for cell_range in ranges]
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    # distances from one point to many, returns a numpy array when numpy is installed, otherwise a list
+    if numpy is not None:
+        lat1, lng1 = math.radians(latitude), math.radians(longitude)
+        lat2 = numpy.radians(numpy.asarray(latitudes, dtype=float))
+        lng2 = numpy.radians(numpy.asarray(longitudes, dtype=float))
+        a = numpy.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+    lat1, lng1 = math.radians(latitude), math.radians(longitude)
+    distances = []
+    for lat2, lng2 in zip(latitudes, longitudes):
+        lat2, lng2 = math.radians(lat2), math.radians(lng2)
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+        distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0))))
+    return distances
+
+
+def nearest(ids, distances, radius_km, limit):
+    # [(id, distance)] of the closest limit ids within radius_km, closest first
+    if numpy is not None:
+        ids = numpy.asarray(ids)
+        inside = numpy.flatnonzero(distances <= radius_km)
+        if len(inside) > limit:
+            inside = inside[numpy.argpartition(distances[inside], limit - 1)[:limit]]
+        inside = inside[numpy.argsort(distances[inside], kind='stable')]
+        return [(int(ids[index]), float(distances[index])) for index in inside]
+    inside = sorted((distance, retreat_id) for retreat_id, distance in zip(ids, distances) if distance <= radius_km)
+    return [(retreat_id, distance) for distance, retreat_id in inside[:limit]]
+
+
+def nearby_retreats(stmt, latitude, longitude, radius_km, limit):
+    """Returns [(retreat id, distance in km)] for the retreats stmt selects within radius_km, closest first.
+
+    stmt is a select of Retreat with any other filters already applied.
+    """
+    ranges = geocell_ranges(latitude, longitude, radius_km)
+    stmt = stmt.with_only_columns(Retreat.id, Retreat.latitude, Retreat.longitude).where(
+        or_(*(Retreat.geocell.between(low, high) for low, high in ranges))
+    )
+    candidates = db.session.execute(stmt).all()
+    if not candidates:
+        return []
+    ids, latitudes, longitudes = zip(*candidates)
+    return nearest(ids, haversine_km(latitude, longitude, latitudes, longitudes), radius_km, limit)
+
+
+# RETREAT COORDINATES
+def parse_coordinates(latitude, longitude):
+    # both or neither, returns them as floats, raises ValueError if they are no good
+    if latitude in (None, '') and longitude in (None, ''):
+        return None, None
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError('latitude and longitude must both be numbers')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('latitude must be between -90 and 90 and longitude between -180 and 180')
+    return latitude, longitude
+
+
+def located_values(values):
+    # adds latitude, longitude and geocell to the insert/update values of a retreat that has no coordinates
+    if values.get('latitude') is None or values.get('longitude') is None:
+        values['latitude'], values['longitude'] = geocode(values.get('location')) or (None, None)
+    values['geocell'] = geocell(values['latitude'], values['longitude'])
+    return values
+
+
+def set_coordinates(mapper, connection, retreat):
+    # coordinates given with the retreat win, otherwise they come from the location when it changes
+    state = db.inspect(retreat)
+    missing = retreat.latitude is None or retreat.longitude is None
+    moved = state.attrs.location.history.has_changes() and not (
+        state.attrs.latitude.history.has_changes() or state.attrs.longitude.history.has_changes())
+    if missing or moved:
+        retreat.latitude, retreat.longitude = geocode(retreat.location) or (None, None)
+    retreat.geocell = geocell(retreat.latitude, retreat.longitude)
+
+
+event.listen(Retreat, 'before_insert', set_coordinates)
+event.listen(Retreat, 'before_update', set_coordinates)
+
+
+@app.cli.command('geocode-retreats')
+@click.option('--all', 'everything', is_flag=True, help='Geocode every retreat again, not just the ones without coordinates.')
+@click.option('--batch-size', default=1000, help='Retreats updated per statement.')
+def geocode_retreats(everything, batch_size):
+    """Fill in retreat coordinates from the gazetteer."""
+    stmt = db.select(Retreat.location).distinct()
+    if not everything:
+        stmt = stmt.where(Retreat.latitude.is_(None))
+    table = Retreat.__table__
+    update = (table.update()
+              .where(table.c.location == db.bindparam('match_location'))
+              .values(latitude=db.bindparam('latitude'), longitude=db.bindparam('longitude'), geocell=db.bindparam('geocell')))
+    if not everything:
+        update = update.where(table.c.latitude.is_(None))
+    located = missing = 0
+    batch = []
+    # one UPDATE per distinct location, there are far fewer of those than retreats
+    for (location,) in db.session.execute(stmt).all():
+        coordinates = geocode(location)
+        if coordinates is None:
+            missing += 1
+            continue
+        located += 1
+        batch.append({'match_location': location, 'latitude': coordinates[0], 'longitude': coordinates[1],
+                      'geocell': geocell(*coordinates)})
+        if len(batch) >= batch_size:
+            db.session.execute(update, batch)
+            batch = []
+    if batch:
+        db.session.execute(update, batch)
+    if located:
+        http_cache.invalidate(db.session, 'retreats', 'retreats:all')
+    db.session.commit()
+    click.echo(f"Geocoded {located} locations, {missing} not in the gazetteer")
@@ -0,0 +1,251 @@
+import hashlib
+import inspect
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# Server side cache of rendered responses for the public read routes, plus ETags and 304s.
+#
+# Cached responses are keyed on the URL and the "generation" of the namespaces the route
+# depends on (ex. 'retreats' for the catalogue, 'retreat:12' for one retreat). Writes bump
+# those generations once their transaction commits, so old entries are never read again and
+# fall out of the cache on their own.
+#
+# 'memory' is an LRU per worker, so other workers only see a write once their entry's TTL
+# runs out: with several workers a GET can be up to RESPONSE_CACHE_TTL seconds behind a write. 'sqlite' keeps entries and generations in a local SQLite file that every gunicorn
+# worker on the machine shares, so a write is seen by all of them straight away.
+
+
+class MemoryResponseCache:
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # the generations are an LRU too, each entry depends on one or two namespaces
+        self.max_namespaces = maxsize * 2
+        self._generations = OrderedDict()
+        # generations come from one counter, and a namespace that isn't kept gets the highest one
+        # dropped so far. A namespace's generation never goes back, so a dropped one can't
+        # make its old entries current again (at worst some entries stop being found early).
+        self._counter = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def generations(self, namespaces):
+        with self._lock:
+            generations = []
+            for namespace in namespaces:
+                # kept from now on, so dropping others doesn't change it
+                generations.append(self._generations.setdefault(namespace, self._floor))
+                self._generations.move_to_end(namespace)
+            self._trim_generations()
+            return generations
+
+    def bump(self, namespaces):
+        with self._lock:
+            for namespace in namespaces:
+                self._counter += 1
+                self._generations[namespace] = self._counter
+                self._generations.move_to_end(namespace)
+            self._trim_generations()
+
+    def _trim_generations(self):
+        while len(self._generations) > self.max_namespaces:
+            namespace, generation = self._generations.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteResponseCache:
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._sets = 0
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, expires REAL, status INTEGER, mimetype TEXT, etag TEXT, body BLOB)")
+            connection.execute("CREATE TABLE IF NOT EXISTS generations (namespace TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def _connection(self):
+        # one connection per thread, and a new one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT status, mimetype, etag, body FROM entries WHERE key = ? AND expires >= ?", (key, time.time())
+        ).fetchone()
+        return row
+
+    def set(self, key, value, ttl):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (key, expires, status, mimetype, etag, body) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, time.time() + ttl, *value)
+        )
+        # every so often clear out what has expired and trim the oldest entries
+        self._sets += 1
+        if self._sets % 100 == 0:
+            connection.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+            connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires LIMIT max(0, (SELECT COUNT(*) FROM entries) - ?))",
+                (self.maxsize,)
+            )
+
+    def generations(self, namespaces):
+        placeholders = ', '.join('?' for _ in namespaces)
+        rows = dict(self._connection().execute(
+            f"SELECT namespace, generation FROM generations WHERE namespace IN ({placeholders})", tuple(namespaces)
+        ).fetchall())
+        return [rows.get(namespace, 0) for namespace in namespaces]
+
+    def bump(self, namespaces):
+        self._connection().executemany(
+            "INSERT INTO generations (namespace, generation) VALUES (?, 1) "
+            "ON CONFLICT(namespace) DO UPDATE SET generation = generation + 1",
+            [(namespace,) for namespace in namespaces]
+        )
+
+    def clear(self):
+        self._connection().execute("DELETE FROM entries")
+
+
+class NullResponseCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def generations(self, namespaces):
+        return [0 for _ in namespaces]
+
+    def bump(self, namespaces):
+        pass
+
+    def clear(self):
+        pass
+
+
+def make_response_cache(config):
+    backend = config['RESPONSE_CACHE']
+    if backend == 'memory':
+        return MemoryResponseCache(config['RESPONSE_CACHE_SIZE'])
+    if backend == 'sqlite':
+        return SqliteResponseCache(config['RESPONSE_CACHE_PATH'], config['RESPONSE_CACHE_SIZE'])
+    if backend in ('none', '', None):
+        return NullResponseCache()
+    raise RuntimeError(f"Unknown RESPONSE_CACHE backend {backend!r}")
+
+
+class HTTPCache:
+    def __init__(self, app=None):
+        self.backend = NullResponseCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.backend = make_response_cache(app.config)
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        max_age = app.config['HTTP_CACHE_MAX_AGE']
+        self.cache_control = f'public, max-age={max_age}' if max_age else 'public, no-cache'
+        # namespaces written to in a transaction are bumped once it commits, and dropped if it rolls back
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def invalidate(self, session, *namespaces):
+        session.info.setdefault('http_cache_invalidate', set()).update(namespaces)
+
+    def _after_commit(self, session):
+        namespaces = session.info.pop('http_cache_invalidate', None)
+        if namespaces:
+            self.backend.bump(sorted(namespaces))
+
+    def _after_rollback(self, session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop('http_cache_invalidate', None)
+
+    def cached(self, *namespaces):
+        """Cache the view's 200 responses and answer If-None-Match with 304.
+
+        namespaces can use the view's arguments, ex. @http_cache.cached('retreat:{retreat_id}').
+        The view can be a coroutine function (the async routes in app/asgi.py).
+        """
+        def decorator(view):
+            if inspect.iscoroutinefunction(view):
+                @wraps(view)
+                async def async_wrapper(**kwargs):
+                    key, response = self._lookup(namespaces, kwargs)
+                    if response is not None:
+                        return self._conditional(response)
+                    return self._store(key, make_response(await view(**kwargs)))
+                return async_wrapper
+
+            @wraps(view)
+            def wrapper(**kwargs):
+                key, response = self._lookup(namespaces, kwargs)
+                if response is not None:
+                    return self._conditional(response)
+                return self._store(key, make_response(view(**kwargs)))
+            return wrapper
+        return decorator
+
+    def _lookup(self, namespaces, kwargs):
+        # returns the cache key for this request and the cached response, or None
+        names = [namespace.format(**kwargs) for namespace in namespaces]
+        generations = self.backend.generations(names)
+        key = request.full_path + '|' + '|'.join(f'{name}={generation}' for name, generation in zip(names, generations))
+        entry = self.backend.get(key)
+        if entry is None:
+            return key, None
+        status, mimetype, etag, body = entry
+        response = self.app.response_class(body, status=status, mimetype=mimetype)
+        response.set_etag(etag)
+        return key, response
+
+    def _store(self, key, response):
+        if response.status_code != 200 or response.is_streamed:
+            return response
+        body = response.get_data()
+        etag = response.get_etag()[0] or hashlib.sha1(body).hexdigest()
+        response.set_etag(etag)
+        self.backend.set(key, (response.status_code, response.mimetype, etag, body), self.ttl)
+        return self._conditional(response)
+
+    def _conditional(self, response):
+        response.headers['Cache-Control'] = self.cache_control
+        return response.make_conditional(request)
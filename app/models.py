@@ -1,10 +1,13 @@
-from app import db
+from app import db, token_cache, tokens, passwords, http_cache, seat_events
+from app.serializers import model_serializer, format_date
+from flask import current_app
 import base64
 import os
 import re
 from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy import Column, Integer, String, Text, event
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 # User Model 
 class User(db.Model):
@@ -18,7 +21,12 @@ class User(db.Model):
     
     token = db.Column(db.String(32), index = True, unique=True)
     token_expiration = db.Column(db.DateTime)
-    retreats = db.relationship('Retreat', backref = 'author')
+    # goes up by one on every save, used as the ETag for GET /users/<id>
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # set when a big account is soft deleted, `flask purge-users` deletes the rest of it (see app/accounts.py)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
+    # the database takes the retreats' user_id off (ON DELETE SET NULL), the ORM never loads them for it
+    retreats = db.relationship('Retreat', backref = 'author', passive_deletes='all')
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -31,7 +39,7 @@ class User(db.Model):
         allowed_fields = {'first_name', 'last_name', 'email', 'username', 'password'}
         
         def camel_to_snake(string):
-            return re.sub("([A-Z][A-Za-z]*)","_\1", string).lower()
+            return re.sub(r"([A-Z])", r"_\1", string).lower()
         
         for key, value in kwargs.items():
             snake_key = camel_to_snake(key)
@@ -43,39 +51,108 @@ class User(db.Model):
         self.save()
 
     def save(self):
+        if self.id is not None:
+            self.version = User.version + 1
         db.session.add(self)
         db.session.commit()
+        # the cached copies of this user are out of date now, under every token they have
+        token_cache.invalidate_user(self.id)
         
     def delete(self):
+        # read before the commit, the user can't load anything once it is gone
+        user_id = self.id
         db.session.delete(self)
         db.session.commit()
+        token_cache.invalidate_user(user_id)
 
-    def set_password(self, password):
-        self.password = generate_password_hash(password)
+    def soft_delete(self):
+        # logs the user out everywhere and hides them, their bookings and retreats stay until `flask purge-users`
+        self.deleted_at = datetime.utcnow()
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
         self.save()
 
+    # columns kept in the token cache, the password hash is left out and loads from the database if it is needed
+    CACHED_COLUMNS = ('id', 'first_name', 'last_name', 'email', 'username', 'date_created', 'token', 'token_expiration')
+
+    def cache_columns(self):
+        return {column: getattr(self, column) for column in self.CACHED_COLUMNS}
+
+    @classmethod
+    def from_cache(cls, columns):
+        # rebuild a user from the token cache and attach it to the session without a query
+        user = cls.__mapper__.class_manager.new_instance()
+        for column, value in columns.items():
+            set_committed_value(user, column, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    # only sets the hash, it is written to the database with the next save()
+    def set_password(self, password):
+        self.password = passwords.hash_password(password)
+
     def check_password(self, plain_text_password):
-        return check_password_hash(self.password, plain_text_password)
+        return passwords.check_password(self.password, plain_text_password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password)
 
     def to_dict(self):
-        return {
-            "id": self.id,
-            "firstName": self.first_name,
-            "lastName": self.last_name,
-            "username": self.username,
-            "email": self.email
-        }
+        return serialize_user(self)
         
+    def issue_token(self):
+        # returns (token, expiration) for whichever TOKEN_MODE is configured
+        if current_app.config['TOKEN_MODE'] == 'signed':
+            return tokens.issue_token(current_app.config['SECRET_KEY'], self.id)
+        return self.get_token(), self.token_expiration
+
+    def revoke_token(self, token=None):
+        # log out, token is the signed token being used when TOKEN_MODE is 'signed'
+        if current_app.config['TOKEN_MODE'] == 'signed':
+            payload = tokens.load_token(current_app.config['SECRET_KEY'], token) if token else None
+            token_cache.invalidate(token)
+            if payload is not None and payload.get('jti'):
+                now = datetime.utcnow()
+                # the tokens that have expired since don't need their row any more
+                db.session.execute(db.delete(RevokedToken).where(RevokedToken.expires_at < now))
+                db.session.add(RevokedToken(jti=payload['jti'], expires_at=now + tokens.TOKEN_LIFETIME))
+                db.session.commit()
+            return
+        token_cache.invalidate(self.token)
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        self.save()
+
     def get_token(self):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(minutes=1):
             return self.token
+        token_cache.invalidate(self.token)
         self.token = base64.b64encode(os.urandom(24)).decode("utf-8") 
         self.token_expiration = now + timedelta(hours=1)
         self.save()
         return self.token
     
     
+# turn the free text cost (ex. "$1,200.50") into cents so it can be compared and sorted
+def parse_cost_cents(cost):
+    if cost is None:
+        return None
+    match = re.search(r"\d[\d,]*(\.\d+)?", str(cost))
+    if match is None:
+        return None
+    return int(round(float(match.group().replace(',', '')) * 100))
+
+DURATION_UNITS = {'day': 1, 'night': 1, 'week': 7, 'month': 30}
+
+# turn the free text duration (ex. "7 days", "2 weeks") into a number of days
+def parse_duration_days(duration):
+    if duration is None:
+        return None
+    match = re.search(r"(\d+)\s*(day|night|week|month)?", str(duration).lower())
+    if match is None:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 'day']
+
+
 # Retreat Model
 class Retreat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -85,13 +162,33 @@ class Retreat(db.Model):
     duration = db.Column(db.String(50), nullable=True)  
     date = db.Column(db.Date, nullable=True)  
     cost = db.Column(db.String(20), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    # numeric copies of cost and duration, kept in sync in save()
+    cost_cents = db.Column(db.Integer, nullable=True, index=True)
+    duration_days = db.Column(db.Integer, nullable=True, index=True)
+    # set for retreats that come from the BookRetreats feed, sync_hash is a hash of the feed values last written
+    external_id = db.Column(db.String(64), nullable=True, unique=True, index=True)
+    sync_hash = db.Column(db.String(40), nullable=True)
+    # no capacity means unlimited seats, seats_booked is only changed by reserve_seat() and release_seat()
+    capacity = db.Column(db.Integer, nullable=True)
+    seats_booked = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # goes up by one on every change, used as the ETag for GET /retreats/<id>
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # from the request or geocoded from location, geocell is their geohash for /retreats/nearby (see app.geo)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geocell = db.Column(db.BigInteger, nullable=True, index=True)
+
+    __table_args__ = (
+        db.Index('ix_retreat_location_date', 'location', 'date'),
+        db.Index('ix_retreat_user_id_date', 'user_id', 'date'),
+    )
     
     def update(self,**kwargs):
-        allowed_fields = {'description', 'name', 'cost', 'duration', 'date', 'location' }
+        allowed_fields = {'description', 'name', 'cost', 'duration', 'date', 'location', 'capacity', 'latitude', 'longitude'}
         
         def camel_to_snake(string):
-            return re.sub("([A-Z][A-Za-z]*)","_\1", string).lower()
+            return re.sub(r"([A-Z])", r"_\1", string).lower()
         
         for key, value in kwargs.items():
             snake_key = camel_to_snake(key)
@@ -103,7 +200,7 @@ class Retreat(db.Model):
         self.save()
 
 
-    def __init__(self, name, location, description=None, duration=None, date=None, cost=None, user_id=None):
+    def __init__(self, name, location, description=None, duration=None, date=None, cost=None, user_id=None, capacity=None, latitude=None, longitude=None):
         self.name = name
         self.location = location
         self.description = description
@@ -111,9 +208,16 @@ class Retreat(db.Model):
         self.date = date
         self.cost = cost
         self.user_id = user_id
-        self.save()
+        self.capacity = capacity
+        self.latitude = latitude
+        self.longitude = longitude
+        self.seats_booked = 0
         
     def save(self):
+        if self.id is not None:
+            self.version = Retreat.version + 1
+        self.cost_cents = parse_cost_cents(self.cost)
+        self.duration_days = parse_duration_days(self.duration)
         db.session.add(self)
         db.session.commit()
         
@@ -122,19 +226,147 @@ class Retreat(db.Model):
         db.session.commit()    
         
     def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'location': self.location,
-            'description': self.description,
-            'duration': self.duration,
-            'cost': self.cost,
-            'date': self.date,
-            'userId':self.user_id
-        }
+        return serialize_retreat(self)
+
+    @staticmethod
+    def reserve_seat(retreat_id):
+        # takes a seat in one conditional UPDATE so two people can't get the last one, False if the retreat is full
+        result = db.session.execute(
+            db.update(Retreat)
+            .where(Retreat.id == retreat_id)
+            .where((Retreat.capacity.is_(None)) | (Retreat.seats_booked < Retreat.capacity))
+            .values(seats_booked=Retreat.seats_booked + 1, version=Retreat.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        http_cache.invalidate(db.session, 'retreats', f'retreat:{retreat_id}')
+        seat_events.changed(db.session, retreat_id)
+        return result.rowcount == 1
+
+    @staticmethod
+    def release_seat(retreat_id):
+        db.session.execute(
+            db.update(Retreat)
+            .where(Retreat.id == retreat_id)
+            .where(Retreat.seats_booked > 0)
+            .values(seats_booked=Retreat.seats_booked - 1, version=Retreat.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        http_cache.invalidate(db.session, 'retreats', f'retreat:{retreat_id}')
+        seat_events.changed(db.session, retreat_id)
+
+# drop the cached GET responses for users and retreats when they are written through the ORM
+def invalidate_user_responses(mapper, connection, user):
+    http_cache.invalidate(object_session(user), f'user:{user.id}')
+
+def invalidate_retreat_responses(mapper, connection, retreat):
+    http_cache.invalidate(object_session(retreat), 'retreats', f'retreat:{retreat.id}')
+    # a new capacity, or the retreat is gone, for anyone watching its seats
+    seat_events.changed(object_session(retreat), retreat.id)
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(User, event_name, invalidate_user_responses)
+    event.listen(Retreat, event_name, invalidate_retreat_responses)
+
+
+# to_dict() for each model, JSON key: attribute
+serialize_user = model_serializer({
+    'id': 'id',
+    'firstName': 'first_name',
+    'lastName': 'last_name',
+    'username': 'username',
+    'email': 'email'
+})
+serialize_retreat = model_serializer({
+    'id': 'id',
+    'name': 'name',
+    'location': 'location',
+    'description': 'description',
+    'duration': 'duration',
+    'cost': 'cost',
+    'date': 'date',
+    'userId': 'user_id',
+    'capacity': 'capacity',
+    'seatsBooked': 'seats_booked',
+    'latitude': 'latitude',
+    'longitude': 'longitude'
+}, {'date': format_date})
+
 
 # Booking Model
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    retreat_id = db.Column(db.Integer, db.ForeignKey('retreat.id'), nullable=False)
+    # deleting the user or the retreat deletes the booking in the database (ON DELETE CASCADE)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    retreat_id = db.Column(db.Integer, db.ForeignKey('retreat.id', ondelete='CASCADE'), nullable=False)
+    retreat = db.relationship('Retreat')
+
+    # one booking per user per retreat, also the index for looking up a user's bookings
+    __table_args__ = (
+        db.Index('uq_booking_user_id_retreat_id', 'user_id', 'retreat_id', unique=True),
+    )
+
+
+# IdempotencyKey Model, the response sent for an Idempotency-Key so a retried POST gets the same answer
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_idempotency_key_user_id_key'),
+    )
+
+
+# RevokedToken Model, signed tokens logged out before they expire (TOKEN_MODE 'signed', see app/tokens.py)
+class RevokedToken(db.Model):
+    jti = db.Column(db.String(32), primary_key=True)
+    # when the token would have expired, the row can go after that
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+def signed_token_user(payload):
+    # the user a signed token is for, if they still exist, aren't soft deleted and didn't log the token out
+    revoked = db.select(RevokedToken.jti).where(RevokedToken.jti == payload.get('jti')).exists()
+    return db.select(User).where(User.id == payload['id'], User.deleted_at.is_(None), ~revoked)
+
+
+# SyncState Model, the ETag/Last-Modified the partner API sent for each page it was asked for
+class SyncState(db.Model):
+    url = db.Column(db.String(512), primary_key=True)
+    etag = db.Column(db.String(255), nullable=True)
+    last_modified = db.Column(db.String(64), nullable=True)
+    total_pages = db.Column(db.Integer, nullable=True)
+    synced_at = db.Column(db.DateTime, nullable=True)
+
+
+# StatRollup Model, retreat and booking counts per location, month and organizer kept up to date by app.stats
+class StatRollup(db.Model):
+    __tablename__ = 'stat_rollup'
+    # 'location', 'month' (YYYY-MM) or 'organizer' (the user id), bucket is '' when the retreat has no value
+    dimension = db.Column(db.String(20), primary_key=True)
+    bucket = db.Column(db.String(255), primary_key=True)
+    retreats = db.Column(db.Integer, nullable=False, default=0)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+
+
+# SimilarRetreat Model, the retreats most often booked by the same people as retreat_id, built by app.similar
+class SimilarRetreat(db.Model):
+    __tablename__ = 'similar_retreat'
+    retreat_id = db.Column(db.Integer, primary_key=True)
+    # 1 is the most similar
+    rank = db.Column(db.Integer, primary_key=True)
+    similar_id = db.Column(db.Integer, nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+    co_bookings = db.Column(db.Integer, nullable=False)
+
+
+# SimilarityState Model, each retreat's bookings as of the last similar retreats build, to find the ones that changed since
+class SimilarityState(db.Model):
+    __tablename__ = 'similarity_state'
+    retreat_id = db.Column(db.Integer, primary_key=True)
+    bookings = db.Column(db.Integer, nullable=False)
+    max_booking_id = db.Column(db.Integer, nullable=False)
+    retreat_version = db.Column(db.Integer, nullable=False)
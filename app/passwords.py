@@ -0,0 +1,66 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+# Password hashing with the parameters from Config.
+# With PASSWORD_HASH_WORKERS > 0 the hashing runs in a process pool so a burst of logins
+# doesn't keep the request threads (and the GIL) busy. The pool is made the first time it is
+# used in each process, so it is never shared across a gunicorn fork.
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_slots
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if workers <= 0:
+        return None, None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_pid = os.getpid()
+            # caps how many hashes can wait on the pool at once, the rest wait here
+            _pool_slots = threading.BoundedSemaphore(workers * current_app.config['PASSWORD_HASH_QUEUE'])
+        return _pool, _pool_slots
+
+
+def _run(function, *args):
+    pool, slots = _get_pool()
+    if pool is None:
+        return function(*args)
+    with slots:
+        return pool.submit(function, *args).result()
+
+
+def hash_password(password):
+    return _run(
+        generate_password_hash,
+        password,
+        current_app.config['PASSWORD_HASH_METHOD'],
+        current_app.config['PASSWORD_SALT_LENGTH']
+    )
+
+
+def check_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+@lru_cache(maxsize=None)
+def _full_method(method):
+    # werkzeug fills in default parameters (ex. "scrypt" -> "scrypt:32768:8:1"), hash once to see what they are
+    return generate_password_hash('', method, 1).split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    # True if the hash was made with different parameters than the ones configured now
+    method, _, rest = password_hash.partition('$')
+    salt = rest.partition('$')[0]
+    return (method != _full_method(current_app.config['PASSWORD_HASH_METHOD'])
+            or len(salt) != current_app.config['PASSWORD_SALT_LENGTH'])
@@ -0,0 +1,83 @@
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that also keeps track of how long requests wait to get a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checkedIn': pool.checkedin(),
+            'checkedOut': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'maxOverflow': pool._max_overflow,
+            'timeout': pool.timeout(),
+        })
+    if isinstance(pool, TimedQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'waitSecondsTotal': round(pool.wait_seconds, 6),
+                'waitSecondsMax': round(pool.max_wait_seconds, 6),
+                'waitSecondsAvg': round(pool.wait_seconds / pool.checkouts, 6) if pool.checkouts else 0.0,
+            })
+    return stats
+
+
+def pool_options(engine_options):
+    # returns the options to create an engine with and the statement timeout app.pool has to set itself
+    engine_options = dict(engine_options)
+    statement_timeout_ms = engine_options.pop('statement_timeout_ms', 0)
+    if 'pool_size' in engine_options:
+        engine_options.setdefault('poolclass', TimedQueuePool)
+    return engine_options, statement_timeout_ms
+
+
+def enable_sqlite_foreign_keys(engine):
+    # SQLite only enforces foreign keys, and so only runs their ON DELETE rules, when it is asked to on each connection
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+def set_mysql_statement_timeout(engine, statement_timeout_ms):
+    # mysql-connector can't take this as a connect argument, so it is set on every new connection
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET SESSION max_execution_time = {int(statement_timeout_ms)}")
+        cursor.close()
@@ -0,0 +1,136 @@
+import json
+import logging
+import threading
+import time
+from flask import g, has_request_context, request, request_started, request_finished
+from sqlalchemy import event
+
+
+# Per request SQL profiling, turned on with SQL_PROFILING.
+# Every statement run while handling a request is timed through the engine's cursor events.
+# When the request finishes it gets a Server-Timing header and one JSON log line, and its
+# numbers are added to per endpoint totals that /_metrics serves in the Prometheus format.
+# A statement run SQL_N_PLUS_ONE_THRESHOLD or more times with different parameters in one
+# request is reported as an N+1 (ex. a lazy load of retreat.author inside a loop).
+
+logger = logging.getLogger('app.profiling')
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.statements = {}
+
+    def record(self, statement, parameters, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+        self.statements.setdefault(statement, set()).add(repr(parameters))
+
+    def repeated_statements(self, threshold):
+        return [statement for statement, parameters in self.statements.items() if len(parameters) >= threshold]
+
+
+class EndpointTotals:
+    def __init__(self):
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.n_plus_one = 0
+
+
+class SQLProfiler:
+    def __init__(self, app=None, db=None):
+        self.totals = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.slow_query_seconds = app.config['SQL_SLOW_QUERY_MS'] / 1000
+        self.n_plus_one_threshold = app.config['SQL_N_PLUS_ONE_THRESHOLD']
+        with app.app_context():
+            for engine in db.engines.values():
+                self.listen(engine)
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+
+    def listen(self, engine):
+        # also called by app/asgi.py for the sync_engine of its async engines
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        context._profile_started = time.perf_counter()
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._profile_started
+        if seconds >= self.slow_query_seconds:
+            logger.warning(json.dumps({'event': 'slow_query', 'ms': round(seconds * 1000, 3), 'statement': statement}))
+        if has_request_context() and 'sql_profile' in g:
+            g.sql_profile.record(statement, parameters, seconds)
+
+    def _request_started(self, sender, **extra):
+        g.sql_profile = RequestProfile()
+
+    def _request_finished(self, sender, response, **extra):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return
+        request_seconds = time.perf_counter() - profile.started
+        repeated = profile.repeated_statements(self.n_plus_one_threshold)
+        endpoint = request.endpoint or 'unknown'
+
+        response.headers.add('Server-Timing', f'db;dur={profile.sql_seconds * 1000:.2f};desc="{profile.queries} queries"')
+        response.headers.add('Server-Timing', f'app;dur={request_seconds * 1000:.2f}')
+        logger.info(json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'ms': round(request_seconds * 1000, 3),
+            'queries': profile.queries,
+            'sqlMs': round(profile.sql_seconds * 1000, 3),
+            'slowestMs': round(profile.slowest_seconds * 1000, 3),
+            'slowestStatement': profile.slowest_statement,
+            'nPlusOne': repeated,
+        }))
+
+        with self._lock:
+            totals = self.totals.setdefault((endpoint, request.method, response.status_code), EndpointTotals())
+            totals.requests += 1
+            totals.request_seconds += request_seconds
+            totals.queries += profile.queries
+            totals.sql_seconds += profile.sql_seconds
+            totals.n_plus_one += len(repeated)
+
+    def prometheus_lines(self):
+        metrics = [
+            ('app_requests_total', 'counter', 'Requests handled', 'requests'),
+            ('app_request_seconds_total', 'counter', 'Time spent handling requests', 'request_seconds'),
+            ('app_sql_queries_total', 'counter', 'SQL statements run while handling requests', 'queries'),
+            ('app_sql_seconds_total', 'counter', 'Time spent in SQL while handling requests', 'sql_seconds'),
+            ('app_sql_n_plus_one_total', 'counter', 'Statements repeated with different parameters in one request', 'n_plus_one'),
+        ]
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda item: (item[0][0], item[0][1], item[0][2]))
+            lines = []
+            for name, metric_type, help_text, attribute in metrics:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for (endpoint, method, status), endpoint_totals in totals:
+                    labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+                    lines.append(f'{name}{{{labels}}} {getattr(endpoint_totals, attribute)}')
+        return lines
+
+
+def gauge_lines(name, help_text, value, metric_type='gauge'):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
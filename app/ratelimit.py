@@ -0,0 +1,221 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from flask import request
+
+
+# Token bucket rate limits for the expensive routes, and load shedding.
+#
+# Routes declare their buckets with @rate_limiter.limit('CONFIG_KEY', per='ip'|'username'|'user').
+# The rate ("30/minute") is read from that config key. Each (route, key) gets a bucket that holds
+# up to that many requests and refills at that rate. A request that finds it empty gets a 429
+# with Retry-After before the view (or the password check, for GET /token) runs.
+#
+# 'memory' buckets are per worker, so with N gunicorn workers a client can get up to N times the
+# rate. 'sqlite' keeps them in a local SQLite file shared by every worker on the machine, the
+# same way http_cache's 'sqlite' backend does.
+#
+# per='ip' keys on request.remote_addr. Behind nginx or a load balancer that is the proxy's address
+# and every client would share one bucket, so set TRUSTED_PROXIES to the number of proxies in front
+# of the app and the address comes from X-Forwarded-For (werkzeug's ProxyFix, see app/__init__.py).
+# Don't set it higher than that, a client could then pick its own address with a made up header.
+#
+# Load shedding: with SHED_QUEUE_MS set, a request that waited longer than that between the
+# proxy and a worker gets a 503 straight away instead of adding to the queue behind it. The wait
+# comes from the proxy's X-Request-Start header (nginx: proxy_set_header X-Request-Start "t=${msec}").
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+
+@lru_cache(maxsize=64)
+def parse_rate(rate):
+    """'30/minute' -> (30, 0.5) as (bucket size, requests per second), None if the limit is off."""
+    if not rate or rate.lower() == 'none':
+        return None
+    count, _, period = rate.partition('/')
+    try:
+        count = int(count)
+        seconds = PERIODS[period.strip().lower()]
+    except (ValueError, KeyError):
+        raise ValueError(f"Rate limits look like '30/minute' (per second, minute or hour), not {rate!r}")
+    if count <= 0:
+        return None
+    return count, count / seconds
+
+
+def refill(tokens, updated, now, capacity, per_second):
+    """Takes one token from a bucket, returns (tokens left, seconds to wait or 0 if it was allowed)."""
+    tokens = min(capacity, tokens + (now - updated) * per_second)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / per_second
+
+
+class MemoryBuckets:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_second):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, wait = refill(tokens, updated, now, capacity, per_second)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # the least recently used buckets go first, they have mostly filled back up anyway
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SqliteBuckets:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, wait REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        # one connection per thread, and a new one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, capacity, per_second):
+        # refill() in one statement so two workers can't both take the last token, SET sees the old row
+        now = time.time()
+        connection = self._connection()
+        wait = connection.execute(
+            "INSERT INTO buckets (key, tokens, updated, wait) VALUES (:key, :capacity - 1, :now, 0) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "tokens = min(:capacity, tokens + (:now - updated) * :rate) - (min(:capacity, tokens + (:now - updated) * :rate) >= 1), "
+            "wait = CASE WHEN min(:capacity, tokens + (:now - updated) * :rate) >= 1 THEN 0 "
+            "ELSE (1 - min(:capacity, tokens + (:now - updated) * :rate)) / :rate END, "
+            "updated = :now "
+            "RETURNING wait",
+            {'key': key, 'capacity': capacity, 'rate': per_second, 'now': now}
+        ).fetchone()[0]
+        # every so often drop the buckets nobody has used in an hour, they would be full by now
+        self._takes += 1
+        if self._takes % 1000 == 0:
+            connection.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+        return wait
+
+    def clear(self):
+        self._connection().execute("DELETE FROM buckets")
+
+
+class NullBuckets:
+    def take(self, key, capacity, per_second):
+        return 0
+
+    def clear(self):
+        pass
+
+
+def make_buckets(config):
+    backend = config['RATE_LIMIT_BACKEND']
+    if backend == 'memory':
+        return MemoryBuckets(config['RATE_LIMIT_SIZE'])
+    if backend == 'sqlite':
+        return SqliteBuckets(config['RATE_LIMIT_PATH'])
+    if backend in ('none', '', None):
+        return NullBuckets()
+    raise RuntimeError(f"Unknown RATE_LIMIT_BACKEND {backend!r}")
+
+
+def request_queue_ms(header, now=None):
+    """Milliseconds since the proxy got the request, from X-Request-Start ("t=1700000000.123", seconds, ms or µs)."""
+    if not header:
+        return None
+    try:
+        started = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    # the unit goes by size: seconds are ~1.7e9 today, milliseconds ~1.7e12, microseconds ~1.7e15
+    while started > 1e11:
+        started /= 1000
+    return ((now or time.time()) - started) * 1000
+
+
+def too_many_requests(wait, message):
+    retry_after = max(1, math.ceil(wait))
+    return {'error': f"{message}, try again in {retry_after} second{'s' if retry_after != 1 else ''}"}, 429, {'Retry-After': str(retry_after)}
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        self.buckets = NullBuckets()
+        self.limited = 0
+        self.shed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.buckets = make_buckets(app.config)
+        app.before_request(self._before_request)
+
+    def limit(self, config_key, per='ip'):
+        """Token bucket for the view, the rate is read from app.config[config_key] on each request.
+
+        per is 'ip', 'username' (from the Authorization header, checked before the password is) or
+        'user' (the authenticated user, put it under @token_auth.login_required). Stack it to have more than one.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                rate = parse_rate(self.app.config[config_key])
+                key = self._key(per)
+                if rate is not None and key is not None:
+                    wait = self.buckets.take(f'{view.__name__}:{per}:{key}', *rate)
+                    if wait:
+                        self.limited += 1
+                        return too_many_requests(wait, 'Too many requests')
+                return view(**kwargs)
+            return wrapper
+        return decorator
+
+    def _key(self, per):
+        if per == 'ip':
+            return request.remote_addr
+        if per == 'username':
+            # None (no bucket) without basic auth, the password check turns those away anyway
+            return request.authorization.username if request.authorization else None
+        if per == 'user':
+            from app.auth import token_auth
+            user = token_auth.current_user()
+            return user.id if user is not None else request.remote_addr
+        raise ValueError(f"Unknown rate limit key {per!r}")
+
+    def _before_request(self):
+        shed_ms = self.app.config['SHED_QUEUE_MS']
+        # the monitoring endpoints are always answered
+        if not shed_ms or request.path.startswith('/_'):
+            return None
+        queue_ms = request_queue_ms(request.headers.get('X-Request-Start'))
+        if queue_ms is not None and queue_ms > shed_ms:
+            self.shed += 1
+            body, status, headers = too_many_requests(1, 'The server is busy')
+            return body, 503, headers
+        return None
+
+    def stats(self):
+        return {'backend': type(self.buckets).__name__, 'limited': self.limited, 'shed': self.shed}
@@ -0,0 +1,99 @@
+import threading
+import time
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+
+
+# Read replica routing, turned on by setting SQLALCHEMY_REPLICA_URI.
+# Views marked with @replicas.read_only send their reads (including the token lookup in
+# verify_token) to the 'replica' bind. Everything else stays on the primary, and so does:
+#   - any flush or INSERT/UPDATE/DELETE, and every read after it in the same request
+#   - a user who wrote something in the last REPLICA_STICKY_SECONDS (ex. GET /bookings right
+#     after POST /retreats/book/<id>), so they read their own writes while the replica catches up
+# Recent writers are kept per worker process, keep it longer than the replica usually lags.
+# Public routes are still cached by http_cache, a read from a lagging replica right after a write
+# can be cached until RESPONSE_CACHE_TTL runs out.
+
+REPLICA_BIND = 'replica'
+
+
+class RecentWriters:
+    def __init__(self, seconds, max_size=100000):
+        self.seconds = seconds
+        self.max_size = max_size
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def mark(self, user_id):
+        with self._lock:
+            if len(self._until) >= self.max_size:
+                now = time.monotonic()
+                self._until = {key: until for key, until in self._until.items() if until > now}
+            self._until[user_id] = time.monotonic() + self.seconds
+
+    def __contains__(self, user_id):
+        with self._lock:
+            until = self._until.get(user_id)
+            if until is None:
+                return False
+            if until <= time.monotonic():
+                del self._until[user_id]
+                return False
+            return True
+
+
+class RoutingSession(Session):
+    """db.session class that sends the reads of read only views to the replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and g.get('use_replica'):
+            if self._flushing or getattr(clause, 'is_dml', False) or getattr(clause, '_for_update_arg', None) is not None:
+                # a write, the rest of the request reads from the primary
+                g.use_replica = False
+                g.wrote = True
+            else:
+                return self._db.engines[REPLICA_BIND]
+        elif has_request_context() and (self._flushing or getattr(clause, 'is_dml', False)):
+            g.wrote = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.recent_writers = RecentWriters(0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = REPLICA_BIND in app.config['SQLALCHEMY_BINDS']
+        self.recent_writers = RecentWriters(app.config['REPLICA_STICKY_SECONDS'])
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def read_only(self, view):
+        """Mark a view as safe to answer from the replica."""
+        view.replica_reads = True
+        return view
+
+    def using_replica(self):
+        return has_request_context() and bool(g.get('use_replica'))
+
+    def use_primary(self):
+        g.use_replica = False
+
+    def set_user(self, user_id):
+        # called once the request's user is known, they go to the primary if they just wrote
+        g.replica_user_id = user_id
+        if g.get('use_replica') and user_id in self.recent_writers:
+            g.use_replica = False
+
+    def _before_request(self):
+        view = self.app.view_functions.get(request.endpoint)
+        g.use_replica = self.enabled and getattr(view, 'replica_reads', False)
+
+    def _after_request(self, response):
+        if self.enabled and g.get('wrote') and g.get('replica_user_id') is not None:
+            self.recent_writers.mark(g.replica_user_id)
+        return response
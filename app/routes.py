@@ -1,22 +1,43 @@
-from flask import jsonify, request
-from app import app, db
+from flask import jsonify, request, Response, stream_with_context, url_for, make_response
+from app import app, db, token_cache, http_cache, sql_profiler, replicas, rate_limiter, seat_events
 from app.models import User
 from app.auth import basic_auth, token_auth
-from app.models import User, Retreat, Booking
-from datetime import datetime
-from flask_login import current_user
+from app.models import User, Retreat, Booking, IdempotencyKey, StatRollup, SimilarRetreat
+from app.search import get_search_backend
+from app.pool import pool_stats
+from app.profiling import gauge_lines
+from app.serializers import row_serializer, format_date
+from app.stats import DIMENSIONS
+from app.similar import TOP_K
+from app import accounts, batch, bulk, geo
+from datetime import datetime, date
+import base64
+import json
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy import func
 
 
 
 
 # USER ENDPOINTS
 @app.route("/token")
+@rate_limiter.limit('RATE_LIMIT_TOKEN_PER_IP', per='ip')
+@rate_limiter.limit('RATE_LIMIT_TOKEN_PER_USERNAME', per='username')
 @basic_auth.login_required
 def get_token():
     user = basic_auth.current_user()
-    token = user.get_token()
+    token, token_expiration = user.issue_token()
     return {"token": token, 
-            "tokenExpiration":user.token_expiration}
+            "tokenExpiration":token_expiration}
+
+# log out
+@app.route("/token", methods=['DELETE'])
+@token_auth.login_required
+def revoke_token():
+    user = token_auth.current_user()
+    user.revoke_token(token_auth.get_auth().token)
+    return {'success': 'Your token has been revoked'}
     
 #Create New User
 @app.route('/users', methods=['POST'])
@@ -42,13 +63,13 @@ def create_user():
     email = data.get('email')
     password = data.get('password')
     
-    # Check to see if any current users already have that username and/or email
-    check_users = db.session.execute(db.select(User).where((User.username==username)|(User.email==email))).scalars().all() 
-    # If the list is not empty then someone alrady has that username or email
-    if check_users:
-        return {'error': ' A user with that username and/or email already exists'}, 400
-    # Create a new user dict instance which will add it to the database
+    # Create a new user and add it to the database, the unique constraints on username and email catch duplicates
     new_user = User(first_name=first_name, last_name=last_name, username=username, email=email, password=password)
+    try:
+        new_user.save()
+    except IntegrityError:
+        db.session.rollback()
+        return {'error': ' A user with that username and/or email already exists'}, 400
     return new_user.to_dict(), 201
 
     #update 
@@ -70,7 +91,11 @@ def edit_user(user_id):
         return {'error': 'You cannot change this user as you are not them!'}, 403
     # then we update! 
     data = request.json
-    user.update(**data)
+    try:
+        user.update(**data)
+    except IntegrityError:
+        db.session.rollback()
+        return {'error': ' A user with that username and/or email already exists'}, 400
     return user.to_dict()
 
 # delete
@@ -87,29 +112,48 @@ def delete_user(user_id):
     # make sure user to delete is current user
     if user is not current_user:
         return {'error': 'You cant do that, delete yourself only'}, 403
-    # delete user
+    # big accounts are soft deleted now and `flask purge-users` deletes their bookings and retreats in batches
+    if accounts.is_large(user.id, app.config['USER_PURGE_THRESHOLD']):
+        user.soft_delete()
+        return {'success': f"{user.username} has been deleted, their bookings and retreats will be removed shortly"}, 202
+    # delete user, the database deletes their bookings and takes their name off their retreats (see app/accounts.py)
+    username = user.username
     user.delete()
-    return {'success': f"{user.username} has been deleted"}
+    return {'success': f"{username} has been deleted"}
 
 # retrieve
 @app.route("/users/<int:user_id>")
+@http_cache.cached('user:{user_id}')
+@replicas.read_only
 def get_user(user_id):
     #get the user
     user = db.session.get(User, user_id)
     #if no user let them know
-    if user:
-        return user.to_dict()
+    if user and user.deleted_at is None:
+        response = make_response(user.to_dict())
+        response.set_etag(f'user-{user.id}-{user.version}')
+        return response
     else:
         return {'error': f"user with id:{user_id} not found"}, 404
     
 @app.route('/users/me')
 @token_auth.login_required
+@replicas.read_only
 def get_me():
     current_user = token_auth.current_user()
     return current_user.to_dict()
     
     
     # RETREAT ENDPOINTS 
+def parse_retreat_date(value):
+    # the date sent in a retreat's JSON (YYYY-MM-DD or null), ValueError if it isn't one
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError('date must be in the format YYYY-MM-DD')
+
 @app.route('/retreats', methods=['POST'])
 @token_auth.login_required
 def create_retreat():
@@ -127,29 +171,387 @@ def create_retreat():
     # Get the values from the data
     name = data.get('name')
     location = data.get('location')
-    date = data.get('date')
     description = data.get('description')
     duration = data.get('duration')
     cost = data.get('cost')
+    capacity = data.get('capacity')
+    if capacity is not None and (not isinstance(capacity, int) or capacity < 0):
+        return {'error': 'capacity must be a whole number'}, 400
+    try:
+        retreat_date = parse_retreat_date(data.get('date'))
+        # optional, they are looked up from the location if they aren't sent
+        latitude, longitude = geo.parse_coordinates(data.get('latitude'), data.get('longitude'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
     user_id = token_auth.current_user().id
     
     # Create a new retreat instance which will add it to the database
-    new_retreat = Retreat(name=name, location=location, date=date, description=description, duration=duration, cost=cost, user_id=user_id)
+    new_retreat = Retreat(name=name, location=location, date=retreat_date, description=description, duration=duration, cost=cost, user_id=user_id, capacity=capacity, latitude=latitude, longitude=longitude)
+    new_retreat.save()
     return new_retreat.to_dict(), 201
 
 @app.route('/retreats/<int:retreat_id>', methods=['GET'])
+@http_cache.cached('retreats:all', 'retreat:{retreat_id}')
+@replicas.read_only
 def get_retreat_by_id(retreat_id):
-    retreat = Retreat.query.get(retreat_id)
+    retreat = db.session.get(Retreat, retreat_id)
 
     if not retreat:
         return{'error':f"Retreat with ID {retreat_id} not found"}, 404
 
-    return retreat.to_dict()
+    response = make_response(retreat.to_dict())
+    response.set_etag(f'retreat-{retreat.id}-{retreat.version}')
+    return response
+
+# maps the keys in Retreat.to_dict() to their columns so ?fields= only selects what it needs
+RETREAT_FIELDS = {
+    'id': Retreat.id,
+    'name': Retreat.name,
+    'location': Retreat.location,
+    'description': Retreat.description,
+    'duration': Retreat.duration,
+    'cost': Retreat.cost,
+    'date': Retreat.date,
+    'userId': Retreat.user_id,
+    'capacity': Retreat.capacity,
+    'seatsBooked': Retreat.seats_booked,
+    'latitude': Retreat.latitude,
+    'longitude': Retreat.longitude
+}
+RETREAT_CONVERTERS = (('date', format_date),)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def retreat_rows(fields, rows):
+    # the rows from retreat_query_from_args as the dicts Retreat.to_dict() would give
+    serialize = row_serializer(tuple(fields), RETREAT_CONVERTERS)
+    return [serialize(row) for row in rows]
+
+
+def apply_retreat_filters(stmt, args):
+    # add the location, date, cost and duration filters from the query string to a select
+    if args.get('location'):
+        stmt = stmt.where(Retreat.location == args['location'])
+    try:
+        if args.get('dateFrom'):
+            stmt = stmt.where(Retreat.date >= date.fromisoformat(args['dateFrom']))
+        if args.get('dateTo'):
+            stmt = stmt.where(Retreat.date <= date.fromisoformat(args['dateTo']))
+    except ValueError:
+        raise ValueError('dateFrom and dateTo must be dates in the format YYYY-MM-DD')
+    try:
+        # costs are sent in dollars but stored in cents
+        if args.get('minCost'):
+            stmt = stmt.where(Retreat.cost_cents >= round(float(args['minCost']) * 100))
+        if args.get('maxCost'):
+            stmt = stmt.where(Retreat.cost_cents <= round(float(args['maxCost']) * 100))
+    except ValueError:
+        raise ValueError('minCost and maxCost must be numbers')
+    try:
+        if args.get('minDays'):
+            stmt = stmt.where(Retreat.duration_days >= int(args['minDays']))
+        if args.get('maxDays'):
+            stmt = stmt.where(Retreat.duration_days <= int(args['maxDays']))
+    except ValueError:
+        raise ValueError('minDays and maxDays must be whole numbers')
+    return stmt
+
+
+def retreat_query_from_args(args):
+    # build the select for GET /retreats from the query string, returns (statement, field names)
+    fields = list(RETREAT_FIELDS)
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown_fields = [field for field in fields if field not in RETREAT_FIELDS]
+        if unknown_fields:
+            raise ValueError(f"Unknown fields: {', '.join(unknown_fields)}")
+        # the id is always sent back because it is the pagination cursor
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+    stmt = apply_retreat_filters(db.select(*[RETREAT_FIELDS[field] for field in fields]), args)
+    if args.get('after'):
+        if not args['after'].isdigit():
+            raise ValueError('after must be a retreat id')
+        stmt = stmt.where(Retreat.id > int(args['after']))
+    return stmt.order_by(Retreat.id), fields
+
+
+def stream_retreats(stmt, fields):
+    # sends one big JSON list in chunks, reading rows off a server-side cursor
+    result = db.session.execute(stmt.execution_options(yield_per=app.config['STREAM_CHUNK_SIZE']))
+    yield '['
+    first = True
+    for rows in result.partitions():
+        chunk = ','.join(app.json.dumps(retreat) for retreat in retreat_rows(fields, rows))
+        if chunk:
+            yield chunk if first else ',' + chunk
+            first = False
+    yield ']'
+
 
 @app.route('/retreats', methods=['GET'])
+@http_cache.cached('retreats')
+@replicas.read_only
 def get_all_retreats():
-    retreats = Retreat.query.all()
-    return [retreat.to_dict() for retreat in retreats]
+    try:
+        stmt, fields = retreat_query_from_args(request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    # full export, rows are streamed so the worker never holds the whole table
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return Response(stream_with_context(stream_retreats(stmt, fields)), mimetype='application/json')
+
+    limit = page_limit()
+    # get one extra row to know if there is another page
+    rows = db.session.execute(stmt.limit(limit + 1)).all()
+    return retreats_page(fields, rows, limit)
+
+
+def page_limit():
+    # ?limit= within 1 and MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE if it is missing or not a number
+    return max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+
+def retreats_page(fields, rows, limit):
+    # the GET /retreats response for up to limit + 1 rows, also used by app/asgi.py
+    retreats = retreat_rows(fields, rows[:limit])
+    response = jsonify(retreats)
+    if len(rows) > limit:
+        next_args = request.args.to_dict()
+        next_args['after'] = retreats[-1]['id']
+        response.headers['Link'] = f'<{url_for("get_all_retreats", **next_args)}>; rel="next"'
+        response.headers['X-Next-Cursor'] = str(retreats[-1]['id'])
+    return response
+
+NEARBY_DEFAULT_RADIUS_KM = 50
+NEARBY_MAX_RADIUS_KM = 2000
+
+
+@app.route('/retreats/nearby', methods=['GET'])
+@http_cache.cached('retreats')
+@replicas.read_only
+def get_nearby_retreats():
+    # the retreats within radius km of lat/lng, closest first, the other /retreats filters work too
+    try:
+        latitude, longitude = geo.parse_coordinates(request.args.get('lat'), request.args.get('lng'))
+        if latitude is None:
+            raise ValueError('lat and lng must be in the query string')
+        try:
+            radius = float(request.args.get('radius', NEARBY_DEFAULT_RADIUS_KM))
+        except ValueError:
+            raise ValueError('radius must be a number of km')
+        if not 0 < radius <= NEARBY_MAX_RADIUS_KM:
+            raise ValueError(f'radius must be more than 0 and at most {NEARBY_MAX_RADIUS_KM} km')
+        stmt = apply_retreat_filters(db.select(Retreat), request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    matches = geo.nearby_retreats(stmt, latitude, longitude, radius, limit)
+    fields = list(RETREAT_FIELDS)
+    rows = db.session.execute(db.select(*RETREAT_FIELDS.values()).where(Retreat.id.in_([retreat_id for retreat_id, distance in matches]))).all() if matches else []
+    retreats = {retreat['id']: retreat for retreat in retreat_rows(fields, rows)}
+    return {
+        'retreats': [{**retreats[retreat_id], 'distanceKm': round(distance, 3)} for retreat_id, distance in matches if retreat_id in retreats],
+        'radiusKm': radius
+    }
+
+@app.route('/retreats/<int:retreat_id>/similar', methods=['GET'])
+@http_cache.cached('retreats', 'similar')
+@replicas.read_only
+def get_similar_retreats(retreat_id):
+    # the retreats most often booked by the same people, as of the last `flask similar-retreats`
+    if db.session.scalar(db.select(Retreat.id).where(Retreat.id == retreat_id)) is None:
+        return {'error': f"Retreat with ID {retreat_id} not found"}, 404
+    limit = request.args.get('limit', 10, type=int)
+    limit = max(1, min(limit, TOP_K))
+    rows = db.session.execute(
+        db.select(*RETREAT_FIELDS.values(), SimilarRetreat.score, SimilarRetreat.co_bookings)
+        .join(SimilarRetreat, SimilarRetreat.similar_id == Retreat.id)
+        .where(SimilarRetreat.retreat_id == retreat_id)
+        .order_by(SimilarRetreat.rank)
+        .limit(limit)
+    ).all()
+    return {'retreats': retreat_rows(list(RETREAT_FIELDS) + ['score', 'coBookings'], rows)}
+
+# columns /retreats/search can sort by, each one is indexed
+RETREAT_SORTS = {
+    'id': Retreat.id,
+    'date': Retreat.date,
+    'cost': Retreat.cost_cents,
+    'duration': Retreat.duration_days
+}
+# the filters on each sort column, with one of them set no retreat without a value can match
+RETREAT_SORT_FILTERS = {
+    'date': ('dateFrom', 'dateTo'),
+    'cost': ('minCost', 'maxCost'),
+    'duration': ('minDays', 'maxDays')
+}
+
+
+def encode_cursor(value, retreat_id):
+    if isinstance(value, date):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, retreat_id]).encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    try:
+        value, retreat_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == 'date' and value is not None:
+            value = date.fromisoformat(value)
+        return value, int(retreat_id)
+    except (ValueError, TypeError):
+        raise ValueError('after is not a valid cursor')
+
+
+def keyset_page(stmt, sort_column, descending, cursor, limit, nulls=True):
+    # up to limit + 1 retreats after cursor ((sort value, id), or None for the first page), the ones
+    # without a sort value last either way. The keyset is (sort_column IS NULL, sort_column, id),
+    # run as the rows with a value and then, if the page isn't full, the NULL ones so both use the
+    # sort column's index. A cursor with a None value is in the NULL rows. nulls=False leaves those out.
+    if descending:
+        order, after = (sort_column.desc(), Retreat.id.desc()), lambda column, value: column < value
+    else:
+        order, after = (sort_column, Retreat.id), lambda column, value: column > value
+    retreats = []
+    if cursor is None or cursor[0] is not None:
+        page = stmt.where(sort_column.isnot(None))
+        if cursor is not None:
+            page = page.where(after(db.tuple_(sort_column, Retreat.id), db.tuple_(*cursor)))
+        retreats = db.session.execute(page.order_by(*order).limit(limit + 1)).scalars().all()
+    if nulls and len(retreats) <= limit:
+        page = stmt.where(sort_column.is_(None))
+        if cursor is not None and cursor[0] is None:
+            page = page.where(after(Retreat.id, cursor[1]))
+        retreats += db.session.execute(page.order_by(order[1]).limit(limit + 1 - len(retreats))).scalars().all()
+    return retreats
+
+
+def full_text_search(q, limit):
+    # ranked results are paged by offset, the cursor is the offset of the next page
+    after = request.args.get('after', '0')
+    if not after.isdigit():
+        return {'error': 'after is not a valid cursor'}, 400
+    offset = int(after)
+    ranked = get_search_backend().ranked(q)
+    try:
+        stmt = apply_retreat_filters(db.select(Retreat, ranked.c.rank).join(ranked, ranked.c.id == Retreat.id), request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    stmt = stmt.order_by(ranked.c.rank.desc(), Retreat.id).offset(offset).limit(limit + 1)
+    rows = db.session.execute(stmt).all()
+    next_cursor = str(offset + limit) if len(rows) > limit else None
+    retreats = []
+    for retreat, rank in rows[:limit]:
+        retreat_data = retreat.to_dict()
+        retreat_data['rank'] = rank
+        retreats.append(retreat_data)
+    return {'retreats': retreats, 'nextCursor': next_cursor}
+
+
+@app.route('/retreats/<int:retreat_id>/events', methods=['GET'])
+def get_retreat_events(retreat_id):
+    # Server-Sent Events with the retreat's seat counts, now and whenever they change (see app/events.py)
+    subscription = seat_events.subscribe(retreat_id, last_event_id=request.headers.get('Last-Event-ID'))
+    if subscription is None:
+        return {'error': 'Too many live streams open, try again later'}, 503, {'Retry-After': '5'}
+    row = db.session.execute(seat_events.state_query(retreat_id)).one_or_none()
+    if row is None:
+        subscription.close()
+        return {'error': f"Retreat with ID {retreat_id} not found"}, 404
+    seat_events.load(subscription, row)
+    # not stream_with_context, the database session goes back as soon as this returns
+    return Response(seat_events.stream(subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/retreats/search', methods=['GET'])
+@replicas.read_only
+def search_retreats():
+    # sort is a column name, with a - in front for descending (ex. ?sort=-cost)
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in RETREAT_SORTS:
+        return {'error': f"sort must be one of {', '.join(RETREAT_SORTS)}"}, 400
+    sort_column = RETREAT_SORTS[sort]
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+    # full text search, results come back best match first
+    if request.args.get('q', '').strip():
+        return full_text_search(request.args['q'], limit)
+
+    try:
+        stmt = apply_retreat_filters(db.select(Retreat), request.args)
+        cursor = None
+        if request.args.get('after'):
+            if sort == 'id':
+                if not request.args['after'].isdigit():
+                    raise ValueError('after must be a retreat id')
+                cursor = int(request.args['after'])
+            else:
+                cursor = decode_cursor(request.args['after'], sort)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    # keyset pagination so deep pages cost the same as the first one
+    if sort == 'id':
+        if cursor is not None:
+            stmt = stmt.where(Retreat.id < cursor if descending else Retreat.id > cursor)
+        stmt = stmt.order_by(Retreat.id.desc() if descending else Retreat.id)
+        retreats = db.session.execute(stmt.limit(limit + 1)).scalars().all()
+    else:
+        nulls = not any(request.args.get(name) for name in RETREAT_SORT_FILTERS[sort])
+        retreats = keyset_page(stmt, sort_column, descending, cursor, limit, nulls)
+
+    next_cursor = None
+    if len(retreats) > limit:
+        retreats = retreats[:limit]
+        last = retreats[-1]
+        next_cursor = str(last.id) if sort == 'id' else encode_cursor(getattr(last, sort_column.key), last.id)
+    return {'retreats': [retreat.to_dict() for retreat in retreats], 'nextCursor': next_cursor}
+
+@app.route('/retreats/bulk', methods=['POST'])
+@token_auth.login_required
+def bulk_import_retreats():
+    # the body is read as a stream, one retreat per NDJSON line or CSV row
+    if request.mimetype in ('application/x-ndjson', 'application/jsonlines'):
+        rows = bulk.read_ndjson(request.stream)
+    elif request.mimetype == 'text/csv':
+        rows = bulk.read_csv(request.stream)
+    else:
+        return {'error': 'Your content-type must be application/x-ndjson or text/csv'}, 400
+    user_id = token_auth.current_user().id
+    try:
+        inserted, error_count, errors = bulk.import_retreats(rows, user_id, app.config['BULK_BATCH_SIZE'])
+    except UnicodeDecodeError:
+        db.session.rollback()
+        return {'error': 'The request body must be UTF-8'}, 400
+    return {'inserted': inserted, 'errorCount': error_count, 'errors': errors}, 201 if inserted else 400
+
+@app.route('/retreats/bulk', methods=['GET'])
+@replicas.read_only
+def bulk_export_retreats():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return {'error': 'format must be ndjson or csv'}, 400
+    try:
+        stmt = apply_retreat_filters(db.select(*[RETREAT_FIELDS[field] for field in bulk.EXPORT_FIELDS]), request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    def generate():
+        result = db.session.execute(stmt.order_by(Retreat.id).execution_options(yield_per=app.config['STREAM_CHUNK_SIZE']))
+        if export_format == 'csv':
+            yield from bulk.export_csv(result)
+        else:
+            yield from bulk.export_ndjson(result)
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
 
 #edit
 @app.route('/retreats/<int:retreat_id>', methods=['PUT'])
@@ -164,6 +566,13 @@ def edit_retreat(retreat_id):
     if retreat.author is not current_user:
         return {'error':'this is not your retreat'}, 403
     data = request.json
+    try:
+        if 'date' in data:
+            data['date'] = parse_retreat_date(data['date'])
+        if 'latitude' in data or 'longitude' in data:
+            data['latitude'], data['longitude'] = geo.parse_coordinates(data.get('latitude'), data.get('longitude'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
     retreat.update(**data)
     return retreat.to_dict()
 
@@ -179,11 +588,11 @@ def delete_retreat(retreat_id):
     # get the logged in user token
     current_user = token_auth.current_user()
     # check to make sure the logged in user is post author
-    if retreat.author is not current_user:
+    if retreat.user_id != current_user.id:
         return {"error":"You can do that, this sint your post! Get outta here!"}, 403
-    # delete post
+    # delete post, its bookings go with it in the database (ON DELETE CASCADE)
     retreat.delete()
-    return {"success":f"{retreat.title} has been deleted!"}
+    return {"success":f"{retreat.name} has been deleted!"}
 
 
 
@@ -191,34 +600,103 @@ def delete_retreat(retreat_id):
 #BOOKINGS
 @app.route('/bookings', methods=['GET'])
 @token_auth.login_required
+@replicas.read_only
 def get_user_bookings():
-    user_id = token_auth.current_user().id
-    bookings = Booking.query.filter_by(user_id=user_id).all()
-    bookings_data = [{'id': booking.id, 'retreat_id': booking.retreat_id} for booking in bookings]
-    return {'bookings': bookings_data}
+    try:
+        stmt, limit = bookings_query_from_args(token_auth.current_user().id)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    bookings = db.session.execute(stmt).scalars().all()
+    return bookings_page(bookings, limit)
+
+
+def bookings_query_from_args(user_id):
+    # the select for a page of GET /bookings, returns (statement, limit), also used by app/asgi.py
+    after = request.args.get('after')
+    if after is not None and not after.isdigit():
+        raise ValueError('after must be a booking id')
+    limit = page_limit()
+    stmt = db.select(Booking).where(Booking.user_id == user_id)
+    if after is not None:
+        stmt = stmt.where(Booking.id > int(after))
+    # ?expand=retreat sends each booking's retreat along with it, loaded in the same query
+    if request.args.get('expand') == 'retreat':
+        stmt = stmt.options(joinedload(Booking.retreat))
+    return stmt.order_by(Booking.id).limit(limit + 1), limit
+
+
+def bookings_page(bookings, limit):
+    # the GET /bookings response for up to limit + 1 bookings
+    expand_retreat = request.args.get('expand') == 'retreat'
+    next_cursor = None
+    if len(bookings) > limit:
+        bookings = bookings[:limit]
+        next_cursor = str(bookings[-1].id)
+    bookings_data = []
+    for booking in bookings:
+        booking_data = {'id': booking.id, 'retreat_id': booking.retreat_id}
+        if expand_retreat:
+            booking_data['retreat'] = booking.retreat.to_dict()
+        bookings_data.append(booking_data)
+    return {'bookings': bookings_data, 'nextCursor': next_cursor}
 
 @app.route('/retreats/book/<int:retreat_id>', methods=['POST'])
 @token_auth.login_required
+@rate_limiter.limit('RATE_LIMIT_BOOKING_PER_USER', per='user')
 def book_retreat(retreat_id):
-    retreat = Retreat.query.get(retreat_id)
+    user_id = token_auth.current_user().id
+    # a retried request with the same Idempotency-Key gets the response the first one got
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        if len(idempotency_key) > 255:
+            return {'error': 'Idempotency-Key must be 255 characters or less'}, 400
+        saved = IdempotencyKey.query.filter_by(user_id=user_id, key=idempotency_key).first()
+        if saved:
+            return json.loads(saved.response), saved.status_code
+
+    retreat = db.session.get(Retreat, retreat_id)
     if not retreat:
         return {'error': f'Retreat with ID {retreat_id} not found'}, 404
-    # Check if the user has already booked the retreat
-    existing_booking = Booking.query.filter_by(user_id=current_user.id, retreat_id=retreat.id).first()
-    if existing_booking:
-        return {'message': f'You have already booked the retreat: {retreat.name}'}
 
-    new_booking = Booking(user_id=current_user.id, retreat_id=retreat.id)
-    db.session.add(new_booking)
-    db.session.commit()
+    # the seat and the booking go in one transaction, the unique constraint on booking catches a second booking
+    already_booked = {'error': f'You have already booked the retreat: {retreat.name}'}, 409
+    if Retreat.reserve_seat(retreat.id):
+        new_booking = Booking(user_id=user_id, retreat_id=retreat.id)
+        db.session.add(new_booking)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            response, status_code = already_booked
+        else:
+            response, status_code = {'message': f'You have booked the retreat: {retreat.name}', 'bookingId': new_booking.id}, 200
+    else:
+        db.session.rollback()
+        if Booking.query.filter_by(user_id=user_id, retreat_id=retreat.id).first():
+            response, status_code = already_booked
+        else:
+            response, status_code = {'error': f'The retreat {retreat.name} is fully booked'}, 409
 
-    return {'message': f'You have booked the retreat: {retreat.name}'}
+    if idempotency_key:
+        db.session.add(IdempotencyKey(user_id=user_id, key=idempotency_key, status_code=status_code, response=json.dumps(response)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if idempotency_key:
+            # the same key came in twice at once and the other request won, send back its response
+            saved = IdempotencyKey.query.filter_by(user_id=user_id, key=idempotency_key).first()
+            if saved:
+                return json.loads(saved.response), saved.status_code
+        # the same booking came in twice at once and the other one was committed first
+        return already_booked
+    return response, status_code
 
 @app.route('/bookings/<int:booking_id>', methods=['DELETE'])
 @token_auth.login_required
 def delete_booking(booking_id):
     # Check if the booking exists
-    booking = Booking.query.get(booking_id)
+    booking = db.session.get(Booking, booking_id)
     if not booking:
         return {'error': f'Booking with ID {booking_id} not found'}, 404
 
@@ -226,14 +704,126 @@ def delete_booking(booking_id):
     if booking.user_id != token_auth.current_user().id:
         return {'error': 'You are not authorized to delete this booking'}, 403
 
-    # Delete from the database
+    # Delete from the database and give the seat back
     db.session.delete(booking)
+    Retreat.release_seat(booking.retreat_id)
     db.session.commit()
 
     return {'message': 'Booking deleted successfully'}
 
 
+# STATS
+# read from the stat_rollup table (see app/stats.py), never from retreat or booking
+STAT_KEYS = {'location': 'location', 'month': 'month', 'organizer': 'userId'}
 
-    
 
+def stat_dict(dimension, bucket, retreats, bookings):
+    bucket = bucket or None
+    if dimension == 'organizer' and bucket is not None:
+        bucket = int(bucket)
+    return {STAT_KEYS[dimension]: bucket, 'retreats': retreats, 'bookings': bookings}
+
+
+@app.route('/stats')
+@replicas.read_only
+def get_stats():
+    # the totals add up the location rows, so there is no one row that every booking has to update
+    retreats, bookings = db.session.execute(
+        db.select(func.coalesce(func.sum(StatRollup.retreats), 0), func.coalesce(func.sum(StatRollup.bookings), 0))
+        .where(StatRollup.dimension == 'location')
+    ).one()
+    return {'retreats': retreats, 'bookings': bookings, 'dimensions': list(DIMENSIONS)}
+
+@app.route('/stats/<dimension>')
+@replicas.read_only
+def get_stats_by(dimension):
+    if dimension not in DIMENSIONS:
+        return {'error': f"dimension must be one of {', '.join(DIMENSIONS)}"}, 404
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    stmt = (db.select(StatRollup.bucket, StatRollup.retreats, StatRollup.bookings)
+            .where(StatRollup.dimension == dimension)
+            .where((StatRollup.retreats != 0) | (StatRollup.bookings != 0)))
+    # the cursor is the last bucket sent, buckets are ordered as text so organizer ids go 1, 10, 2
+    if request.args.get('after') is not None:
+        stmt = stmt.where(StatRollup.bucket > request.args['after'])
+    rows = db.session.execute(stmt.order_by(StatRollup.bucket).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].bucket if len(rows) > limit else None
+    return {'stats': [stat_dict(dimension, *row) for row in rows[:limit]], 'nextCursor': next_cursor}
+
+@app.route('/stats/<dimension>/<path:bucket>')
+@replicas.read_only
+def get_stat(dimension, bucket):
+    if dimension not in DIMENSIONS:
+        return {'error': f"dimension must be one of {', '.join(DIMENSIONS)}"}, 404
+    if dimension == 'organizer' and not bucket.isdigit():
+        return {'error': 'organizer must be a user id'}, 400
+    stat = db.session.get(StatRollup, (dimension, bucket))
+    if stat is None:
+        return stat_dict(dimension, bucket, 0, 0)
+    return stat_dict(dimension, stat.bucket, stat.retreats, stat.bookings)
+
+
+# BATCH
+@app.route('/batch', methods=['POST'])
+@token_auth.login_required
+@replicas.read_only
+def run_batch():
+    # {"requests": [{"method": "GET", "path": "/retreats/1", "headers": {...}}, ...]}, answered in the same order
+    if not request.is_json:
+        return {'error': 'Your content-type must be application/json'}, 400
+    try:
+        items = batch.parse_items(request.get_json(silent=True), app.config['BATCH_MAX_REQUESTS'])
+    except ValueError as error:
+        return {'error': str(error)}, 400
+    return {'responses': batch.run_batch(items, token_auth.current_user())}
+
+
+# INTERNAL ENDPOINTS
+@app.route('/_internal/token-cache')
+def get_token_cache_stats():
+    if not app.config['INTERNAL_ENDPOINTS']:
+        return {'error': 'Not found'}, 404
+    return token_cache.stats()
+
+@app.route('/_internal/pool')
+def get_pool_stats():
+    if not app.config['INTERNAL_ENDPOINTS']:
+        return {'error': 'Not found'}, 404
+    stats = pool_stats(db.engine)
+    if replicas.enabled:
+        stats['replica'] = pool_stats(db.engines['replica'])
+    return stats
+
+@app.route('/_internal/rate-limits')
+def get_rate_limit_stats():
+    if not app.config['INTERNAL_ENDPOINTS']:
+        return {'error': 'Not found'}, 404
+    return rate_limiter.stats()
+
+@app.route('/_internal/seat-events')
+def get_seat_event_stats():
+    if not app.config['INTERNAL_ENDPOINTS']:
+        return {'error': 'Not found'}, 404
+    return seat_events.stats()
 
+# prometheus text format
+@app.route('/_metrics')
+def get_metrics():
+    if not app.config['INTERNAL_ENDPOINTS']:
+        return {'error': 'Not found'}, 404
+    lines = sql_profiler.prometheus_lines() if sql_profiler is not None else []
+    cache_stats = token_cache.stats()
+    lines += gauge_lines('app_token_cache_hits_total', 'Token cache hits', cache_stats['hits'], 'counter')
+    lines += gauge_lines('app_token_cache_misses_total', 'Token cache misses', cache_stats['misses'], 'counter')
+    lines += gauge_lines('app_rate_limited_total', 'Requests turned away with a 429 by a rate limit', rate_limiter.limited, 'counter')
+    lines += gauge_lines('app_shed_total', 'Requests turned away with a 503 for waiting too long', rate_limiter.shed, 'counter')
+    lines += gauge_lines('app_seat_event_subscribers', 'Open GET /retreats/<id>/events streams', seat_events.stats()['subscribers'])
+    stats = pool_stats(db.engine)
+    if 'checkedOut' in stats:
+        lines += gauge_lines('app_db_pool_checked_out', 'Connections in use', stats['checkedOut'])
+        lines += gauge_lines('app_db_pool_overflow', 'Connections open past pool_size', stats['overflow'])
+    if 'waitSecondsTotal' in stats:
+        lines += gauge_lines('app_db_pool_wait_seconds_total', 'Time spent waiting for a connection', stats['waitSecondsTotal'], 'counter')
+        lines += gauge_lines('app_db_pool_timeouts_total', 'Connection waits that timed out', stats['timeouts'], 'counter')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,145 @@
+from abc import ABC, abstractmethod
+import click
+from sqlalchemy import event
+from app import app, db
+from app.models import Retreat
+
+
+# Full text search over retreat name, location and description.
+# Postgres uses a GIN index on a tsvector expression and SQLite uses an FTS5 table kept up to
+# date by triggers, so the index changes in the same transaction as Retreat.save()/delete().
+# Any other database falls back to LIKE, which works but scans the table.
+# The migrations create the index, and so does db.create_all() (tests, a new development
+# database) through the retreat table's DDL events. flask search-index is for a database that
+# has neither.
+
+# must match the expression the GIN index in the migration was built on, or postgres won't use it
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(location, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+)
+
+SQLITE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS retreat_fts USING fts5("
+    "name, location, description, content='retreat', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_insert AFTER INSERT ON retreat BEGIN "
+    "INSERT INTO retreat_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_delete AFTER DELETE ON retreat BEGIN "
+    "INSERT INTO retreat_fts(retreat_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_update AFTER UPDATE OF name, location, description ON retreat BEGIN "
+    "INSERT INTO retreat_fts(retreat_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); "
+    "INSERT INTO retreat_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+]
+
+
+class SearchBackend(ABC):
+    name = None
+
+    @abstractmethod
+    def ranked(self, q):
+        # returns a subquery with the columns (id, rank) for the retreats matching q, higher rank is better
+        pass
+
+    def create_index(self, connection):
+        pass
+
+    def drop_index(self, connection):
+        pass
+
+    def rebuild_index(self, connection):
+        pass
+
+
+class PostgresSearch(SearchBackend):
+    name = 'postgres'
+
+    def ranked(self, q):
+        document = db.literal_column(f"({POSTGRES_DOCUMENT})")
+        query = db.func.websearch_to_tsquery('english', q)
+        return db.select(
+            Retreat.id.label('id'),
+            db.func.ts_rank(document, query).label('rank')
+        ).where(document.op('@@')(query)).subquery()
+
+    def create_index(self, connection):
+        connection.execute(db.text(f"CREATE INDEX IF NOT EXISTS ix_retreat_search ON retreat USING gin (({POSTGRES_DOCUMENT}))"))
+
+
+class SqliteSearch(SearchBackend):
+    name = 'sqlite'
+    # bm25 weights for the name, location and description columns
+    weights = (10.0, 5.0, 1.0)
+
+    def ranked(self, q):
+        # quote every word so user input can't be read as FTS5 query syntax
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in q.split())
+        fts = db.table('retreat_fts', db.column('rowid'))
+        # bm25() is lower for better matches so it is flipped to match the other backends
+        rank = -db.func.bm25(db.literal_column('retreat_fts'), *self.weights)
+        return db.select(
+            fts.c.rowid.label('id'),
+            rank.label('rank')
+        ).where(db.literal_column('retreat_fts').op('MATCH')(match)).subquery()
+
+    def create_index(self, connection):
+        for statement in SQLITE_STATEMENTS:
+            connection.execute(db.text(statement))
+
+    def drop_index(self, connection):
+        # the triggers go with the retreat table, the FTS table would be left behind with the old rows in it
+        connection.execute(db.text("DROP TABLE IF EXISTS retreat_fts"))
+
+    def rebuild_index(self, connection):
+        connection.execute(db.text("INSERT INTO retreat_fts(retreat_fts) VALUES ('rebuild')"))
+
+
+class LikeSearch(SearchBackend):
+    name = 'like'
+
+    def ranked(self, q):
+        stmt = db.select(Retreat.id.label('id'), db.literal(0).label('rank'))
+        for word in q.split():
+            pattern = f"%{word}%"
+            stmt = stmt.where(
+                Retreat.name.ilike(pattern) | Retreat.location.ilike(pattern) | Retreat.description.ilike(pattern)
+            )
+        return stmt.subquery()
+
+
+SEARCH_BACKENDS = {backend.name: backend for backend in (PostgresSearch, SqliteSearch, LikeSearch)}
+
+
+def get_search_backend(dialect=None):
+    # SEARCH_BACKEND in the config picks one, otherwise it goes off the database in use
+    name = app.config.get('SEARCH_BACKEND')
+    if not name:
+        dialect = dialect or db.engine.dialect.name
+        name = {'postgresql': 'postgres', 'sqlite': 'sqlite'}.get(dialect, 'like')
+    return SEARCH_BACKENDS[name]()
+
+
+@event.listens_for(Retreat.__table__, 'after_create')
+def create_search_index(table, connection, **kwargs):
+    get_search_backend(connection.dialect.name).create_index(connection)
+
+
+@event.listens_for(Retreat.__table__, 'before_drop')
+def drop_search_index(table, connection, **kwargs):
+    get_search_backend(connection.dialect.name).drop_index(connection)
+
+
+@app.cli.command('search-index')
+@click.option('--rebuild', is_flag=True, help='Reindex every retreat, not just create the index.')
+def search_index(rebuild):
+    """Create the full text search index for the configured backend."""
+    backend = get_search_backend()
+    with db.engine.begin() as connection:
+        backend.create_index(connection)
+        if rebuild:
+            backend.rebuild_index(connection)
+    click.echo(f"Search index ready ({backend.name})")
@@ -0,0 +1,266 @@
+import time
+from itertools import chain
+import click
+from sqlalchemy import event, func
+from app import app, db, http_cache
+from app.models import Retreat, Booking, SimilarRetreat, SimilarityState
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# "People who booked this also booked", served by /retreats/<id>/similar from the similar_retreat table.
+# `flask similar-retreats` builds it offline from the booking table. Two retreats are similar when
+# the same users booked them. The score is the cosine similarity of their sets of users:
+# co-bookings / sqrt(bookings of one * bookings of the other). The top TOP_K are kept per retreat.
+#
+# The counting is done with numpy on the bookings as two integer arrays. The retreat x retreat
+# matrix is never built: targets are taken in batches of at most MAX_PAIRS (retreat, user,
+# retreat) paths, which are counted with numpy.unique, so memory stays flat however many retreats
+# there are.
+#
+# After the first build only what new and cancelled bookings touched is rebuilt. Changed retreats are
+# found by comparing each retreat's (bookings, highest booking id, version) with similarity_state, and
+# their rows are counted again from the bookings of their users. Every way a booking is made or
+# deleted also puts its retreat's version up, so a cancel and a new booking that happen to get the
+# same id (SQLite reuses the highest rowid) still change it. Every other retreat's scores against them are
+# swapped into its stored row, and the few rows where that could let in a retreat that was never
+# stored are counted again too. --full rebuilds everything.
+
+TOP_K = 20
+MAX_PAIRS = 5000000
+# someone who booked this many retreats says little about any two of them, and costs the square in pairs
+MAX_USER_BOOKINGS = 1000
+CHUNK_SIZE = 500
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = sorted(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def booking_fingerprints(connection):
+    # {retreat id: (bookings, highest booking id, version)} of the retreats with bookings
+    stmt = (
+        db.select(Booking.retreat_id, func.count(), func.max(Booking.id), Retreat.version)
+        .join(Retreat, Retreat.id == Booking.retreat_id)
+        .group_by(Booking.retreat_id, Retreat.version)
+    )
+    return {retreat_id: (count, max_id, version) for retreat_id, count, max_id, version in connection.execute(stmt)}
+
+
+def load_bookings(connection, stmts):
+    # (user ids, retreat ids) arrays of the (user_id, retreat_id) rows the statements select, without duplicates
+    parts = [numpy.empty((0, 2), dtype=numpy.int64)]
+    for stmt in stmts:
+        for rows in connection.execute(stmt.execution_options(yield_per=100000)).partitions():
+            # from a flat iterator, numpy.array() on Row objects probes each one for array attributes
+            parts.append(numpy.fromiter(chain.from_iterable(rows), dtype=numpy.int64, count=2 * len(rows)).reshape(-1, 2))
+    pairs = numpy.concatenate(parts)
+    if len(stmts) > 1:
+        pairs = numpy.unique(pairs, axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def _ragged(ptr, rows):
+    # (which of rows, position) of every value in those rows of a CSR style (ptr, values) layout
+    lengths = ptr[rows + 1] - ptr[rows]
+    owners = numpy.repeat(numpy.arange(len(rows)), lengths)
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    return owners, ptr[rows][owners] + offsets
+
+
+def _rank(owners, others, scores, co_bookings, k):
+    # best first within each owner, ties go to the lower id, and the first k of each (all of them if k is None)
+    order = numpy.lexsort((others, -scores, owners))
+    owners, others, scores, co_bookings = owners[order], others[order], scores[order], co_bookings[order]
+    ranks = numpy.arange(len(owners)) - numpy.searchsorted(owners, owners) + 1
+    top = ranks <= k if k is not None else slice(None)
+    return owners[top], ranks[top], others[top], scores[top], co_bookings[top]
+
+
+def top_similar(users, retreats, counts, targets, k=TOP_K, max_pairs=MAX_PAIRS, max_user_bookings=MAX_USER_BOOKINGS):
+    """Yields (retreat ids, ranks, similar retreat ids, scores, co-bookings) arrays, a batch of targets at a time.
+
+    users and retreats are the bookings, they must hold every booking of the users who booked a target.
+    counts maps retreat ids to their number of bookings. At most k rows are given per target retreat.
+    """
+    retreat_ids, retreat_index = numpy.unique(retreats, return_inverse=True)
+    user_ids, user_index = numpy.unique(users, return_inverse=True)
+    # the bookings loaded can be fewer than counts says when the job only loaded some users
+    bookings = numpy.maximum(
+        numpy.fromiter((counts.get(int(retreat_id), 0) for retreat_id in retreat_ids), dtype=float, count=len(retreat_ids)),
+        numpy.bincount(retreat_index, minlength=len(retreat_ids))
+    )
+    keep = numpy.bincount(user_index)[user_index] <= max_user_bookings
+    user_index, retreat_index = user_index[keep], retreat_index[keep]
+    user_degree = numpy.bincount(user_index, minlength=len(user_ids))
+
+    # the bookings both ways round: each user's retreats and each retreat's users
+    user_ptr = numpy.concatenate(([0], numpy.cumsum(user_degree)))
+    user_retreats = retreat_index[numpy.argsort(user_index, kind='stable')]
+    retreat_ptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(retreat_index, minlength=len(retreat_ids)))))
+    retreat_users = user_index[numpy.argsort(retreat_index, kind='stable')]
+
+    targets = numpy.flatnonzero(numpy.isin(retreat_ids, numpy.fromiter(targets, dtype=numpy.int64)))
+    # paths each target has to count, batches hold about max_pairs of them
+    work = numpy.bincount(retreat_index, weights=user_degree[user_index], minlength=len(retreat_ids))[targets]
+    batch_numbers = (numpy.cumsum(work) - work) // max_pairs
+    for batch in numpy.split(targets, numpy.flatnonzero(numpy.diff(batch_numbers)) + 1):
+        if not len(batch):
+            continue
+        owners, positions = _ragged(retreat_ptr, batch)
+        path_owners, positions = _ragged(user_ptr, retreat_users[positions])
+        path_owners = owners[path_owners]
+        others = user_retreats[positions]
+        not_itself = others != batch[path_owners]
+        keys, co_bookings = numpy.unique(
+            path_owners[not_itself].astype(numpy.int64) * len(retreat_ids) + others[not_itself], return_counts=True
+        )
+        owners, others = numpy.divmod(keys, len(retreat_ids))
+        scores = co_bookings / numpy.sqrt(bookings[batch[owners]] * bookings[others])
+        # retreat_ids is sorted, so ordering by index is ordering by id
+        owners, ranks, others, scores, co_bookings = _rank(batch[owners], others, scores, co_bookings, k)
+        yield retreat_ids[owners], ranks, retreat_ids[others], scores, co_bookings
+
+
+ROW_DTYPES = (numpy.int64, numpy.int64, numpy.int64, float, numpy.int64) if numpy else ()
+
+
+def _concatenate(batches):
+    # the batches top_similar yields as one set of columns
+    batches = list(batches)
+    return [numpy.concatenate([numpy.empty(0, dtype=dtype)] + [batch[column] for batch in batches]).astype(dtype)
+            for column, dtype in enumerate(ROW_DTYPES)]
+
+
+def _write_rows(connection, rows):
+    retreat_ids, ranks, similar_ids, scores, co_bookings = rows
+    if len(retreat_ids):
+        connection.execute(db.insert(SimilarRetreat), [
+            {'retreat_id': retreat_id, 'rank': rank, 'similar_id': similar_id, 'score': score, 'co_bookings': co}
+            for retreat_id, rank, similar_id, score, co in zip(
+                retreat_ids.tolist(), ranks.tolist(), similar_ids.tolist(), scores.tolist(), co_bookings.tolist())
+        ])
+    return len(retreat_ids)
+
+
+def _kth(owners, ranks, others, scores, k):
+    # {owner: (-score, similar id)} of each owner's kth row, the sort key of the last row it keeps
+    kth = ranks == k
+    return dict(zip(owners[kth].tolist(), zip((-scores[kth]).tolist(), others[kth].tolist())))
+
+
+def _bookings_of_users_of(connection, retreat_ids):
+    # every booking of the users who booked one of retreat_ids
+    return load_bookings(connection, [
+        db.select(Booking.user_id, Booking.retreat_id)
+        .where(Booking.user_id.in_(db.select(Booking.user_id).where(Booking.retreat_id.in_(chunk))))
+        for chunk in _chunks(retreat_ids)
+    ])
+
+
+def _rebuild_changed(connection, changed, counts, k):
+    # rows of the changed retreats counted again, every row they appear in (or now should) updated
+    users, retreats = _bookings_of_users_of(connection, changed)
+    pairs = _concatenate(top_similar(users, retreats, counts, changed, None))
+    changed_ids = numpy.fromiter(changed, dtype=numpy.int64)
+    changed_rows = [column[pairs[1] <= k] for column in pairs]
+
+    # the others keep their rows, with their scores against the changed retreats replaced by the new ones
+    reverse = ~numpy.isin(pairs[2], changed_ids)
+    fresh = [pairs[2][reverse], pairs[0][reverse], pairs[3][reverse], pairs[4][reverse]]
+    neighbours = set(fresh[0].tolist())
+    for chunk in _chunks(changed):
+        neighbours.update(connection.execute(db.select(SimilarRetreat.retreat_id).where(SimilarRetreat.similar_id.in_(chunk))).scalars())
+    neighbours -= changed
+    columns = (SimilarRetreat.retreat_id, SimilarRetreat.similar_id, SimilarRetreat.score, SimilarRetreat.co_bookings)
+    stored = numpy.fromiter(chain.from_iterable(chain.from_iterable(
+        connection.execute(db.select(*columns).where(SimilarRetreat.retreat_id.in_(chunk))) for chunk in _chunks(neighbours)
+    )), dtype=float).reshape(-1, 4)
+    stored = [stored[:, index].astype(dtype) for index, dtype in enumerate(ROW_DTYPES[:1] + ROW_DTYPES[2:])]
+    unchanged = ~numpy.isin(stored[1], changed_ids)
+    owners, ranks, others, scores, co_bookings = _rank(*[numpy.concatenate((old[unchanged], new)) for old, new in zip(stored, fresh)], k)
+    # only rows that had a changed retreat in them or have one now are written
+    touched = numpy.union1d(stored[0][~unchanged], owners[numpy.isin(others, changed_ids)])
+
+    # the retreats that didn't make a full row were never stored, they all rank below its old kth row.
+    # a row that now ends above that is right, one that ends below it (a changed retreat fell or left)
+    # may be missing one of them and is counted again
+    cutoffs = _kth(*_rank(*stored, k)[:4], k)
+    kth = _kth(owners, ranks, others, scores, k)
+    recount = {owner for owner in touched.tolist() if owner in cutoffs and (owner not in kth or kth[owner] > cutoffs[owner])}
+    rewrite = numpy.isin(owners, touched) & ~numpy.isin(owners, numpy.fromiter(recount, dtype=numpy.int64))
+    neighbour_rows = [owners[rewrite], ranks[rewrite], others[rewrite], scores[rewrite], co_bookings[rewrite]]
+    if recount:
+        users, retreats = _bookings_of_users_of(connection, recount)
+        recounted = _concatenate(top_similar(users, retreats, counts, recount, k))
+        neighbour_rows = [numpy.concatenate(columns) for columns in zip(neighbour_rows, recounted)]
+
+    for chunk in _chunks(changed | set(touched.tolist())):
+        connection.execute(db.delete(SimilarRetreat).where(SimilarRetreat.retreat_id.in_(chunk)))
+    return len(changed) + len(touched), _write_rows(connection, changed_rows) + _write_rows(connection, neighbour_rows)
+
+
+def build_similar(connection, full=False, k=TOP_K):
+    """Rebuilds the similar retreats of the retreats whose bookings changed since the last build.
+
+    Returns (retreats rebuilt, rows written).
+    """
+    current = booking_fingerprints(connection)
+    previous = {row.retreat_id: (row.bookings, row.max_booking_id, row.retreat_version)
+                for row in connection.execute(db.select(SimilarityState))}
+    changed = {retreat_id for retreat_id in current.keys() | previous.keys() if current.get(retreat_id) != previous.get(retreat_id)}
+    if not full and not changed:
+        return 0, 0
+    counts = {retreat_id: fingerprint[0] for retreat_id, fingerprint in current.items()}
+    # past a quarter of the catalogue one full read is cheaper than all the IN lists
+    if full or len(changed) > len(current) / 4:
+        users, retreats = load_bookings(connection, [db.select(Booking.user_id, Booking.retreat_id)])
+        connection.execute(db.delete(SimilarRetreat))
+        connection.execute(db.delete(SimilarityState))
+        written = sum(_write_rows(connection, rows) for rows in top_similar(users, retreats, counts, current.keys(), k))
+        rebuilt, changed = len(current), current.keys()
+    else:
+        rebuilt, written = _rebuild_changed(connection, changed, counts, k)
+        for chunk in _chunks(changed):
+            connection.execute(db.delete(SimilarityState).where(SimilarityState.retreat_id.in_(chunk)))
+
+    states = [dict(zip(('retreat_id', 'bookings', 'max_booking_id', 'retreat_version'), (retreat_id, *current[retreat_id])))
+              for retreat_id in changed if retreat_id in current]
+    if states:
+        connection.execute(db.insert(SimilarityState), states)
+    return rebuilt, written
+
+
+def retreat_deleted(mapper, connection, retreat):
+    # similar_retreat has no foreign keys, and SQLite can give the next retreat the same id: its rows and
+    # the rows it is in go now. The retreats that listed it lose their state so the next build counts them again.
+    listed_by = db.select(SimilarRetreat.retreat_id).where(SimilarRetreat.similar_id == retreat.id)
+    connection.execute(db.delete(SimilarityState).where(
+        (SimilarityState.retreat_id == retreat.id) | SimilarityState.retreat_id.in_(listed_by)
+    ))
+    connection.execute(db.delete(SimilarRetreat).where(
+        (SimilarRetreat.retreat_id == retreat.id) | (SimilarRetreat.similar_id == retreat.id)
+    ))
+
+
+event.listen(Retreat, 'before_delete', retreat_deleted)
+
+
+@app.cli.command('similar-retreats')
+@click.option('--full', is_flag=True, help='Rebuild every retreat, not just the ones whose bookings changed.')
+@click.option('--top', default=TOP_K, help='Similar retreats kept per retreat.')
+def similar_retreats(full, top):
+    """Build the /retreats/<id>/similar table from bookings."""
+    if numpy is None:
+        raise click.ClickException('numpy must be installed to build similar retreats')
+    started = time.perf_counter()
+    rebuilt, written = build_similar(db.session.connection(), full, top)
+    if rebuilt:
+        http_cache.invalidate(db.session, 'similar')
+    db.session.commit()
+    click.echo(f"Rebuilt {rebuilt} retreats, {written} similar retreats in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,145 @@
+from collections import defaultdict
+import click
+from sqlalchemy import event, func
+from app import app, db
+from app.models import Retreat, Booking, StatRollup
+
+
+# Rollups behind /stats: retreat and booking counts per location, month and organizer.
+# Every write changes the stat_rollup rows it affects in the same transaction, so /stats only
+# ever reads a handful of rows however big retreat and booking get:
+#   - ORM inserts, updates and deletes of Retreat and Booking through the mapper events below
+#   - bulk imports (app.bulk) and partner syncs (app.sync) through StatDeltas directly
+# A retreat's bookings are counted under its location, month and organizer, and move with it
+# when one of those changes. `flask stats-rebuild` recounts everything from scratch.
+
+DIMENSIONS = ('location', 'month', 'organizer')
+
+
+def buckets(location, retreat_date, user_id):
+    return (
+        ('location', location or ''),
+        ('month', retreat_date.strftime('%Y-%m') if retreat_date else ''),
+        ('organizer', str(user_id) if user_id is not None else ''),
+    )
+
+
+def upsert_statement(dialect):
+    # adds to the counts already in the row, or inserts it
+    table = StatRollup.__table__
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(
+            retreats=table.c.retreats + stmt.inserted.retreats,
+            bookings=table.c.bookings + stmt.inserted.bookings
+        )
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.dimension, table.c.bucket],
+        set_={'retreats': table.c.retreats + stmt.excluded.retreats, 'bookings': table.c.bookings + stmt.excluded.bookings}
+    )
+
+
+class StatDeltas:
+    """Changes to the rollup rows, collected and then written in one statement."""
+
+    def __init__(self):
+        self.changes = defaultdict(lambda: [0, 0])
+
+    def add(self, location, retreat_date, user_id, retreats=0, bookings=0):
+        for key in buckets(location, retreat_date, user_id):
+            change = self.changes[key]
+            change[0] += retreats
+            change[1] += bookings
+
+    def apply(self, connection):
+        # sorted so concurrent transactions lock the rows in the same order
+        rows = [{'dimension': dimension, 'bucket': bucket, 'retreats': retreats, 'bookings': bookings}
+                for (dimension, bucket), (retreats, bookings) in sorted(self.changes.items()) if retreats or bookings]
+        if rows:
+            connection.execute(upsert_statement(connection.dialect.name), rows)
+        self.changes.clear()
+
+
+def rebuild_stats(connection):
+    deltas = StatDeltas()
+    columns = (Retreat.location, Retreat.date, Retreat.user_id)
+    for location, retreat_date, user_id, count in connection.execute(db.select(*columns, func.count()).group_by(*columns)):
+        deltas.add(location, retreat_date, user_id, retreats=count)
+    bookings = db.select(*columns, func.count(Booking.id)).join(Booking, Booking.retreat_id == Retreat.id).group_by(*columns)
+    for location, retreat_date, user_id, count in connection.execute(bookings):
+        deltas.add(location, retreat_date, user_id, bookings=count)
+    connection.execute(db.delete(StatRollup))
+    deltas.apply(connection)
+
+
+# MAPPER EVENTS
+TRACKED_COLUMNS = ('location', 'date', 'user_id', 'seats_booked')
+
+
+def retreat_values(retreat):
+    # (old, new) values of TRACKED_COLUMNS in the flush under way
+    state = db.inspect(retreat)
+    old, new = [], []
+    for column in TRACKED_COLUMNS:
+        history = state.attrs[column].history
+        current = history.added[0] if history.added else (history.unchanged[0] if history.unchanged else None)
+        new.append(current)
+        old.append(history.deleted[0] if history.deleted else current)
+    return old, new
+
+
+def retreat_inserted(mapper, connection, retreat):
+    deltas = StatDeltas()
+    deltas.add(retreat.location, retreat.date, retreat.user_id, retreats=1, bookings=retreat.seats_booked or 0)
+    deltas.apply(connection)
+
+
+def retreat_updated(mapper, connection, retreat):
+    old, new = retreat_values(retreat)
+    if old[:3] == new[:3]:
+        return
+    deltas = StatDeltas()
+    deltas.add(*old[:3], retreats=-1, bookings=-(old[3] or 0))
+    deltas.add(*new[:3], retreats=1, bookings=old[3] or 0)
+    deltas.apply(connection)
+
+
+def retreat_deleted(mapper, connection, retreat):
+    deltas = StatDeltas()
+    deltas.add(retreat.location, retreat.date, retreat.user_id, retreats=-1, bookings=-(retreat.seats_booked or 0))
+    deltas.apply(connection)
+
+
+def booking_changed(bookings):
+    def listener(mapper, connection, booking):
+        retreat = connection.execute(
+            db.select(Retreat.location, Retreat.date, Retreat.user_id).where(Retreat.id == booking.retreat_id)
+        ).first()
+        if retreat is not None:
+            deltas = StatDeltas()
+            deltas.add(*retreat, bookings=bookings)
+            deltas.apply(connection)
+    return listener
+
+
+event.listen(Retreat, 'after_insert', retreat_inserted)
+event.listen(Retreat, 'after_update', retreat_updated)
+# before_delete so expired columns can still be loaded
+event.listen(Retreat, 'before_delete', retreat_deleted)
+event.listen(Booking, 'after_insert', booking_changed(1))
+event.listen(Booking, 'after_delete', booking_changed(-1))
+
+
+@app.cli.command('stats-rebuild')
+def stats_rebuild():
+    """Recount the /stats rollups from the retreat and booking tables."""
+    with db.engine.begin() as connection:
+        rebuild_stats(connection)
+        rows = connection.execute(db.select(func.count()).select_from(StatRollup)).scalar()
+    click.echo(f"Rebuilt {rows} stat rows")
@@ -0,0 +1,240 @@
+import hashlib
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from urllib.parse import urljoin, urlsplit
+import click
+from app import app, db, http_cache
+from app.models import Retreat, SyncState, parse_cost_cents, parse_duration_days
+from app.stats import StatDeltas
+from app import geo
+
+
+# Pulls the BookRetreats partner catalogue into the retreat table.
+# Pages are fetched in parallel over kept-alive connections with If-None-Match/If-Modified-Since,
+# so pages that haven't changed since the last run come back as an empty 304. Retreats on the
+# pages that did change are compared to the hash of what was last written, and only new or
+# changed ones are inserted or updated.
+#
+# The feed is expected to look like
+#   GET <BOOKRETREATS_API_URL>retreats?page=1 -> {"retreats": [{...}, ...], "totalPages": 12}
+# with each retreat having an "id" and the fields read in partner_values().
+
+
+class PartnerClient:
+    """HTTP client that keeps one open connection per thread to the partner API."""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        parts = urlsplit(self.base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connection_class(self.host, timeout=self.timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def get(self, url, headers):
+        # returns (status, response headers, body), retrying once on a connection the server closed
+        path = urlsplit(url)
+        target = path.path + ('?' + path.query if path.query else '')
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request('GET', target, headers={'Accept': 'application/json', **headers})
+                response = connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def page_url(self, page):
+        return urljoin(self.base_url, f'retreats?page={page}')
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
+class SyncStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.pages_fetched = 0
+        self.pages_not_modified = 0
+        self.retreats_seen = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.errors = 0
+
+    def to_dict(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            'pagesFetched': self.pages_fetched,
+            'pagesNotModified': self.pages_not_modified,
+            'retreatsSeen': self.retreats_seen,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'errors': self.errors,
+            'seconds': round(seconds, 3),
+            'retreatsPerSecond': round(self.retreats_seen / seconds, 1) if seconds else 0.0
+        }
+
+
+def partner_values(item):
+    # map one feed retreat onto our columns, returns None if it can't be used
+    external_id = item.get('id')
+    name = item.get('name') or item.get('title')
+    location = item.get('location')
+    if external_id is None or not name or not location:
+        return None
+    start_date = item.get('date') or item.get('startDate')
+    try:
+        start_date = date.fromisoformat(str(start_date)[:10]) if start_date else None
+    except ValueError:
+        start_date = None
+    cost = item.get('cost', item.get('price'))
+    duration = item.get('duration')
+    values = {
+        'external_id': str(external_id)[:64],
+        'name': str(name)[:255],
+        'location': str(location)[:255],
+        'description': item.get('description'),
+        'duration': str(duration)[:50] if duration is not None else None,
+        'date': start_date,
+        'cost': str(cost)[:20] if cost is not None else None,
+    }
+    values['sync_hash'] = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+    values['cost_cents'] = parse_cost_cents(values['cost'])
+    values['duration_days'] = parse_duration_days(values['duration'])
+    return geo.located_values(values)
+
+
+def fetch_page(client, url, validators):
+    # validators is (etag, last modified) from the last run, runs on the pool threads
+    etag, last_modified = validators.get(url, (None, None))
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return url, client.get(url, headers)
+
+
+def save_page(url, status, headers, body, states, stats):
+    # write one fetched page, returns the total page count the feed reported (None if unknown)
+    state = states.get(url)
+    if state is None:
+        state = states[url] = SyncState(url=url)
+        db.session.add(state)
+    state.synced_at = datetime.utcnow()
+    if status == 304:
+        stats.pages_not_modified += 1
+        return state.total_pages
+    if status != 200:
+        raise click.ClickException(f"{url} returned {status}")
+    stats.pages_fetched += 1
+
+    data = json.loads(body)
+    items = data.get('retreats', []) if isinstance(data, dict) else data
+    total_pages = data.get('totalPages') if isinstance(data, dict) else None
+    upsert_retreats(items, stats)
+    state.etag = headers.get('ETag')
+    state.last_modified = headers.get('Last-Modified')
+    state.total_pages = total_pages
+    db.session.commit()
+    return total_pages
+
+
+def upsert_retreats(items, stats):
+    rows = {}
+    for item in items:
+        stats.retreats_seen += 1
+        values = partner_values(item) if isinstance(item, dict) else None
+        if values is None:
+            stats.errors += 1
+            continue
+        rows[values['external_id']] = values
+    if not rows:
+        return
+    existing = {row.external_id: row for row in db.session.execute(
+        db.select(Retreat.external_id, Retreat.sync_hash, Retreat.location, Retreat.date, Retreat.user_id, Retreat.seats_booked)
+        .where(Retreat.external_id.in_(rows))
+    )}
+    new_rows = [values for external_id, values in rows.items() if external_id not in existing]
+    changed_rows = [values for external_id, values in rows.items()
+                    if external_id in existing and existing[external_id].sync_hash != values['sync_hash']]
+    stats.unchanged += len(rows) - len(new_rows) - len(changed_rows)
+    # the /stats rollups, a changed retreat takes its bookings with it to its new location and month
+    stat_deltas = StatDeltas()
+    for values in new_rows:
+        stat_deltas.add(values['location'], values['date'], None, retreats=1)
+    for values in changed_rows:
+        old = existing[values['external_id']]
+        stat_deltas.add(old.location, old.date, old.user_id, retreats=-1, bookings=-old.seats_booked)
+        stat_deltas.add(values['location'], values['date'], old.user_id, retreats=1, bookings=old.seats_booked)
+    stat_deltas.apply(db.session.connection())
+    if new_rows:
+        db.session.execute(db.insert(Retreat), new_rows)
+        stats.inserted += len(new_rows)
+        http_cache.invalidate(db.session, 'retreats')
+    if changed_rows:
+        table = Retreat.__table__
+        update = (table.update()
+                  .where(table.c.external_id == db.bindparam('match_external_id'))
+                  .values(version=table.c.version + 1))
+        db.session.execute(update, [{'match_external_id': values['external_id'], **values} for values in changed_rows])
+        stats.updated += len(changed_rows)
+        # the ids of the updated retreats aren't known here, so every cached retreat goes
+        http_cache.invalidate(db.session, 'retreats', 'retreats:all')
+
+
+def sync_retreats(base_url, concurrency=8, timeout=30):
+    stats = SyncStats()
+    client = PartnerClient(base_url, timeout)
+    states = {state.url: state for state in db.session.execute(db.select(SyncState)).scalars()}
+    validators = {url: (state.etag, state.last_modified) for url, state in states.items()}
+    try:
+        # the first page says how many pages there are, then the rest are fetched side by side
+        url, (status, headers, body) = fetch_page(client, client.page_url(1), validators)
+        total_pages = save_page(url, status, headers, body, states, stats) or 1
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(fetch_page, client, client.page_url(page), validators)
+                       for page in range(2, total_pages + 1)]
+            # database writes stay on this thread, the pool only does HTTP
+            for future in as_completed(futures):
+                url, (status, headers, body) = future.result()
+                save_page(url, status, headers, body, states, stats)
+        db.session.commit()
+    finally:
+        client.close()
+    return stats
+
+
+@app.cli.command('sync-retreats')
+@click.option('--url', help='Partner API base URL, defaults to BOOKRETREATS_API_URL.')
+@click.option('--concurrency', type=int, default=None, help='Pages fetched at the same time.')
+def sync_retreats_command(url, concurrency):
+    """Pull the BookRetreats catalogue and upsert the retreats that changed."""
+    url = url or app.config['BOOKRETREATS_API_URL']
+    if not url:
+        raise click.ClickException('Set BOOKRETREATS_API_URL or pass --url')
+    stats = sync_retreats(url, concurrency or app.config['SYNC_CONCURRENCY'], app.config['SYNC_TIMEOUT'])
+    click.echo(json.dumps(stats.to_dict()))
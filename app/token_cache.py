@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """Bounded LRU cache of token -> (user id, token expiration, user columns) with a TTL.
+
+    verify_token checks here before going to the database, for both TOKEN_MODEs. Entries are
+    dropped when the token rotates or is logged out, every token of a user when the user is
+    saved or deleted, or when the TTL runs out, so the TTL is the longest another worker can
+    serve a stale user.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # user id -> their tokens in _entries, a signed mode user can have several
+        self._tokens_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, token, user_id, token_expiration, columns):
+        if self.maxsize <= 0 or not token:
+            return
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (time.monotonic() + self.ttl, (user_id, token_expiration, columns))
+            self._tokens_by_user.setdefault(user_id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, token):
+        if not token:
+            return
+        with self._lock:
+            self._remove(token)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in self._tokens_by_user.pop(user_id, ()):
+                self._entries.pop(token, None)
+
+    def _remove(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_user.get(entry[1][0])
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[1][0]]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,38 @@
+import os
+from datetime import datetime, timedelta
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+
+# Signed access tokens, used when Config.TOKEN_MODE is 'signed'.
+# The token carries the user id and when it was issued, so handing one out writes nothing and
+# checking it needs the secret key. The first time a worker sees a token it also looks the user
+# up by primary key (see models.signed_token_user): a deleted or soft deleted user isn't found,
+# and a logged out token's id is in the revoked_token table until the token would have expired
+# anyway. The result goes in the token cache like a database token's would, so after that a
+# request needs no database access, and another worker sees a logout or a deleted user within
+# TOKEN_CACHE_TTL seconds (straight away in the worker that did it).
+
+TOKEN_LIFETIME = timedelta(hours=1)
+
+
+def get_serializer(secret_key):
+    return URLSafeTimedSerializer(secret_key, salt='access-token')
+
+
+def issue_token(secret_key, user_id):
+    # returns the token and when it expires
+    token = get_serializer(secret_key).dumps({'id': user_id, 'jti': os.urandom(8).hex()})
+    return token, datetime.utcnow() + TOKEN_LIFETIME
+
+
+def load_token(secret_key, token):
+    # returns the token's payload with when it expires added, or None if it is forged or expired
+    # (revoked tokens are caught by signed_token_user)
+    try:
+        payload, issued = get_serializer(secret_key).loads(token, max_age=TOKEN_LIFETIME.total_seconds(), return_timestamp=True)
+    except (BadSignature, SignatureExpired):
+        return None
+    if not isinstance(payload, dict) or 'id' not in payload:
+        return None
+    payload['expires'] = issued.replace(tzinfo=None) + TOKEN_LIFETIME
+    return payload
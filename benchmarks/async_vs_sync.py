@@ -0,0 +1,130 @@
+"""Requests/sec and latency of the sync (gunicorn) app against the ASGI (uvicorn) app.
+
+Seeds a SQLite database, starts each server with the same number of worker processes, hits
+the read routes they both serve with the same number of concurrent clients and prints
+requests/sec, p50 and p99 for each.
+
+    python benchmarks/async_vs_sync.py --workers 2 --clients 32 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(database_uri, retreats):
+    env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': database_uri}
+    script = f"""
+from app import app, db
+from app.models import Retreat
+with app.app_context():
+    db.create_all()
+    db.session.execute(db.insert(Retreat), [
+        {{'name': f'Retreat {{i}}', 'location': f'Place {{i % 50}}', 'description': 'yoga ' * 20,
+          'cost': str(100 + i % 900), 'duration': f'{{1 + i % 14}} days'}}
+        for i in range({retreats})
+    ])
+    db.session.commit()
+"""
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+
+
+def start_server(kind, port, workers, database_uri):
+    env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': database_uri, 'RESPONSE_CACHE': 'none'}
+    if kind == 'sync':
+        command = ['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app']
+    else:
+        command = ['uvicorn', '--workers', str(workers), '--port', str(port), '--no-access-log', 'app.asgi:application']
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/retreats/1')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+
+def run_load(port, clients, seconds, retreats):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    end = time.perf_counter() + seconds
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        mine = []
+        while time.perf_counter() < end:
+            if random.random() < 0.5:
+                path = f'/retreats/{random.randint(1, retreats)}'
+            else:
+                path = f'/retreats?limit=50&after={random.randint(0, retreats)}'
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+            except OSError:
+                errors[0] += 1
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors[0],
+        'requestsPerSecond': round(count / seconds, 1),
+        'p50Ms': round(latencies[count // 2] * 1000, 2) if count else None,
+        'p99Ms': round(latencies[min(count - 1, int(count * 0.99))] * 1000, 2) if count else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--retreats', type=int, default=10000)
+    parser.add_argument('--database-uri', help='Use this database instead of a new SQLite file (it must already be seeded).')
+    args = parser.parse_args()
+
+    database_uri = args.database_uri
+    if database_uri is None:
+        database_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        seed(database_uri, args.retreats)
+
+    results = {}
+    for port, kind in ((8801, 'sync'), (8802, 'async')):
+        process = start_server(kind, port, args.workers, database_uri)
+        try:
+            results[kind] = run_load(port, args.clients, args.seconds, args.retreats)
+        finally:
+            process.terminate()
+            process.wait()
+    print(json.dumps({'workers': args.workers, 'clients': args.clients, **results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
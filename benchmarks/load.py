@@ -0,0 +1,448 @@
+"""Load test for the API: seeds a database, replays a traffic mix and saves the results as JSON.
+
+Seed volumes, the traffic mix and the server are all options:
+
+    # in process through the Flask test client
+    python benchmarks/load.py run --users 1000 --retreats 50000 --bookings 20000 --mix mixed --seconds 20
+
+    # through a real gunicorn with 4 workers, against a local Postgres
+    python benchmarks/load.py run --server gunicorn --workers 4 --database-uri postgresql://localhost/retreats_bench
+
+    # overload 2 workers, with requests that queued for more than 200ms shed with a 503
+    python benchmarks/load.py run --server gunicorn --workers 2 --clients 64 --mix auth --shed-queue-ms 200
+
+    # compare two runs
+    python benchmarks/load.py compare before.json after.json
+
+Every request is sent with SQL_PROFILING on, so the SQL count per request is read from the
+Server-Timing header the same way in both modes. Peak RSS is the process's own high water
+mark in test client mode and the largest gunicorn worker's in gunicorn mode.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'password'
+LOCATIONS = ['Bali', 'Goa', 'Tulum', 'Sedona', 'Rishikesh', 'Costa Rica', 'Portugal', 'Thailand', 'Morocco', 'Peru']
+WORDS = ['yoga', 'meditation', 'silent', 'surf', 'detox', 'hiking', 'breathwork', 'vegan', 'sunrise', 'ocean']
+
+# (scenario, weight) for each --mix
+MIXES = {
+    'catalog': [('list_retreats', 40), ('get_retreat', 40), ('search_text', 10), ('search_sorted', 10)],
+    'auth': [('login', 20), ('me', 50), ('bookings', 30)],
+    'booking': [('book', 60), ('bookings_expanded', 30), ('cancel', 10)],
+    'mixed': [('list_retreats', 20), ('get_retreat', 25), ('search_text', 5), ('search_sorted', 5),
+              ('login', 3), ('me', 12), ('bookings', 10), ('bookings_expanded', 10), ('book', 8), ('cancel', 2)],
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3)
+
+
+# SEEDING
+def seed(users, retreats, bookings, batch_size=5000):
+    from werkzeug.security import generate_password_hash
+    from app import app, db
+    from app.models import User, Retreat, Booking, parse_cost_cents, parse_duration_days
+    from app.search import get_search_backend
+
+    rng = random.Random(42)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        with db.engine.begin() as connection:
+            get_search_backend().create_index(connection)
+
+        # every seeded user gets the same hash so seeding doesn't spend minutes hashing
+        password_hash = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+        for start in range(0, users, batch_size):
+            db.session.execute(db.insert(User), [
+                {'first_name': 'Bench', 'last_name': f'User{i}', 'username': f'bench{i}', 'email': f'bench{i}@example.com',
+                 'password': password_hash, 'date_created': datetime.utcnow()}
+                for i in range(start, min(start + batch_size, users))
+            ])
+
+        for start in range(0, retreats, batch_size):
+            rows = []
+            for i in range(start, min(start + batch_size, retreats)):
+                cost = f'${rng.randint(200, 5000):,}'
+                duration = f'{rng.randint(2, 21)} days'
+                rows.append({
+                    'name': f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} retreat {i}',
+                    'location': rng.choice(LOCATIONS),
+                    'description': ' '.join(rng.choice(WORDS) for _ in range(30)),
+                    'duration': duration,
+                    'date': date(2025, 1, 1) + timedelta(days=rng.randint(0, 700)),
+                    'cost': cost,
+                    'cost_cents': parse_cost_cents(cost),
+                    'duration_days': parse_duration_days(duration),
+                    'user_id': rng.randint(1, users) if users else None,
+                    'capacity': rng.choice([None, 20, 50, 100]),
+                })
+            db.session.execute(db.insert(Retreat), rows)
+
+        pairs = set()
+        while len(pairs) < min(bookings, users * retreats):
+            pairs.add((rng.randint(1, users), rng.randint(1, retreats)))
+        pairs = list(pairs)
+        for start in range(0, len(pairs), batch_size):
+            db.session.execute(db.insert(Booking), [
+                {'user_id': user_id, 'retreat_id': retreat_id} for user_id, retreat_id in pairs[start:start + batch_size]
+            ])
+        db.session.execute(db.text(
+            "UPDATE retreat SET seats_booked = (SELECT COUNT(*) FROM booking WHERE booking.retreat_id = retreat.id)"
+        ))
+        # capacity has to fit what was seeded
+        db.session.execute(db.text("UPDATE retreat SET capacity = seats_booked + 10 WHERE capacity < seats_booked"))
+        db.session.commit()
+
+
+# TRANSPORTS
+class TestClientTransport:
+    def __init__(self):
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, headers):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, headers=headers)
+        body = response.get_data()
+        return response.status_code, response.headers.getlist('Server-Timing'), body
+
+    def peak_rss_kb(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def close(self):
+        pass
+
+
+class GunicornTransport:
+    def __init__(self, database_uri, workers, port):
+        env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': database_uri, 'SQL_PROFILING': '1'}
+        self.port = port
+        self.process = subprocess.Popen(
+            ['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app'],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self._local = threading.local()
+        for _ in range(100):
+            try:
+                self.request('GET', '/retreats?limit=1', {})
+                return
+            except OSError:
+                self._local.connection = None
+                time.sleep(0.1)
+        self.process.kill()
+        raise RuntimeError('gunicorn did not start')
+
+    def request(self, method, path, headers):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            # stands in for the proxy's header, so SHED_QUEUE_MS sees how long gunicorn's backlog held the request
+            connection.request(method, path, headers={**headers, 'X-Request-Start': f't={time.time():.3f}'})
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self._local.connection = None
+            raise
+        return response.status, response.headers.get_all('Server-Timing') or [], body
+
+    def worker_pids(self):
+        try:
+            with open(f'/proc/{self.process.pid}/task/{self.process.pid}/children') as children:
+                return [int(pid) for pid in children.read().split()]
+        except OSError:
+            return []
+
+    def peak_rss_kb(self):
+        # VmHWM is the most memory each process has had resident
+        peaks = []
+        for pid in self.worker_pids():
+            try:
+                with open(f'/proc/{pid}/status') as status:
+                    for line in status:
+                        if line.startswith('VmHWM:'):
+                            peaks.append(int(line.split()[1]))
+            except OSError:
+                pass
+        return max(peaks) if peaks else None
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+# SCENARIOS
+class Scenarios:
+    """Each scenario picks a request from the seeded data, returns (method, path, headers, on_response)."""
+
+    def __init__(self, users, retreats, tokens):
+        self.users = users
+        self.retreats = retreats
+        self.tokens = tokens
+        # (user id, booking id) made by the book scenario, for cancel to delete
+        self.booked = []
+        self._lock = threading.Lock()
+
+    def _auth(self, rng):
+        user_id = rng.choice(list(self.tokens))
+        return user_id, {'Authorization': f'Bearer {self.tokens[user_id]}'}
+
+    def list_retreats(self, rng):
+        return 'GET', f'/retreats?limit=50&after={rng.randint(0, self.retreats)}', {}, None
+
+    def get_retreat(self, rng):
+        return 'GET', f'/retreats/{rng.randint(1, self.retreats)}', {}, None
+
+    def search_text(self, rng):
+        return 'GET', f'/retreats/search?q={rng.choice(WORDS)}&limit=20', {}, None
+
+    def search_sorted(self, rng):
+        location = rng.choice(LOCATIONS).replace(' ', '+')
+        return 'GET', f'/retreats/search?location={location}&sort=-cost&maxCost={rng.randint(500, 5000)}&limit=20', {}, None
+
+    def login(self, rng):
+        user_id = rng.randint(1, self.users)
+        credentials = base64.b64encode(f'bench{user_id - 1}:{PASSWORD}'.encode()).decode()
+        return 'GET', '/token', {'Authorization': f'Basic {credentials}'}, None
+
+    def me(self, rng):
+        return 'GET', '/users/me', self._auth(rng)[1], None
+
+    def bookings(self, rng):
+        return 'GET', '/bookings', self._auth(rng)[1], None
+
+    def bookings_expanded(self, rng):
+        return 'GET', '/bookings?expand=retreat', self._auth(rng)[1], None
+
+    def book(self, rng):
+        # bursts go at a handful of popular retreats
+        retreat_id = rng.randint(1, min(20, self.retreats))
+        user_id, headers = self._auth(rng)
+        headers['Idempotency-Key'] = uuid.uuid4().hex
+
+        def on_response(status, body):
+            booking_id = json.loads(body).get('bookingId') if status == 200 else None
+            if booking_id is not None:
+                with self._lock:
+                    self.booked.append((user_id, booking_id))
+        return 'POST', f'/retreats/book/{retreat_id}', headers, on_response
+
+    def cancel(self, rng):
+        with self._lock:
+            booked = self.booked.pop(rng.randrange(len(self.booked))) if self.booked else None
+        if booked is None:
+            # nothing booked yet, a 403/404 still goes through the route
+            return 'DELETE', f'/bookings/{rng.randint(1, self.retreats)}', self._auth(rng)[1], None
+        user_id, booking_id = booked
+        return 'DELETE', f'/bookings/{booking_id}', {'Authorization': f'Bearer {self.tokens[user_id]}'}, None
+
+
+def get_tokens(transport, users, count):
+    tokens = {}
+    for user_id in random.Random(7).sample(range(1, users + 1), min(count, users)):
+        credentials = base64.b64encode(f'bench{user_id - 1}:{PASSWORD}'.encode()).decode()
+        status, _, body = transport.request('GET', '/token', {'Authorization': f'Basic {credentials}'})
+        if status == 200:
+            tokens[user_id] = json.loads(body)['token']
+    return tokens
+
+
+def sql_count(server_timing):
+    for value in server_timing:
+        if value.startswith('db;') and 'desc="' in value:
+            return int(value.split('desc="', 1)[1].split(' ', 1)[0])
+    return None
+
+
+def run_load(transport, scenarios, mix, clients, seconds):
+    names = [name for name, weight in MIXES[mix]]
+    weights = [weight for name, weight in MIXES[mix]]
+    results = {name: {'latencies': [], 'sql': [], 'statuses': {}, 'errors': 0} for name in names}
+    lock = threading.Lock()
+    end = time.perf_counter() + seconds
+
+    def client(seed):
+        rng = random.Random(seed)
+        mine = {name: {'latencies': [], 'sql': [], 'statuses': {}, 'errors': 0} for name in names}
+        while time.perf_counter() < end:
+            name = rng.choices(names, weights)[0]
+            method, path, headers, on_response = getattr(scenarios, name)(rng)
+            start = time.perf_counter()
+            try:
+                status, server_timing, body = transport.request(method, path, headers)
+            except (OSError, http.client.HTTPException):
+                mine[name]['errors'] += 1
+                continue
+            mine[name]['latencies'].append(time.perf_counter() - start)
+            if on_response is not None:
+                on_response(status, body)
+            mine[name]['statuses'][status] = mine[name]['statuses'].get(status, 0) + 1
+            count = sql_count(server_timing)
+            if count is not None:
+                mine[name]['sql'].append(count)
+        with lock:
+            for name, result in mine.items():
+                results[name]['latencies'] += result['latencies']
+                results[name]['sql'] += result['sql']
+                results[name]['errors'] += result['errors']
+                for status, count in result['statuses'].items():
+                    results[name]['statuses'][status] = results[name]['statuses'].get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return summarize(results, elapsed)
+
+
+def summarize(results, elapsed):
+    summary = {'seconds': round(elapsed, 3), 'scenarios': {}}
+    all_latencies = []
+    all_sql = []
+    for name, result in results.items():
+        latencies = sorted(result['latencies'])
+        all_latencies += latencies
+        all_sql += result['sql']
+        summary['scenarios'][name] = {
+            'requests': len(latencies),
+            'errors': result['errors'],
+            'statuses': {str(status): count for status, count in sorted(result['statuses'].items())},
+            'requestsPerSecond': round(len(latencies) / elapsed, 2),
+            'p50Ms': percentile(latencies, 0.50),
+            'p95Ms': percentile(latencies, 0.95),
+            'p99Ms': percentile(latencies, 0.99),
+            'sqlPerRequest': round(sum(result['sql']) / len(result['sql']), 2) if result['sql'] else None,
+        }
+    all_latencies.sort()
+    summary['total'] = {
+        'requests': len(all_latencies),
+        'requestsPerSecond': round(len(all_latencies) / elapsed, 2),
+        'p50Ms': percentile(all_latencies, 0.50),
+        'p95Ms': percentile(all_latencies, 0.95),
+        'p99Ms': percentile(all_latencies, 0.99),
+        'sqlPerRequest': round(sum(all_sql) / len(all_sql), 2) if all_sql else None,
+    }
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(args):
+    database_uri = args.database_uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load.db')
+    # set before the app is imported so its Config picks them up
+    os.environ['SQLALCHEMY_DATABASE_URI'] = database_uri
+    os.environ['SQL_PROFILING'] = '1'
+    os.environ.setdefault('RESPONSE_CACHE', 'memory')
+    # the clients all come from one IP, so the rate limits are off unless a backend is asked for
+    os.environ['RATE_LIMIT_BACKEND'] = args.rate_limit_backend
+    os.environ['SHED_QUEUE_MS'] = str(args.shed_queue_ms)
+    if not args.no_seed:
+        started = time.perf_counter()
+        seed(args.users, args.retreats, args.bookings)
+        print(f'seeded in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    if args.server == 'gunicorn':
+        transport = GunicornTransport(database_uri, args.workers, args.port)
+    else:
+        transport = TestClientTransport()
+    try:
+        tokens = get_tokens(transport, args.users, args.token_users)
+        scenarios = Scenarios(args.users, args.retreats, tokens)
+        summary = run_load(transport, scenarios, args.mix, args.clients, args.seconds)
+        peak_rss_kb = transport.peak_rss_kb()
+        summary['peakRssMb'] = round(peak_rss_kb / 1024, 1) if peak_rss_kb else None
+    finally:
+        transport.close()
+
+    result = {
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('func', 'database_uri')},
+        'database': database_uri.split(':', 1)[0],
+        **summary,
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+
+def compare(args):
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{'scenario':<20}{'req/s':>20}{'p99 ms':>22}{'sql/req':>18}")
+    for name in sorted(set(before['scenarios']) | set(after['scenarios'])) + ['total']:
+        old = before['total'] if name == 'total' else before['scenarios'].get(name, {})
+        new = after['total'] if name == 'total' else after['scenarios'].get(name, {})
+        cells = []
+        for key in ('requestsPerSecond', 'p99Ms', 'sqlPerRequest'):
+            cells.append(f"{old.get(key)} -> {new.get(key)}")
+        print(f"{name:<20}{cells[0]:>20}{cells[1]:>22}{cells[2]:>18}")
+    print(f"peak RSS MB: {before.get('peakRssMb')} -> {after.get('peakRssMb')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(required=True)
+
+    run_parser = commands.add_parser('run', help='seed a database and run a traffic mix against it')
+    run_parser.add_argument('--database-uri', help='defaults to a new SQLite file')
+    run_parser.add_argument('--no-seed', action='store_true', help='use the data already in --database-uri')
+    run_parser.add_argument('--users', type=int, default=500)
+    run_parser.add_argument('--retreats', type=int, default=10000)
+    run_parser.add_argument('--bookings', type=int, default=5000)
+    run_parser.add_argument('--token-users', type=int, default=100, help='how many users log in for the authenticated scenarios')
+    run_parser.add_argument('--mix', choices=sorted(MIXES), default='mixed')
+    run_parser.add_argument('--rate-limit-backend', choices=['none', 'memory', 'sqlite'], default='none')
+    run_parser.add_argument('--shed-queue-ms', type=int, default=0, help='SHED_QUEUE_MS for the server, 0 leaves shedding off')
+    run_parser.add_argument('--server', choices=['testclient', 'gunicorn'], default='testclient')
+    run_parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    run_parser.add_argument('--port', type=int, default=8810)
+    run_parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    run_parser.add_argument('--seconds', type=float, default=10)
+    run_parser.add_argument('--output', help='save the results to this JSON file')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
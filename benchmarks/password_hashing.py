@@ -0,0 +1,48 @@
+"""Logins per second per core for the password hash settings in Config.
+
+Runs check_password_hash in one process (one core) for a few seconds and reports the rate,
+then does the same through a process pool to show how it scales with more cores.
+
+    python benchmarks/password_hashing.py --method scrypt --seconds 5 --workers 4
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def logins_for(seconds, password_hash, password):
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        check_password_hash(password_hash, password)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--method', default=os.environ.get('PASSWORD_HASH_METHOD', 'scrypt'))
+    parser.add_argument('--salt-length', type=int, default=int(os.environ.get('PASSWORD_SALT_LENGTH', 16)))
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    password = 'correct horse battery staple'
+    password_hash = generate_password_hash(password, args.method, args.salt_length)
+    print(f"method: {password_hash.split('$', 1)[0]}")
+
+    count = logins_for(args.seconds, password_hash, password)
+    print(f"1 core: {count / args.seconds:.1f} logins/sec ({args.seconds * 1000 / count:.1f} ms each)")
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            counts = list(pool.map(logins_for, [args.seconds] * args.workers,
+                                   [password_hash] * args.workers, [password] * args.workers))
+        total = sum(counts) / args.seconds
+        print(f"{args.workers} cores: {total:.1f} logins/sec ({total / args.workers:.1f} per core)")
+
+
+if __name__ == '__main__':
+    main()
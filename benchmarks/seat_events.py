@@ -0,0 +1,173 @@
+"""Idle GET /retreats/<id>/events streams on one ASGI worker: memory, and how fast a booking reaches them.
+
+Seeds a SQLite database, starts one uvicorn worker, opens --subscribers streams spread over
+--retreats-watched retreats and prints the worker's resident memory before and after. Then it books
+--bookings seats, one every --booking-interval seconds, and reports how long after each booking
+the streams watching that retreat got the new count, and how many updates the streams got in all
+(fewer than the bookings when they are coalesced, see SEAT_EVENTS_PER_SECOND).
+
+    python benchmarks/seat_events.py --subscribers 5000 --bookings 20
+"""
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(database_uri, retreats):
+    env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': database_uri}
+    script = f"""
+from app import app, db
+from app.models import Retreat
+with app.app_context():
+    db.create_all()
+    db.session.execute(db.insert(Retreat), [
+        {{'name': f'Retreat {{i}}', 'location': 'Bali', 'capacity': 100000, 'seats_booked': 0, 'version': 1}}
+        for i in range({retreats})
+    ])
+    db.session.commit()
+"""
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+
+
+def start_server(port, database_uri, per_second):
+    env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': database_uri, 'SEAT_EVENTS_PER_SECOND': str(per_second),
+           'RATE_LIMIT_BACKEND': 'none'}
+    command = [sys.executable, '-m', 'uvicorn', '--port', str(port), '--no-access-log', '--log-level', 'warning', 'app.asgi:application']
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    for _ in range(100):
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/retreats/1')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('uvicorn did not start')
+
+
+def rss_mb(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return round(int(line.split()[1]) / 1024, 1)
+
+
+def request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                       headers={'Content-Type': 'application/json', **(headers or {})})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read() or 'null')
+
+
+def make_tokens(port, count):
+    # one user per booking, a user books a retreat once
+    tokens = []
+    for i in range(count):
+        username = f'booker{i}'
+        request(port, 'POST', '/users', {'firstName': 'B', 'lastName': 'B', 'username': username,
+                                         'email': f'{username}@example.com', 'password': 'password'})
+        basic = base64.b64encode(f'{username}:password'.encode()).decode()
+        tokens.append(request(port, 'GET', '/token', headers={'Authorization': f'Basic {basic}'})[1]['token'])
+    return tokens
+
+
+async def subscribe(port, retreat_id, updates, opened):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET /retreats/{retreat_id}/events HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n'.encode())
+    await writer.drain()
+    opened.release()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if line.startswith(b'data: '):
+                updates.append((retreat_id, json.loads(line[6:])['seatsBooked'], time.perf_counter()))
+    finally:
+        writer.close()
+
+
+async def run(port, pid, subscribers, watched, tokens, booking_interval):
+    updates = []
+    opened = asyncio.Semaphore(0)
+    rss_before = rss_mb(pid)
+    tasks = [asyncio.ensure_future(subscribe(port, 1 + i % watched, updates, opened)) for i in range(subscribers)]
+    for _ in range(subscribers):
+        await opened.acquire()
+    # every stream has had its first update, the counts as they are now
+    while len(updates) < subscribers:
+        await asyncio.sleep(0.1)
+    rss_after = rss_mb(pid)
+    updates.clear()
+
+    loop = asyncio.get_running_loop()
+    booked = []
+    for i, token in enumerate(tokens):
+        retreat_id = 1 + i % watched
+        started = time.perf_counter()
+        status, body = await loop.run_in_executor(None, lambda: request(port, 'POST', f'/retreats/book/{retreat_id}', headers={'Authorization': f'Bearer {token}'}))
+        booked.append((retreat_id, started))
+        await asyncio.sleep(booking_interval)
+    await asyncio.sleep(2)
+    for task in tasks:
+        task.cancel()
+
+    # the latency of a booking is from its POST to the first update on a stream that includes it
+    latencies = []
+    for index, (retreat_id, started) in enumerate(booked):
+        bookings_so_far = sum(1 for other, _ in booked[:index + 1] if other == retreat_id)
+        for other, seats, received in updates:
+            if other == retreat_id and seats >= bookings_so_far and received >= started:
+                latencies.append(received - started)
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'subscribers': subscribers,
+        'rssBeforeMb': rss_before,
+        'rssAfterMb': rss_after,
+        'kbPerSubscriber': round((rss_after - rss_before) * 1024 / subscribers, 1),
+        'bookings': len(booked),
+        'updatesReceived': len(updates),
+        'p50Ms': round(latencies[count // 2] * 1000, 1) if count else None,
+        'p99Ms': round(latencies[min(count - 1, int(count * 0.99))] * 1000, 1) if count else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=5000)
+    parser.add_argument('--retreats-watched', type=int, default=10)
+    parser.add_argument('--bookings', type=int, default=20)
+    parser.add_argument('--booking-interval', type=float, default=0.05)
+    parser.add_argument('--per-second', type=float, default=2, help='SEAT_EVENTS_PER_SECOND for the server.')
+    args = parser.parse_args()
+
+    database_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    seed(database_uri, args.retreats_watched)
+    # a socket per stream on both ends, uvicorn inherits the limit
+    hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    process = start_server(8803, database_uri, args.per_second)
+    try:
+        tokens = make_tokens(8803, args.bookings)
+        results = asyncio.run(run(8803, process.pid, args.subscribers, args.retreats_watched, tokens, args.booking_interval))
+    finally:
+        process.terminate()
+        process.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
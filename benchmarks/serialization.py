@@ -0,0 +1,106 @@
+"""CPU time and bytes/sec to turn 10k retreats into a JSON response body, before and after orjson.
+
+"before" is what the app did until the serializers: Retreat.to_dict() reading each attribute
+and Flask's stdlib JSON provider formatting the dates in its default hook. "after" is the
+compiled serializers with the stdlib provider and with orjson. Both the ORM path (GET
+/retreats/<id>, ?expand=retreat) and the column rows path (GET /retreats) are measured.
+
+    python benchmarks/serialization.py --retreats 10000 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'serialization.db')
+
+from flask.json.provider import DefaultJSONProvider
+from app import app, db
+from app.models import Retreat
+from app.routes import RETREAT_FIELDS, retreat_rows
+from app.serializers import JSONProvider, OrjsonProvider, orjson
+
+
+def old_to_dict(retreat):
+    # Retreat.to_dict() before the serializers
+    return {
+        'id': retreat.id,
+        'name': retreat.name,
+        'location': retreat.location,
+        'description': retreat.description,
+        'duration': retreat.duration,
+        'cost': retreat.cost,
+        'date': retreat.date,
+        'userId': retreat.user_id,
+        'capacity': retreat.capacity,
+        'seatsBooked': retreat.seats_booked
+    }
+
+
+def seed(count):
+    rng = random.Random(1)
+    db.create_all()
+    db.session.execute(db.insert(Retreat), [
+        {'name': f'Retreat {i}', 'location': f'Place {i % 50}', 'description': 'yoga and meditation by the sea ' * 5,
+         'duration': f'{1 + i % 14} days', 'cost': f'${rng.randint(200, 5000)}',
+         'date': date(2025, 1, 1) + timedelta(days=rng.randint(0, 700)), 'capacity': rng.choice([None, 20, 50])}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+def measure(build, provider, repeat):
+    # best of repeat, CPU seconds to build the dicts and encode them as one response body
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        body = provider.response(build()).get_data()
+        seconds = time.process_time() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--retreats', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    providers = {'stdlib': DefaultJSONProvider(app), 'stdlib+serializers': JSONProvider(app)}
+    if orjson is not None:
+        providers['orjson+serializers'] = OrjsonProvider(app)
+
+    with app.app_context():
+        seed(args.retreats)
+        instances = db.session.execute(db.select(Retreat)).scalars().all()
+        fields = list(RETREAT_FIELDS)
+        rows = db.session.execute(db.select(*RETREAT_FIELDS.values())).all()
+
+        cases = {
+            'orm before': (lambda: [old_to_dict(retreat) for retreat in instances], providers['stdlib']),
+            'rows before': (lambda: [dict(zip(fields, row)) for row in rows], providers['stdlib']),
+        }
+        for name, provider in providers.items():
+            if name != 'stdlib':
+                cases[f'orm {name}'] = (lambda: [retreat.to_dict() for retreat in instances], provider)
+                cases[f'rows {name}'] = (lambda: retreat_rows(fields, rows), provider)
+
+        results = {}
+        for name, (build, provider) in cases.items():
+            seconds, size = measure(build, provider, args.repeat)
+            results[name] = {
+                'cpuMsPer10k': round(seconds * 1000 * 10000 / args.retreats, 2),
+                'bytes': size,
+                'megabytesPerSecond': round(size / seconds / 1e6, 1),
+            }
+    print(json.dumps({'retreats': args.retreats, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Build time and memory of the similar retreats job, full and incremental.
+
+"compute" runs the numpy counting (app.similar.top_similar) on --bookings synthetic bookings held
+in memory, no database. "database" seeds --db-bookings into a SQLite file and times
+`flask similar-retreats` end to end (reading the bookings, counting, writing the rows), then again
+after --new-bookings more bookings and a few cancellations, which only rebuilds what they touched.
+
+    python benchmarks/similarity.py --bookings 10000000 --db-bookings 1000000
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'similarity.db')
+
+import numpy
+from app import app, db
+from app.models import User, Retreat, Booking
+from app.similar import build_similar, top_similar
+
+
+def synthetic_bookings(count, retreats, seed=1):
+    # users book a few retreats each, mostly within one of 500 "interests", popular retreats more often
+    rng = numpy.random.default_rng(seed)
+    # twice as many as asked for, some land on the same (user, retreat) more than once
+    size = count * 2
+    users = rng.integers(0, count // 5, size=size)
+    interests = users % 500
+    per_interest = retreats // 500
+    picks = numpy.minimum(rng.zipf(1.6, size=size) - 1, per_interest - 1)
+    wanders = rng.random(size) < 0.2
+    retreat_ids = numpy.where(wanders, rng.integers(0, retreats, size=size), interests * per_interest + picks) + 1
+    pairs = numpy.unique(numpy.stack([users + 1, retreat_ids], axis=1), axis=0)
+    pairs = pairs[numpy.sort(rng.choice(len(pairs), size=min(count, len(pairs)), replace=False))]
+    return pairs[:, 0], pairs[:, 1]
+
+
+def measure(run):
+    # result, seconds
+    started = time.perf_counter()
+    result = run()
+    return result, round(time.perf_counter() - started, 2)
+
+
+def peak_memory(run):
+    # peak MB of Python and numpy allocations during run, traced separately as tracing slows it down
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return round(peak / 1e6, 1)
+
+
+def compute(bookings, retreats):
+    users, retreat_ids = synthetic_bookings(bookings, retreats)
+    ids, counts = numpy.unique(retreat_ids, return_counts=True)
+    counts = dict(zip(ids.tolist(), counts.tolist()))
+
+    def run():
+        return sum(len(batch[0]) for batch in top_similar(users, retreat_ids, counts, counts.keys()))
+    rows, seconds = measure(run)
+    return {'bookings': len(users), 'retreats': len(counts), 'rows': rows, 'seconds': seconds, 'peakMb': peak_memory(run)}
+
+
+def insert_users(first, last):
+    # the bookings' users, SQLite enforces the foreign keys
+    for start in range(first, last + 1, 100000):
+        db.session.execute(db.insert(User), [
+            {'id': user, 'first_name': 'B', 'last_name': 'B', 'username': f'user{user}', 'email': f'user{user}@example.com', 'password': ''}
+            for user in range(start, min(start + 100000, last + 1))
+        ])
+
+
+def database(bookings, retreats, new_bookings):
+    users, retreat_ids = synthetic_bookings(bookings, retreats, seed=2)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(db.insert(Retreat), [{'name': f'Retreat {i}', 'location': 'Bali', 'seats_booked': 0, 'version': 1}
+                                                for i in range(retreats)])
+        insert_users(1, int(users.max()))
+        pairs = list(zip(users.tolist(), retreat_ids.tolist()))
+        for start in range(0, len(pairs), 100000):
+            db.session.execute(db.insert(Booking), [{'user_id': user, 'retreat_id': retreat} for user, retreat in pairs[start:start + 100000]])
+        db.session.commit()
+
+        (rebuilt, rows), full_seconds = measure(lambda: build(full=True))
+        full_peak = peak_memory(lambda: build(full=True))
+
+        # a day's worth of new bookings from new users, and some cancellations
+        rng = numpy.random.default_rng(3)
+        first_user = int(users.max()) + 1
+        new_users, new_retreats = synthetic_bookings(new_bookings * 5, retreats, seed=4)
+        new_pairs = {(first_user + user, retreat) for user, retreat in zip(new_users.tolist(), new_retreats.tolist())}
+        insert_users(first_user, first_user + int(new_users.max()))
+        db.session.execute(db.insert(Booking), [{'user_id': user, 'retreat_id': retreat} for user, retreat in sorted(new_pairs)[:new_bookings]])
+        cancelled = rng.choice(len(pairs), size=new_bookings // 10, replace=False).tolist()
+        for index in cancelled:
+            user, retreat = pairs[index]
+            db.session.execute(db.delete(Booking).where(Booking.user_id == user, Booking.retreat_id == retreat))
+        db.session.commit()
+
+        (incremental_rebuilt, incremental_rows), incremental_seconds = measure(build)
+    return {
+        'bookings': len(pairs),
+        'full': {'retreats': rebuilt, 'rows': rows, 'seconds': full_seconds, 'peakMb': full_peak},
+        'incremental': {'newBookings': new_bookings, 'cancelled': len(cancelled), 'retreats': incremental_rebuilt,
+                        'rows': incremental_rows, 'seconds': incremental_seconds},
+    }
+
+
+def build(full=False):
+    # what `flask similar-retreats` does
+    result = build_similar(db.session.connection(), full)
+    db.session.commit()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bookings', type=int, default=10000000)
+    parser.add_argument('--db-bookings', type=int, default=1000000)
+    parser.add_argument('--retreats', type=int, default=50000)
+    parser.add_argument('--new-bookings', type=int, default=1000)
+    args = parser.parse_args()
+    results = {
+        'compute': compute(args.bookings, args.retreats),
+        'database': database(args.db_bookings, args.retreats, args.new_bookings),
+        'maxRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
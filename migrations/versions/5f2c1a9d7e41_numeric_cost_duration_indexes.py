@@ -0,0 +1,93 @@
+"""numeric cost and duration columns, retreat search indexes
+
+Revision ID: 5f2c1a9d7e41
+Revises: 2ca85fd1e5db
+Create Date: 2026-10-18 09:12:40.118304
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2c1a9d7e41'
+down_revision = '2ca85fd1e5db'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+DURATION_UNITS = {'day': 1, 'night': 1, 'week': 7, 'month': 30}
+
+
+# copies of the parsers in app/models.py so this migration doesn't change if they do
+def parse_cost_cents(cost):
+    if cost is None:
+        return None
+    match = re.search(r"\d[\d,]*(\.\d+)?", str(cost))
+    if match is None:
+        return None
+    return int(round(float(match.group().replace(',', '')) * 100))
+
+
+def parse_duration_days(duration):
+    if duration is None:
+        return None
+    match = re.search(r"(\d+)\s*(day|night|week|month)?", str(duration).lower())
+    if match is None:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 'day']
+
+
+def upgrade():
+    with op.batch_alter_table('retreat', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('cost_cents', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('duration_days', sa.Integer(), nullable=True))
+
+    # fill in the new columns from the existing strings, a batch of rows at a time
+    retreat = sa.table('retreat',
+        sa.column('id', sa.Integer),
+        sa.column('cost', sa.String),
+        sa.column('duration', sa.String),
+        sa.column('cost_cents', sa.Integer),
+        sa.column('duration_days', sa.Integer),
+    )
+    connection = op.get_bind()
+    update = retreat.update().where(retreat.c.id == sa.bindparam('retreat_id')).values(
+        cost_cents=sa.bindparam('new_cost_cents'),
+        duration_days=sa.bindparam('new_duration_days'),
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(retreat.c.id, retreat.c.cost, retreat.c.duration)
+            .where(retreat.c.id > last_id)
+            .order_by(retreat.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(update, [
+            {'retreat_id': row.id,
+             'new_cost_cents': parse_cost_cents(row.cost),
+             'new_duration_days': parse_duration_days(row.duration)}
+            for row in rows
+        ])
+        last_id = rows[-1].id
+
+    with op.batch_alter_table('retreat', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_retreat_cost_cents'), ['cost_cents'], unique=False)
+        batch_op.create_index(batch_op.f('ix_retreat_duration_days'), ['duration_days'], unique=False)
+        batch_op.create_index('ix_retreat_location_date', ['location', 'date'], unique=False)
+        batch_op.create_index('ix_retreat_user_id_date', ['user_id', 'date'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('retreat', schema=None) as batch_op:
+        batch_op.drop_index('ix_retreat_user_id_date')
+        batch_op.drop_index('ix_retreat_location_date')
+        batch_op.drop_index(batch_op.f('ix_retreat_duration_days'))
+        batch_op.drop_index(batch_op.f('ix_retreat_cost_cents'))
+        batch_op.drop_column('duration_days')
+        batch_op.drop_column('cost_cents')
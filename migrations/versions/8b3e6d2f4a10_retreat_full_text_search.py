@@ -0,0 +1,59 @@
+"""full text search index on retreat name, location and description
+
+Revision ID: 8b3e6d2f4a10
+Revises: 5f2c1a9d7e41
+Create Date: 2026-10-18 10:02:17.540921
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b3e6d2f4a10'
+down_revision = '5f2c1a9d7e41'
+branch_labels = None
+depends_on = None
+
+# copied from app/search.py, the postgres query has to use this exact expression to hit the index
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(location, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+)
+
+SQLITE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS retreat_fts USING fts5("
+    "name, location, description, content='retreat', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_insert AFTER INSERT ON retreat BEGIN "
+    "INSERT INTO retreat_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_delete AFTER DELETE ON retreat BEGIN "
+    "INSERT INTO retreat_fts(retreat_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_update AFTER UPDATE OF name, location, description ON retreat BEGIN "
+    "INSERT INTO retreat_fts(retreat_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); "
+    "INSERT INTO retreat_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(f"CREATE INDEX ix_retreat_search ON retreat USING gin (({POSTGRES_DOCUMENT}))")
+    elif dialect == 'sqlite':
+        for statement in SQLITE_STATEMENTS:
+            op.execute(statement)
+        # index the retreats that are already there
+        op.execute("INSERT INTO retreat_fts(retreat_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_retreat_search")
+    elif dialect == 'sqlite':
+        for trigger in ('retreat_fts_insert', 'retreat_fts_delete', 'retreat_fts_update'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS retreat_fts")
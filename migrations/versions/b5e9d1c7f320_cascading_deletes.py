@@ -0,0 +1,81 @@
+"""ON DELETE rules on the foreign keys to user and retreat, user.deleted_at for soft deletes
+
+Revision ID: b5e9d1c7f320
+Revises: 8e3b5d7a0c42
+Create Date: 2026-10-18 19:36:05.214873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e9d1c7f320'
+down_revision = '8e3b5d7a0c42'
+branch_labels = None
+depends_on = None
+
+# names for the foreign keys SQLite has no name for, so batch mode can drop them
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+# table: [(column, referred table, ON DELETE)]
+FOREIGN_KEYS = {
+    'booking': [('user_id', 'user', 'CASCADE'), ('retreat_id', 'retreat', 'CASCADE')],
+    'idempotency_key': [('user_id', 'user', 'CASCADE')],
+    'retreat': [('user_id', 'user', 'SET NULL')],
+}
+
+# copied from 8b3e6d2f4a10, SQLite drops a table's triggers with it when batch mode rebuilds retreat
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_insert AFTER INSERT ON retreat BEGIN "
+    "INSERT INTO retreat_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_delete AFTER DELETE ON retreat BEGIN "
+    "INSERT INTO retreat_fts(retreat_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS retreat_fts_update AFTER UPDATE OF name, location, description ON retreat BEGIN "
+    "INSERT INTO retreat_fts(retreat_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); "
+    "INSERT INTO retreat_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+]
+
+
+def replace_foreign_keys(with_rules):
+    bind = op.get_bind()
+    for table, foreign_keys in FOREIGN_KEYS.items():
+        # the names the database gave them (ex. booking_user_id_fkey, booking_ibfk_1), None on SQLite
+        names = {tuple(foreign_key['constrained_columns']): foreign_key['name'] for foreign_key in sa.inspect(bind).get_foreign_keys(table)}
+        with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+            for column, referred, ondelete in foreign_keys:
+                name = f'fk_{table}_{column}_{referred}'
+                batch_op.drop_constraint(names.get((column,)) or name, type_='foreignkey')
+                batch_op.create_foreign_key(name, referred, [column], ['id'], ondelete=ondelete if with_rules else None)
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_deleted_at'), ['deleted_at'], unique=False)
+
+    # SQLite never enforced the old foreign keys, rows left behind by earlier deletes would stop the new ones
+    op.execute('DELETE FROM booking WHERE user_id NOT IN (SELECT id FROM "user") OR retreat_id NOT IN (SELECT id FROM retreat)')
+    op.execute('DELETE FROM idempotency_key WHERE user_id NOT IN (SELECT id FROM "user")')
+    op.execute('UPDATE retreat SET user_id = NULL WHERE user_id NOT IN (SELECT id FROM "user")')
+    op.execute("UPDATE retreat SET seats_booked = (SELECT COUNT(*) FROM booking WHERE booking.retreat_id = retreat.id)")
+
+    replace_foreign_keys(with_rules=True)
+    if op.get_bind().dialect.name == 'sqlite':
+        for statement in SQLITE_TRIGGERS:
+            op.execute(statement)
+
+
+def downgrade():
+    replace_foreign_keys(with_rules=False)
+    if op.get_bind().dialect.name == 'sqlite':
+        for statement in SQLITE_TRIGGERS:
+            op.execute(statement)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_deleted_at'))
+        batch_op.drop_column('deleted_at')
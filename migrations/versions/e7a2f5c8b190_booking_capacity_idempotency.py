@@ -0,0 +1,56 @@
+"""retreat capacity, unique booking per user and retreat, idempotency keys
+
+Revision ID: e7a2f5c8b190
+Revises: c41d9e7b2a63
+Create Date: 2026-10-18 12:41:52.906117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2f5c8b190'
+down_revision = 'c41d9e7b2a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('retreat', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('capacity', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('seats_booked', sa.Integer(), server_default='0', nullable=False))
+
+    # drop duplicate bookings (keeping the first one) so the unique index can be built
+    op.execute(
+        "DELETE FROM booking WHERE id NOT IN "
+        "(SELECT min_id FROM (SELECT MIN(id) AS min_id FROM booking GROUP BY user_id, retreat_id) AS first_bookings)"
+    )
+    op.execute(
+        "UPDATE retreat SET seats_booked = "
+        "(SELECT COUNT(*) FROM booking WHERE booking.retreat_id = retreat.id)"
+    )
+    with op.batch_alter_table('booking', schema=None) as batch_op:
+        batch_op.create_index('uq_booking_user_id_retreat_id', ['user_id', 'retreat_id'], unique=True)
+
+    op.create_table('idempotency_key',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=False),
+    sa.Column('response', sa.Text(), nullable=False),
+    sa.Column('date_created', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'key', name='uq_idempotency_key_user_id_key')
+    )
+
+
+def downgrade():
+    op.drop_table('idempotency_key')
+    with op.batch_alter_table('booking', schema=None) as batch_op:
+        batch_op.drop_index('uq_booking_user_id_retreat_id')
+
+    with op.batch_alter_table('retreat', schema=None) as batch_op:
+        batch_op.drop_column('seats_booked')
+        batch_op.drop_column('capacity')
@@ -0,0 +1,39 @@
+"""similarity_state keeps the highest booking id and the retreat version instead of the sum of booking ids
+
+Revision ID: e8c3a5f17b92
+Revises: d2a7c9e4f618
+Create Date: 2026-10-20 10:41:05.318226
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c3a5f17b92'
+down_revision = 'd2a7c9e4f618'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the old fingerprints can't be turned into the new ones, with the table empty the next
+    # `flask similar-retreats` sees every retreat as changed and rebuilds them all
+    op.drop_table('similarity_state')
+    op.create_table('similarity_state',
+    sa.Column('retreat_id', sa.Integer(), nullable=False),
+    sa.Column('bookings', sa.Integer(), nullable=False),
+    sa.Column('max_booking_id', sa.Integer(), nullable=False),
+    sa.Column('retreat_version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('retreat_id')
+    )
+
+
+def downgrade():
+    op.drop_table('similarity_state')
+    op.create_table('similarity_state',
+    sa.Column('retreat_id', sa.Integer(), nullable=False),
+    sa.Column('bookings', sa.Integer(), nullable=False),
+    sa.Column('booking_id_sum', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('retreat_id')
+    )
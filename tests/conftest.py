@@ -0,0 +1,52 @@
+import base64
+import os
+import tempfile
+
+import pytest
+
+# the app reads its config when it is imported, so these go first. A SQLite file rather than
+# :memory: so the threads in test_booking.py see the same database.
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ.setdefault('APP_ENV', 'test')
+os.environ.setdefault('DB_POOL_SIZE', '10')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+os.environ.setdefault('SECRET_KEY', 'test-secret')
+# Server-Timing headers with the number of statements each request ran, test_queries.py counts them
+os.environ.setdefault('SQL_PROFILING', '1')
+# as if behind one proxy, test_ratelimit.py sends X-Forwarded-For
+os.environ.setdefault('TRUSTED_PROXIES', '1')
+
+from app import app as flask_app, db, token_cache, http_cache
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+    token_cache.clear()
+    http_cache.backend.clear()
+    # no app context is left pushed, so each request gets its own session like it would in a worker
+    yield flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def basic_auth(username, password):
+    return {'Authorization': 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()}
+
+
+@pytest.fixture
+def make_user(client):
+    # creates a user and logs them in, returns (user json, headers with their token)
+    def make_user(username='ann', password='password'):
+        response = client.post('/users', json={'firstName': 'Ann', 'lastName': 'Lee', 'username': username,
+                                               'email': f'{username}@example.com', 'password': password})
+        assert response.status_code == 201, response.json
+        token = client.get('/token', headers=basic_auth(username, password)).json['token']
+        return response.json, {'Authorization': f'Bearer {token}'}
+    return make_user
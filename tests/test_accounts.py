@@ -0,0 +1,104 @@
+import pytest
+from app import db, http_cache
+from app.models import User, Booking
+from tests.test_queries import statements
+
+
+def new_retreat(client, headers, name, location, date):
+    response = client.post('/retreats', json={'name': name, 'location': location, 'date': date, 'description': '',
+                                              'duration': '3 days', 'cost': '$100'}, headers=headers)
+    assert response.status_code == 201, response.json
+    return response.json['id']
+
+
+def book(client, headers, retreat_id):
+    assert client.post(f'/retreats/book/{retreat_id}', headers=headers).status_code == 200
+
+
+def all_stats(client):
+    http_cache.backend.clear()
+    return {dimension: client.get(f'/stats/{dimension}?limit=100').json['stats'] for dimension in ('location', 'month', 'organizer')}
+
+
+def assert_stats_match_a_rebuild(app, client):
+    stats = all_stats(client)
+    result = app.test_cli_runner().invoke(args=['stats-rebuild'])
+    assert result.exit_code == 0, result.output
+    assert all_stats(client) == stats
+
+
+def seats_booked(client, retreat_id):
+    http_cache.backend.clear()
+    return client.get(f'/retreats/{retreat_id}').json['seatsBooked']
+
+
+@pytest.fixture
+def accounts(client, make_user):
+    # ann organizes two retreats, bob books both and organizes one that carol booked
+    ann, ann_headers = make_user('ann')
+    bob, bob_headers = make_user('bob')
+    carol, carol_headers = make_user('carol')
+    ann_retreats = [new_retreat(client, ann_headers, 'Yoga', 'Bali', '2025-05-01'),
+                    new_retreat(client, ann_headers, 'Surf', 'Goa', '2025-06-01')]
+    bob_retreat = new_retreat(client, bob_headers, 'Silence', 'Goa', '2025-06-15')
+    for retreat_id in ann_retreats:
+        book(client, bob_headers, retreat_id)
+        book(client, carol_headers, retreat_id)
+    book(client, carol_headers, bob_retreat)
+    return bob, bob_headers, ann_retreats, bob_retreat
+
+
+def assert_bob_is_gone(app, client, bob, ann_retreats, bob_retreat):
+    with app.app_context():
+        assert db.session.get(User, bob['id']) is None
+        assert db.session.scalar(db.select(db.func.count()).select_from(Booking).where(Booking.user_id == bob['id'])) == 0
+    # bob's seats are given back, carol's stay
+    assert [seats_booked(client, retreat_id) for retreat_id in ann_retreats] == [1, 1]
+    # bob's retreat stays without an organizer, with carol's booking
+    retreat = client.get(f'/retreats/{bob_retreat}').json
+    assert retreat['userId'] is None and retreat['seatsBooked'] == 1
+    organizers = {row['userId'] for row in all_stats(client)['organizer']}
+    assert str(bob['id']) not in organizers and bob['id'] not in organizers
+
+
+def test_delete_user(app, client, accounts):
+    bob, bob_headers, ann_retreats, bob_retreat = accounts
+    response = client.delete(f"/users/{bob['id']}", headers=bob_headers)
+    assert response.status_code == 200, response.json
+    assert client.get('/users/me', headers=bob_headers).status_code == 401
+    assert_bob_is_gone(app, client, bob, ann_retreats, bob_retreat)
+    assert_stats_match_a_rebuild(app, client)
+
+
+def test_soft_delete_then_purge(app, client, accounts, monkeypatch):
+    bob, bob_headers, ann_retreats, bob_retreat = accounts
+    monkeypatch.setitem(app.config, 'USER_PURGE_THRESHOLD', 1)
+    response = client.delete(f"/users/{bob['id']}", headers=bob_headers)
+    assert response.status_code == 202, response.json
+    # logged out and hidden straight away, the rest waits for purge-users
+    assert client.get('/users/me', headers=bob_headers).status_code == 401
+    assert client.get(f"/users/{bob['id']}").status_code == 404
+    assert [seats_booked(client, retreat_id) for retreat_id in ann_retreats] == [2, 2]
+
+    result = app.test_cli_runner().invoke(args=['purge-users', '--batch-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert 'Purged 1 users, 2 bookings and 1 retreats' in result.output
+    assert_bob_is_gone(app, client, bob, ann_retreats, bob_retreat)
+    assert_stats_match_a_rebuild(app, client)
+
+
+def test_delete_runs_the_same_statements_however_many_bookings(client, make_user):
+    owner, owner_headers = make_user('owner')
+    retreat_ids = [new_retreat(client, owner_headers, f'Retreat {i}', f'Place {i % 3}', f'2025-0{i % 9 + 1}-01')
+                   for i in range(30)]
+    counts = []
+    for username, booked in (('few', 2), ('many', 30)):
+        user, headers = make_user(username)
+        for retreat_id in retreat_ids[:booked]:
+            book(client, headers, retreat_id)
+        new_retreat(client, headers, f'Retreat by {username}', 'Bali', '2025-05-01')
+        response = client.delete(f"/users/{user['id']}", headers=headers)
+        assert response.status_code == 200, response.json
+        counts.append(statements(response))
+    # the user, the seats and /stats, the retreats taken off them, the delete and the token lookup
+    assert counts[0] == counts[1] <= 10, counts
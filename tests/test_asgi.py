@@ -0,0 +1,108 @@
+import asyncio
+import re
+import pytest
+from werkzeug.datastructures import Headers
+from app import http_cache
+from app.asgi import application, async_engine
+
+
+def asgi_get(path, headers=None):
+    # one GET through the ASGI app, returns (status, headers, body)
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'method': 'GET', 'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+        'path': path, 'query_string': query.encode(), 'server': ('localhost', 80), 'client': ('127.0.0.1', 50000),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        try:
+            await application(scope, receive, send)
+        finally:
+            # each asyncio.run() has its own loop, the pooled connections can't outlive it
+            await async_engine.dispose()
+    asyncio.run(run())
+    start = messages[0]
+    response_headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in start['headers']])
+    return start['status'], response_headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def comparable(headers):
+    # Server-Timing durations and the Date differ between two runs, the statement count shouldn't
+    timings = sorted(re.sub(r'dur=[\d.]+;?', '', value) for value in headers.getlist('Server-Timing'))
+    return sorted((name.lower(), value) for name, value in headers.items() if name.lower() not in ('server-timing', 'date')), timings
+
+
+def assert_same_response(client, path, headers=None):
+    http_cache.backend.clear()
+    flask_response = client.get(path, headers=headers)
+    http_cache.backend.clear()
+    status, asgi_headers, body = asgi_get(path, headers)
+    assert status == flask_response.status_code, (path, body)
+    assert body == flask_response.data
+    assert comparable(asgi_headers) == comparable(flask_response.headers)
+    return status, asgi_headers, body
+
+
+@pytest.fixture
+def listed(client, make_user):
+    user, headers = make_user()
+    for i in range(3):
+        retreat = client.post('/retreats', json={'name': f'Retreat {i}', 'location': 'Bali', 'date': '2025-05-01',
+                                                 'description': '', 'duration': '3 days', 'cost': '$100'}, headers=headers)
+        assert client.post(f"/retreats/book/{retreat.json['id']}", headers=headers).status_code == 200
+    return headers
+
+
+@pytest.mark.parametrize('path', [
+    '/retreats', '/retreats?limit=2', '/retreats?fields=id,name', '/retreats?dateFrom=soon',
+    '/retreats/1', '/retreats/99', '/retreats/99/events',
+])
+def test_public_routes_match_flask(client, listed, path):
+    status, headers, body = assert_same_response(client, path, {'Origin': 'https://example.com'})
+    assert headers['Access-Control-Allow-Origin'] == 'https://example.com'
+    assert 'desc="' in headers['Server-Timing']
+
+
+@pytest.mark.parametrize('path, authorized', [
+    ('/bookings', True), ('/bookings?expand=retreat&limit=2', True), ('/bookings?after=x', True), ('/bookings', False),
+])
+def test_bookings_match_flask(client, listed, path, authorized):
+    headers = listed if authorized else {'Authorization': 'Bearer not-a-token'}
+    status, response_headers, body = assert_same_response(client, path, headers)
+    if not authorized:
+        assert status == 401 and 'WWW-Authenticate' in response_headers
+
+
+def test_next_page_link(client, listed):
+    status, headers, body = asgi_get('/retreats?limit=2')
+    assert headers['Link'] == '</retreats?limit=2&after=2>; rel="next"'
+    assert headers['X-Next-Cursor'] == '2'
+
+
+def test_response_cache_and_etags(client, listed):
+    http_cache.backend.clear()
+    status, headers, body = asgi_get('/retreats')
+    etag = headers['ETag']
+    # the entry the ASGI app stored is served to the Flask app and the other way round
+    response = client.get('/retreats')
+    assert response.headers['ETag'] == etag
+    assert 'desc="0 queries"' in response.headers['Server-Timing']
+    status, headers, body = asgi_get('/retreats', {'If-None-Match': etag})
+    assert status == 304 and body == b''
+
+    status, headers, body = asgi_get('/retreats/1')
+    assert asgi_get('/retreats/1', {'If-None-Match': headers['ETag']})[0] == 304
+
+
+def test_load_shedding(app, client, listed, monkeypatch):
+    monkeypatch.setitem(app.config, 'SHED_QUEUE_MS', 100)
+    status, headers, body = assert_same_response(client, '/retreats', {'X-Request-Start': 't=1000000000.000'})
+    assert status == 503 and headers['Retry-After'] == '1'
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import event
+from app import db, http_cache
+
+
+@pytest.fixture
+def retreats(client, make_user):
+    # three retreats, returns headers with a token that is already in the token cache
+    user, headers = make_user()
+    for i in range(3):
+        response = client.post('/retreats', json={'name': f'Retreat {i}', 'location': 'Bali', 'date': '2025-05-01',
+                                                  'description': '', 'duration': '3 days', 'cost': '$100'}, headers=headers)
+        assert response.status_code == 201
+    http_cache.backend.clear()
+    return headers
+
+
+@contextmanager
+def counting(app):
+    # every statement the engine runs, the batch's Server-Timing only has its own and each item has its own profile
+    executed = []
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield executed
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def run(client, headers, *items):
+    response = client.post('/batch', json={'requests': [item if isinstance(item, dict) else {'path': item} for item in items]},
+                           headers=headers)
+    assert response.status_code == 200, response.json
+    return response
+
+
+def test_each_item_gets_its_own_status(client, retreats):
+    responses = run(client, retreats, '/retreats/1', '/retreats/99', '/nowhere', '/users/me').json['responses']
+    assert [item['status'] for item in responses] == [200, 404, 404, 200]
+    assert responses[0]['body']['name'] == 'Retreat 0'
+    assert responses[0]['headers']['ETag']
+    assert responses[1]['body'] == {'error': 'Retreat with ID 99 not found'}
+    assert responses[3]['body']['username'] == 'ann'
+
+
+def test_only_gets_that_finish(client, retreats):
+    responses = run(client, retreats, {'method': 'POST', 'path': '/retreats'}, {'method': 'DELETE', 'path': '/retreats/1'},
+                    '/batch', {'method': 'POST', 'path': '/batch'}, '/retreats/1/events', '/retreats/1').json['responses']
+    assert [item['status'] for item in responses] == [405, 405, 405, 405, 400, 200]
+    # nothing was written
+    assert run(client, retreats, '/retreats/1').json['responses'][0]['status'] == 200
+
+
+def test_bad_batches(app, client, retreats, monkeypatch):
+    assert client.post('/batch', json={'requests': []}, headers=retreats).status_code == 400
+    assert client.post('/batch', json={'requests': [{'path': 'retreats'}]}, headers=retreats).status_code == 400
+    monkeypatch.setitem(app.config, 'BATCH_MAX_REQUESTS', 2)
+    assert client.post('/batch', json={'requests': [{'path': '/retreats/1'}] * 3}, headers=retreats).status_code == 400
+    assert client.post('/batch', json={'requests': [{'path': '/retreats/1'}]}).status_code == 401
+
+
+def test_repeated_items_run_once(app, client, retreats):
+    with counting(app) as once:
+        single = run(client, retreats, '/bookings')
+    with counting(app) as repeated:
+        response = run(client, retreats, '/bookings', '/bookings', '/bookings')
+    assert response.json['responses'] == single.json['responses'] * 3
+    assert len(repeated) == len(once) == 1
+
+
+def test_rows_are_loaded_with_one_in_query(app, client, make_user, retreats):
+    make_user('bob')
+    with counting(app) as executed:
+        response = run(client, retreats, '/retreats/1', '/retreats/2', '/retreats/3')
+    assert [item['body']['id'] for item in response.json['responses']] == [1, 2, 3]
+    # the SELECT ... WHERE retreat.id IN (1, 2, 3) and nothing per item
+    assert len(executed) == 1 and ' IN (' in executed[0]
+    http_cache.backend.clear()
+    with counting(app) as executed:
+        response = run(client, retreats, '/retreats/1', '/users/1', '/retreats/2', '/users/2', '/retreats/3')
+    assert [item['status'] for item in response.json['responses']] == [200] * 5
+    # one IN query per model
+    assert len(executed) == 2 and all(' IN (' in statement for statement in executed)
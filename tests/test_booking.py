@@ -0,0 +1,81 @@
+import threading
+from collections import Counter
+from app import db
+from app.models import Retreat, Booking
+
+
+def book_at_once(app, requests):
+    # sends every (retreat id, headers) booking from its own thread, all let go together
+    barrier = threading.Barrier(len(requests))
+    results = [None] * len(requests)
+
+    def book(index, retreat_id, headers):
+        client = app.test_client()
+        barrier.wait()
+        response = client.post(f'/retreats/book/{retreat_id}', headers=headers)
+        results[index] = (response.status_code, response.json)
+
+    threads = [threading.Thread(target=book, args=(index, *request)) for index, request in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return results
+
+
+def test_last_seats_are_never_overbooked(app, client, make_user):
+    owner, owner_headers = make_user('owner')
+    retreat = client.post('/retreats', json={'name': 'Silent retreat', 'location': 'Goa', 'date': '2025-05-01', 'description': '',
+                                             'duration': '3 days', 'cost': '$100', 'capacity': 5}, headers=owner_headers).json
+    bookers = [make_user(f'booker{i}')[1] for i in range(12)]
+    # everyone tries twice at the same moment
+    results = book_at_once(app, [(retreat['id'], headers) for headers in bookers for _ in range(2)])
+
+    statuses = Counter(status for status, body in results)
+    assert set(statuses) <= {200, 409}, results
+    assert sum(1 for status, body in results if 'bookingId' in body) == 5
+    with app.app_context():
+        assert db.session.get(Retreat, retreat['id']).seats_booked == 5
+        per_user = db.session.execute(
+            db.select(Booking.user_id, db.func.count()).where(Booking.retreat_id == retreat['id']).group_by(Booking.user_id)
+        ).all()
+    assert len(per_user) == 5
+    assert all(count == 1 for user_id, count in per_user)
+
+
+def test_same_user_books_once(app, client, make_user):
+    owner, owner_headers = make_user('owner')
+    retreat = client.post('/retreats', json={'name': 'Open retreat', 'location': 'Goa', 'date': '2025-05-01', 'description': '',
+                                             'duration': '3 days', 'cost': '$100', 'capacity': 50}, headers=owner_headers).json
+    user, headers = make_user('keen')
+    results = book_at_once(app, [(retreat['id'], headers)] * 8)
+
+    assert sorted(status for status, body in results) == [200] + [409] * 7, results
+    assert sum(1 for status, body in results if 'bookingId' in body) == 1
+    with app.app_context():
+        assert db.session.get(Retreat, retreat['id']).seats_booked == 1
+        assert db.session.scalar(db.select(db.func.count()).select_from(Booking).where(Booking.user_id == user['id'])) == 1
+
+
+def test_booking_twice_without_a_key(client, make_user):
+    owner, owner_headers = make_user('owner')
+    retreat = client.post('/retreats', json={'name': 'Open retreat', 'location': 'Goa', 'date': '2025-05-01', 'description': '',
+                                             'duration': '3 days', 'cost': '$100'}, headers=owner_headers).json
+    user, headers = make_user('keen')
+    assert client.post(f"/retreats/book/{retreat['id']}", headers=headers).status_code == 200
+    response = client.post(f"/retreats/book/{retreat['id']}", headers=headers)
+    assert response.status_code == 409
+    assert response.json == {'error': 'You have already booked the retreat: Open retreat'}
+    assert client.get(f"/retreats/{retreat['id']}").json['seatsBooked'] == 1
+
+
+def test_booking_twice_with_a_key(client, make_user):
+    owner, owner_headers = make_user('owner')
+    retreat = client.post('/retreats', json={'name': 'Open retreat', 'location': 'Goa', 'date': '2025-05-01', 'description': '',
+                                             'duration': '3 days', 'cost': '$100'}, headers=owner_headers).json
+    user, headers = make_user('keen')
+    first = client.post(f"/retreats/book/{retreat['id']}", headers={**headers, 'Idempotency-Key': 'a'})
+    retried = client.post(f"/retreats/book/{retreat['id']}", headers={**headers, 'Idempotency-Key': 'a'})
+    assert first.status_code == 200
+    assert (retried.status_code, retried.json) == (200, first.json)
+    assert client.post(f"/retreats/book/{retreat['id']}", headers={**headers, 'Idempotency-Key': 'b'}).status_code == 409
@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+import pytest
+
+RETREATS = [
+    {'name': 'Silent week', 'location': 'Ubud, Bali', 'description': 'Quiet, "really" quiet\nand then some',
+     'duration': '7 days', 'date': '2025-05-01', 'cost': '$1,200'},
+    {'name': 'Café retreat', 'location': 'Lisbon', 'latitude': 38.7223, 'longitude': -9.1393},
+    {'name': 'Somewhere', 'location': 'Nowhere in particular', 'duration': '2 weeks', 'cost': '€300'},
+    {'name': 'Mountains', 'location': 'Cusco', 'date': '2025-12-31', 'latitude': -13.5319, 'longitude': -71.9675},
+    # no empty strings, an empty CSV cell is no value
+    {'name': 'Last one', 'location': 'Kyoto'},
+]
+
+
+@pytest.fixture
+def headers(app, make_user, monkeypatch):
+    # several batches and several export chunks out of a handful of rows
+    monkeypatch.setitem(app.config, 'BULK_BATCH_SIZE', 2)
+    monkeypatch.setitem(app.config, 'STREAM_CHUNK_SIZE', 2)
+    user, headers = make_user()
+    return headers
+
+
+def import_ndjson(client, headers, lines):
+    return client.post('/retreats/bulk', data=''.join(line + '\n' for line in lines),
+                       content_type='application/x-ndjson', headers=headers)
+
+
+def import_csv(client, headers, text):
+    return client.post('/retreats/bulk', data=text.encode(), content_type='text/csv', headers=headers)
+
+
+def export(client, export_format):
+    response = client.get(f'/retreats/bulk?format={export_format}')
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def comparable(rows):
+    # what an import keeps of an exported row, ids and owners are new ones
+    return [{key: value for key, value in row.items() if key not in ('id', 'userId')} for row in rows]
+
+
+def test_ndjson_errors_are_reported_by_line(client, headers):
+    response = import_ndjson(client, headers, [
+        json.dumps(RETREATS[0]),
+        '{"name": "no end"',
+        '',
+        '["a", "list"]',
+        json.dumps({'name': 'No location'}),
+        json.dumps(RETREATS[1]),
+        json.dumps({**RETREATS[2], 'date': 'May 1st'}),
+        json.dumps({**RETREATS[3], 'latitude': 100}),
+        json.dumps({**RETREATS[4], 'cost': 'x' * 21}),
+        json.dumps(RETREATS[2]),
+    ])
+    assert response.status_code == 201
+    assert response.json == {'inserted': 3, 'errorCount': 6, 'errors': [
+        {'line': 2, 'error': 'not valid JSON'},
+        {'line': 4, 'error': 'each line must be a JSON object'},
+        {'line': 5, 'error': 'location must be in the row'},
+        {'line': 7, 'error': 'date must be in the format YYYY-MM-DD'},
+        {'line': 8, 'error': 'latitude must be between -90 and 90 and longitude between -180 and 180'},
+        {'line': 9, 'error': 'cost must be 20 characters or less'},
+    ]}
+    assert [json.loads(line)['name'] for line in export(client, 'ndjson').splitlines()] == [
+        'Silent week', 'Café retreat', 'Somewhere']
+
+
+def test_csv_errors_are_reported_by_line(client, headers):
+    response = import_csv(client, headers, 'name,location,date\nGood,Bali,2025-05-01\n,Bali,\nAlso good,Lisbon,\nBad,Kyoto,01/05/2025\n')
+    assert response.status_code == 201
+    assert response.json == {'inserted': 2, 'errorCount': 2, 'errors': [
+        {'line': 3, 'error': 'name must be in the row'},
+        {'line': 5, 'error': 'date must be in the format YYYY-MM-DD'},
+    ]}
+
+
+def test_nothing_to_import(client, headers):
+    response = import_ndjson(client, headers, ['{}', 'nope'])
+    assert response.status_code == 400
+    assert response.json['inserted'] == 0 and response.json['errorCount'] == 2
+    assert export(client, 'ndjson') == ''
+    assert client.post('/retreats/bulk', data=b'\xff\xfe', content_type='text/csv', headers=headers).status_code == 400
+    assert client.post('/retreats/bulk', json=RETREATS, headers=headers).status_code == 400
+
+
+@pytest.mark.parametrize('export_format', ['csv', 'ndjson'])
+def test_export_imports_back_the_same(client, headers, make_user, export_format):
+    assert import_ndjson(client, headers, [json.dumps(retreat) for retreat in RETREATS]).json['errorCount'] == 0
+    exported = export(client, export_format)
+    if export_format == 'csv':
+        rows = list(csv.DictReader(io.StringIO(exported)))
+        assert list(rows[0]) == ['id', 'name', 'location', 'description', 'duration', 'date', 'cost', 'userId', 'latitude', 'longitude']
+    else:
+        rows = [json.loads(line) for line in exported.splitlines()]
+    assert len(rows) == len(RETREATS)
+
+    # the export as it is, as somebody else
+    user, other_headers = make_user('bob')
+    content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = client.post('/retreats/bulk', data=exported.encode(), content_type=content_type, headers=other_headers)
+    assert response.status_code == 201
+    assert response.json == {'inserted': len(RETREATS), 'errorCount': 0, 'errors': []}
+
+    all_rows = [json.loads(line) for line in export(client, 'ndjson').splitlines()]
+    originals, copies = all_rows[:len(RETREATS)], all_rows[len(RETREATS):]
+    assert comparable(copies) == comparable(originals)
+    assert {row['userId'] for row in copies} == {user['id']}
+    assert originals[0]['description'] == RETREATS[0]['description']
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+import pytest
+from app import seat_events
+from app.asgi import application, async_engine
+
+# the flusher thread runs as it would in a worker, at SEAT_EVENTS_PER_SECOND
+
+
+@pytest.fixture
+def retreat(app, client, make_user, monkeypatch):
+    # a quiet stream sends a keepalive this often, so reading it never blocks for long
+    monkeypatch.setattr(seat_events, 'heartbeat', 0.1)
+    user, headers = make_user()
+    response = client.post('/retreats', json={'name': 'Silent', 'location': 'Bali', 'date': '2025-05-01', 'capacity': 10,
+                                              'description': '', 'duration': '3 days', 'cost': '$100'}, headers=headers)
+    assert response.status_code == 201
+    return response.json, headers
+
+
+def book(client, make_user, retreat_id, count):
+    for i in range(count):
+        user, headers = make_user(f'guest{retreat_id}_{i}')
+        assert client.post(f'/retreats/book/{retreat_id}', headers=headers).status_code == 200
+
+
+def events(chunks, seconds):
+    # the (event, data) messages sent within seconds, keepalives left out, stops early when the stream ends
+    received = []
+    deadline = time.monotonic() + seconds
+    for chunk in chunks:
+        message = chunk.decode()
+        if message.startswith('event: '):
+            lines = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+            received.append((lines['event'], json.loads(lines['data'])))
+        if time.monotonic() > deadline:
+            break
+    return received
+
+
+def open_stream(client, retreat_id):
+    response = client.get(f'/retreats/{retreat_id}/events', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    assert next(chunks) == b'retry: 3000\n\n'
+    return response, chunks
+
+
+def test_stream_starts_with_the_seat_counts(client, retreat):
+    retreat, headers = retreat
+    response, chunks = open_stream(client, retreat['id'])
+    assert events(chunks, 0.2) == [('seats', {'id': retreat['id'], 'seatsBooked': 0, 'capacity': 10, 'seatsLeft': 10})]
+    response.close()
+    assert client.get('/retreats/12345/events').status_code == 404
+
+
+def test_seat_changes_are_coalesced(client, make_user, retreat):
+    retreat, headers = retreat
+    response, chunks = open_stream(client, retreat['id'])
+    assert len(events(chunks, 0.2)) == 1
+    # the flusher can't get at the channels until all three bookings are in, however soon it wakes up
+    with seat_events.lock:
+        book(client, make_user, retreat['id'], 3)
+    # two flush intervals, the second has the changes published after the first picked them up
+    assert events(chunks, 2.5 * seat_events.interval) == [
+        ('seats', {'id': retreat['id'], 'seatsBooked': 3, 'capacity': 10, 'seatsLeft': 7})
+    ]
+    response.close()
+
+
+def test_deleted_retreat_ends_the_stream(client, retreat):
+    retreat, headers = retreat
+    response, chunks = open_stream(client, retreat['id'])
+    assert len(events(chunks, 0.2)) == 1
+    assert client.delete(f"/retreats/{retreat['id']}", headers=headers).status_code == 200
+    # the stream ends by itself after the deleted event
+    assert events(chunks, 5) == [('deleted', {'id': retreat['id']})]
+    assert next(chunks, None) is None
+    assert seat_events.stats()['subscribers'] == 0
+    response.close()
+
+
+def test_disconnect_closes_the_subscription(client, retreat):
+    retreat, headers = retreat
+    response, chunks = open_stream(client, retreat['id'])
+    assert len(events(chunks, 0.2)) == 1
+    assert seat_events.stats()['subscribers'] == 1
+    # what the WSGI server does when the client goes away
+    response.close()
+    assert seat_events.stats() == {'backend': 'MemoryChanges', 'subscribers': 0, 'retreats': 0}
+
+
+def test_asgi_stream_ends_on_disconnect(client, retreat):
+    retreat, headers = retreat
+    scope = {
+        'type': 'http', 'method': 'GET', 'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+        'path': f"/retreats/{retreat['id']}/events", 'query_string': b'', 'server': ('localhost', 80),
+        'client': ('127.0.0.1', 50000), 'headers': [],
+    }
+    messages = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+        # the client leaves once it has the seat counts
+        if message.get('body', b'').startswith(b'event: seats'):
+            disconnected.set()
+
+    async def run():
+        try:
+            await asyncio.wait_for(application(scope, receive, send), 5)
+        finally:
+            await async_engine.dispose()
+    asyncio.run(run())
+    assert messages[0]['status'] == 200
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    assert body.startswith(b'retry: 3000\n\nevent: seats\n')
+    # nothing is sent after the client left, not even the end of the body
+    assert messages[-1]['body'].startswith(b'event: seats')
+    assert seat_events.stats()['subscribers'] == 0
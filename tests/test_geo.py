@@ -0,0 +1,84 @@
+import math
+import random
+import pytest
+from app import db, geo
+from app.models import Retreat
+
+# /retreats/nearby against a brute force haversine over every retreat. The points are random, with
+# clusters where the geocell cover is most likely to miss something: on the equator and the prime
+# meridian (where the biggest cells meet), either side of the antimeridian and near the poles.
+
+CENTERS = [(0.0, 0.0), (0.0, 179.99), (-40.3, -179.95), (45.0, 90.0), (-45.0, -90.0001), (89.7, 10.0), (-89.9, 150.0),
+           (51.5, -0.12)]
+RADII = [0.5, 20, 300, 2000]
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * geo.EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def wrap(longitude):
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def destination(latitude, longitude, bearing, distance):
+    # the point distance km from latitude/longitude going bearing degrees from north
+    lat1, lng1, bearing = map(math.radians, (latitude, longitude, bearing))
+    angle = distance / geo.EARTH_RADIUS_KM
+    lat2 = math.asin(math.sin(lat1) * math.cos(angle) + math.cos(lat1) * math.sin(angle) * math.cos(bearing))
+    lng2 = lng1 + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(lat1), math.cos(angle) - math.sin(lat1) * math.sin(lat2))
+    return math.degrees(lat2), wrap(math.degrees(lng2))
+
+
+@pytest.fixture
+def points(app):
+    generator = random.Random(20)
+    points = [(generator.uniform(-90, 90), generator.uniform(-180, 180)) for i in range(500)]
+    for latitude, longitude in CENTERS:
+        for spread in (0.01, 0.3, 3, 20):
+            for i in range(25):
+                points.append((min(max(latitude + generator.uniform(-spread, spread), -90.0), 90.0),
+                               wrap(longitude + generator.uniform(-spread, spread))))
+        # just inside and just outside the search circles, where the corners of the cover are
+        for radius in RADII:
+            for bearing in range(0, 360, 15):
+                points += [destination(latitude, longitude, bearing, radius * scale) for scale in (0.999, 1.001)]
+        # right on the cell edges around the center
+        points += [(latitude, wrap(longitude + offset)) for offset in (-1e-9, 0.0, 1e-9)]
+    with app.app_context():
+        db.session.execute(db.insert(Retreat), [
+            {'name': f'Retreat {i}', 'location': 'Somewhere', 'latitude': latitude, 'longitude': longitude,
+             'geocell': geo.geocell(latitude, longitude)}
+            for i, (latitude, longitude) in enumerate(points)
+        ])
+        db.session.commit()
+    # ids start at 1 in the order the points were inserted
+    return dict(enumerate(points, 1))
+
+
+@pytest.mark.parametrize('radius', RADII)
+def test_nearby_finds_what_brute_force_finds(client, points, radius):
+    for latitude, longitude in CENTERS:
+        distances = {retreat_id: haversine(latitude, longitude, *point) for retreat_id, point in points.items()}
+        response = client.get(f'/retreats/nearby?lat={latitude}&lng={longitude}&radius={radius}&limit=500')
+        assert response.status_code == 200
+        found = {retreat['id']: retreat['distanceKm'] for retreat in response.json['retreats']}
+        expected = {retreat_id for retreat_id, distance in distances.items() if distance <= radius}
+        assert len(expected) <= 500
+        # a point a rounding error away from the radius can go either way
+        borderline = {retreat_id for retreat_id, distance in distances.items() if abs(distance - radius) < 1e-6}
+        assert set(found) - borderline == expected - borderline, (latitude, longitude, radius)
+        for retreat_id, distance in found.items():
+            assert distance == pytest.approx(distances[retreat_id], abs=1e-3)
+        assert list(found.values()) == sorted(found.values())
+
+
+def test_geocell_ranges_cover_the_antimeridian():
+    # a circle across the antimeridian has cells at both ends of the longitude axis
+    ranges = geo.geocell_ranges(0.0, 179.99, 20)
+    for latitude, longitude in [(0.0, 179.999), (0.05, -179.95), (-0.1, 179.9)]:
+        cell = geo.geocell(latitude, longitude)
+        assert any(low <= cell <= high for low, high in ranges), (latitude, longitude)
+    assert len(ranges) <= geo.MAX_COVER_CELLS
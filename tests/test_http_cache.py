@@ -0,0 +1,32 @@
+from app.http_cache import MemoryResponseCache
+
+
+def test_memory_generations_are_bounded():
+    cache = MemoryResponseCache(maxsize=10)
+    for retreat_id in range(1000):
+        cache.generations([f'retreat:{retreat_id}'])
+        cache.bump([f'retreat:{retreat_id}'])
+    assert len(cache._generations) <= cache.max_namespaces
+
+
+def test_dropped_generation_never_comes_back():
+    cache = MemoryResponseCache(maxsize=1)
+    old = cache.generations(['retreat:1'])
+    cache.bump(['retreat:1'])
+    new = cache.generations(['retreat:1'])
+    assert new != old
+    # push retreat:1 out of the generations LRU
+    for retreat_id in range(2, 10):
+        cache.bump([f'retreat:{retreat_id}'])
+    assert 'retreat:1' not in cache._generations
+    # what was cached before the write isn't current again
+    assert cache.generations(['retreat:1'])[0] >= new[0] > old[0]
+
+
+def test_recently_read_generations_are_kept():
+    cache = MemoryResponseCache(maxsize=2)
+    current = cache.generations(['retreats'])
+    for retreat_id in range(10):
+        cache.bump([f'retreat:{retreat_id}'])
+        # a route that is read keeps its generation, and its cached responses
+        assert cache.generations(['retreats']) == current
@@ -0,0 +1,94 @@
+import re
+import pytest
+from app import token_cache, http_cache
+
+
+# SQL statements per request, from the Server-Timing header the profiler adds (SQL_PROFILING is on
+# in conftest.py). A lazy load in a loop shows up here as the count growing with the rows.
+
+def statements(response):
+    return int(re.search(r'desc="(\d+) queries"', response.headers['Server-Timing']).group(1))
+
+
+@pytest.fixture
+def booked(client, make_user):
+    # a user with a booking on each of three retreats, returns their headers
+    user, headers = make_user()
+    for i in range(3):
+        retreat = client.post('/retreats', json={'name': f'Retreat {i}', 'location': 'Bali', 'date': '2025-05-01',
+                                                 'description': '', 'duration': '3 days', 'cost': '$100'}, headers=headers)
+        assert client.post(f"/retreats/book/{retreat.json['id']}", headers=headers).status_code == 200
+    http_cache.backend.clear()
+    return headers
+
+
+def test_get_retreats(client, booked):
+    response = client.get('/retreats')
+    assert response.status_code == 200 and len(response.json) == 3
+    assert statements(response) == 1
+    # the second one comes from the response cache
+    assert statements(client.get('/retreats')) == 0
+
+
+def test_get_retreat_by_id(client, booked):
+    response = client.get('/retreats/1')
+    assert response.status_code == 200
+    assert statements(response) == 1
+
+
+def test_get_bookings_expand_retreat(client, booked):
+    response = client.get('/bookings?expand=retreat', headers=booked)
+    assert response.status_code == 200 and len(response.json['bookings']) == 3
+    # the retreats are joined in, not loaded one by one
+    assert statements(response) == 1
+
+
+def test_get_users_me(client, booked):
+    # the token is in the token cache, so the user comes from there
+    assert statements(client.get('/users/me', headers=booked)) == 0
+    token_cache.clear()
+    response = client.get('/users/me', headers=booked)
+    assert response.status_code == 200
+    assert statements(response) == 1
+
+
+
+# the write paths commit once. After the commit the ORM has expired the row, so the to_dict() for
+# the response reads it back by primary key: that is the last statement of each of them.
+
+RETREAT = {'name': 'Yoga', 'location': 'Bali', 'date': '2025-05-01', 'description': '', 'duration': '3 days', 'cost': '$100'}
+
+
+def test_signup(client):
+    response = client.post('/users', json={'firstName': 'Ann', 'lastName': 'Lee', 'username': 'ann',
+                                           'email': 'ann@example.com', 'password': 'password'})
+    assert response.status_code == 201
+    # the INSERT (no SELECT for duplicates, the unique constraints catch them) and the read back
+    assert statements(response) == 2
+
+
+def test_change_password(client, booked):
+    user_id = client.get('/users/me', headers=booked).json['id']
+    response = client.post(f'/users/{user_id}', json={'password': 'new password'}, headers=booked)
+    assert response.status_code == 200
+    # the user comes from the token cache, then the UPDATE and the read back
+    assert statements(response) == 2
+
+
+def test_create_retreat(client, booked):
+    response = client.post('/retreats', json=RETREAT, headers=booked)
+    assert response.status_code == 201
+    # the INSERT, one upsert for the three /stats rollups and the read back
+    assert statements(response) == 3
+
+
+def test_edit_retreat(client, booked):
+    retreat_id = client.post('/retreats', json=RETREAT, headers=booked).json['id']
+    response = client.put(f'/retreats/{retreat_id}', json={'name': 'Yin yoga'}, headers=booked)
+    assert response.status_code == 200
+    # the retreat, the UPDATE and the read back
+    assert statements(response) == 3
+    # moving it to another month moves its counts in /stats too, still in one upsert
+    response = client.put(f'/retreats/{retreat_id}', json={'date': '2025-06-01'}, headers=booked)
+    assert response.status_code == 200
+    assert statements(response) == 4
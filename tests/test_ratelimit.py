@@ -0,0 +1,34 @@
+import pytest
+from app import rate_limiter
+from app.asgi import environ_from_scope
+from app.ratelimit import MemoryBuckets
+from tests.conftest import basic_auth
+
+
+@pytest.fixture
+def limited(app, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'buckets', MemoryBuckets())
+    monkeypatch.setitem(app.config, 'RATE_LIMIT_TOKEN_PER_IP', '2/minute')
+    monkeypatch.setitem(app.config, 'RATE_LIMIT_TOKEN_PER_USERNAME', 'none')
+
+
+def test_per_ip_limit_uses_the_forwarded_address(limited, client, make_user):
+    make_user('alice', 'secret')
+    headers = basic_auth('alice', 'secret')
+    for _ in range(2):
+        assert client.get('/token', headers={**headers, 'X-Forwarded-For': '203.0.113.7'}).status_code == 200
+    assert client.get('/token', headers={**headers, 'X-Forwarded-For': '203.0.113.7'}).status_code == 429
+    # another client behind the same proxy has its own bucket
+    assert client.get('/token', headers={**headers, 'X-Forwarded-For': '203.0.113.8'}).status_code == 200
+    # only the address the trusted proxy added counts, not one the client made up before it
+    response = client.get('/token', headers={**headers, 'X-Forwarded-For': '198.51.100.1, 203.0.113.7'})
+    assert response.status_code == 429
+
+
+def test_async_views_see_the_forwarded_address():
+    environ = environ_from_scope({
+        'type': 'http', 'method': 'GET', 'path': '/retreats', 'query_string': b'', 'client': ('10.0.0.1', 50000),
+        'headers': [(b'x-forwarded-for', b'203.0.113.7'), (b'x-forwarded-proto', b'https')],
+    })
+    assert environ['REMOTE_ADDR'] == '203.0.113.7'
+    assert environ['wsgi.url_scheme'] == 'https'
@@ -0,0 +1,86 @@
+import sqlite3
+import pytest
+import sqlalchemy as sa
+from flask import g
+from sqlalchemy.pool import NullPool
+from app import db, http_cache, replicas
+from app.models import Retreat
+from app.replicas import REPLICA_BIND, RecentWriters
+
+# The app reads SQLALCHEMY_REPLICA_URI when it is imported, so here the 'replica' bind is added to the
+# test app by hand: a second SQLite file holding a copy of the primary taken by snapshot(), which then
+# lags behind it like a replica would.
+
+
+@pytest.fixture
+def replica(app, tmp_path, monkeypatch):
+    with app.app_context():
+        primary_path = db.engine.url.database
+        engines = db.engines
+    replica_path = str(tmp_path / 'replica.db')
+    replica_engine = sa.create_engine(f'sqlite:///{replica_path}', poolclass=NullPool)
+    monkeypatch.setitem(engines, REPLICA_BIND, replica_engine)
+    monkeypatch.setattr(replicas, 'enabled', True)
+    monkeypatch.setattr(replicas, 'recent_writers', RecentWriters(60))
+
+    def snapshot():
+        # the replica catches up with the primary
+        with sqlite3.connect(primary_path) as primary, sqlite3.connect(replica_path) as copy:
+            primary.backup(copy)
+        http_cache.backend.clear()
+
+    def execute(sql, *params):
+        with sqlite3.connect(replica_path) as connection:
+            return connection.execute(sql, params).fetchall()
+    yield snapshot, execute
+    replica_engine.dispose()
+
+
+@pytest.fixture
+def retreat(client, make_user):
+    user, headers = make_user()
+    response = client.post('/retreats', json={'name': 'Primary', 'location': 'Bali', 'date': '2025-05-01',
+                                              'description': '', 'duration': '3 days', 'cost': '$100'}, headers=headers)
+    assert response.status_code == 201
+    return response.json
+
+
+def test_read_only_views_read_from_the_replica(client, replica, retreat):
+    snapshot, execute = replica
+    snapshot()
+    execute("UPDATE retreat SET name = 'Replica' WHERE id = ?", retreat['id'])
+    assert client.get(f"/retreats/{retreat['id']}").json['name'] == 'Replica'
+    assert [found['name'] for found in client.get('/retreats').json] == ['Replica']
+
+
+def test_writer_reads_their_own_writes(client, make_user, replica, retreat):
+    snapshot, execute = replica
+    user, headers = make_user('bob')
+    snapshot()
+    assert client.get('/bookings', headers=headers).json['bookings'] == []
+    assert client.post(f"/retreats/book/{retreat['id']}", headers=headers).status_code == 200
+    assert execute("SELECT count(*) FROM booking") == [(0,)]
+    # bob just wrote, his reads go to the primary for REPLICA_STICKY_SECONDS
+    assert [booking['retreat_id'] for booking in client.get('/bookings', headers=headers).json['bookings']] == [retreat['id']]
+    # and back to the replica once that is over, which hasn't got the booking yet
+    replicas.recent_writers = RecentWriters(60)
+    assert client.get('/bookings', headers=headers).json['bookings'] == []
+    snapshot()
+    assert len(client.get('/bookings', headers=headers).json['bookings']) == 1
+
+
+def test_session_reads_its_own_write_from_the_primary(app, replica, retreat):
+    snapshot, execute = replica
+    snapshot()
+    execute("UPDATE retreat SET name = 'Replica' WHERE id = ?", retreat['id'])
+    name = db.select(Retreat.name).where(Retreat.id == retreat['id'])
+    with app.test_request_context():
+        g.use_replica = True
+        assert db.session.scalar(name) == 'Replica'
+        db.session.execute(db.update(Retreat).where(Retreat.id == retreat['id']).values(name='Written'))
+        # the rest of the request is on the primary, in the transaction that wrote
+        assert not replicas.using_replica() and g.wrote
+        assert db.session.scalar(name) == 'Written'
+        db.session.rollback()
+        assert db.session.scalar(name) == 'Primary'
+    assert execute("SELECT name FROM retreat") == [('Replica',)]
@@ -0,0 +1,24 @@
+RETREAT = {'name': 'Yoga by the sea', 'location': 'Bali', 'date': '2025-05-01', 'description': 'Sun salutations',
+           'duration': '7 days', 'cost': '$1,200'}
+
+
+def test_create_and_edit_retreat_with_date_string(client, make_user):
+    user, headers = make_user()
+    response = client.post('/retreats', json=RETREAT, headers=headers)
+    assert response.status_code == 201, response.json
+    assert response.json['date'] == 'Thu, 01 May 2025 00:00:00 GMT'
+    stats = client.get('/stats/month').json['stats']
+    assert [(row['month'], row['retreats']) for row in stats] == [('2025-05', 1)]
+
+    response = client.put(f"/retreats/{response.json['id']}", json={'date': '2025-06-02'}, headers=headers)
+    assert response.status_code == 200, response.json
+    assert response.json['date'] == 'Mon, 02 Jun 2025 00:00:00 GMT'
+    stats = client.get('/stats/month').json['stats']
+    assert [(row['month'], row['retreats']) for row in stats if row['retreats']] == [('2025-06', 1)]
+
+
+def test_create_retreat_with_bad_date(client, make_user):
+    user, headers = make_user()
+    response = client.post('/retreats', json={**RETREAT, 'date': 'May 1st'}, headers=headers)
+    assert response.status_code == 400
+    assert response.json == {'error': 'date must be in the format YYYY-MM-DD'}
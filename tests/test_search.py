@@ -0,0 +1,152 @@
+import os
+from datetime import date, timedelta
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import event
+from app import db
+from app.models import Retreat
+
+# a database the Postgres tests can drop and create the tables in, they are skipped without one
+POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+
+
+COSTS = ['$300', None, '$100', '$200', None, '$100', '$50']
+
+
+@pytest.fixture
+def retreats(app, client, make_user):
+    user, headers = make_user()
+    for i, cost in enumerate(COSTS):
+        location = 'Bali' if i % 2 else 'Goa'
+        response = client.post('/retreats', json={'name': f'Retreat {i}', 'location': location, 'date': f'2025-0{i + 1}-01',
+                                                  'description': '', 'duration': f'{i + 1} days', 'cost': cost}, headers=headers)
+        assert response.status_code == 201, response.json
+    return app
+
+
+def all_pages(client, path):
+    ids, after = [], None
+    while True:
+        response = client.get(path + (f'&after={after}' if after else ''))
+        assert response.status_code == 200, response.json
+        ids += [retreat['id'] for retreat in response.json['retreats']]
+        after = response.json['nextCursor']
+        if after is None:
+            return ids
+
+
+def test_sort_keeps_retreats_without_a_value_last(client, retreats):
+    # cost_cents per id: 1=300, 2=None, 3=100, 4=200, 5=None, 6=100, 7=50
+    assert all_pages(client, '/retreats/search?sort=cost&limit=2') == [7, 3, 6, 4, 1, 2, 5]
+    assert all_pages(client, '/retreats/search?sort=-cost&limit=2') == [1, 4, 6, 3, 7, 5, 2]
+    assert all_pages(client, '/retreats/search?sort=cost&limit=100') == [7, 3, 6, 4, 1, 2, 5]
+    assert all_pages(client, '/retreats/search?sort=duration&limit=3') == [1, 2, 3, 4, 5, 6, 7]
+
+
+def query_plans(app, client, path):
+    # EXPLAIN QUERY PLAN for every statement the request ran
+    statements = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        assert client.get(path).status_code == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    assert statements
+    with engine.connect() as connection:
+        return [' / '.join(row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters))
+                for statement, parameters in statements]
+
+
+@pytest.mark.parametrize('path, index', [
+    ('/retreats/search?sort=cost&limit=2', 'ix_retreat_cost_cents'),
+    ('/retreats/search?sort=-duration&limit=2', 'ix_retreat_duration_days'),
+    ('/retreats/search?location=Bali&dateFrom=2025-02-01&sort=date&limit=10', 'ix_retreat_location_date'),
+])
+def test_keyset_queries_use_the_index(retreats, client, path, index):
+    # on SQLite, the sort comes from walking the index rather than a sort of every matching row
+    for plan in query_plans(retreats, client, path):
+        assert index in plan, plan
+        assert 'TEMP B-TREE' not in plan, plan
+
+
+def test_keyset_queries_after_a_cursor_use_the_index(retreats, client):
+    after = client.get('/retreats/search?sort=cost&limit=2').json['nextCursor']
+    for plan in query_plans(retreats, client, f'/retreats/search?sort=cost&limit=2&after={after}'):
+        assert 'ix_retreat_cost_cents' in plan, plan
+        assert 'TEMP B-TREE' not in plan, plan
+
+
+def select_statements(app, client, path):
+    # the selects a request ran, as SQLAlchemy statements that can be compiled for another database
+    statements = []
+
+    def capture(connection, clauseelement, multiparams, params, execution_options):
+        if isinstance(clauseelement, sa.Select):
+            statements.append(clauseelement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_execute', capture)
+    try:
+        assert client.get(path).status_code == 200
+    finally:
+        event.remove(engine, 'before_execute', capture)
+    assert statements
+    return statements
+
+
+@pytest.fixture(scope='module')
+def postgres():
+    # the same tables as the migrations, with enough retreats that the planner cares which index it uses
+    engine = sa.create_engine(POSTGRES_URL)
+    with engine.begin() as connection:
+        db.metadata.drop_all(connection)
+        db.metadata.create_all(connection)
+        connection.execute(Retreat.__table__.insert(), [
+            {'name': f'Retreat {i}', 'location': ('Bali', 'Goa', 'Lisbon', 'Kyoto')[i % 4],
+             'date': date(2025, 1, 1) + timedelta(days=i % 365), 'cost_cents': (i * 7919) % 500000,
+             'duration_days': i % 30 + 1}
+            for i in range(20000)
+        ])
+        connection.exec_driver_sql('ANALYZE retreat')
+    yield engine
+    with engine.begin() as connection:
+        db.metadata.drop_all(connection)
+    engine.dispose()
+
+
+@pytest.mark.postgres
+@pytest.mark.skipif(not POSTGRES_URL, reason='set TEST_POSTGRES_URL to run the Postgres query plan tests')
+@pytest.mark.parametrize('path, index', [
+    ('/retreats/search?sort=cost&limit=2', 'ix_retreat_cost_cents'),
+    ('/retreats/search?sort=-duration&limit=2', 'ix_retreat_duration_days'),
+    ('/retreats/search?location=Bali&dateFrom=2025-02-01&sort=date&limit=10', 'ix_retreat_location_date'),
+])
+def test_keyset_queries_use_the_index_on_postgres(retreats, client, postgres, path, index):
+    # the statements the request ran on SQLite, explained on Postgres
+    for statement in select_statements(retreats, client, path):
+        compiled = statement.compile(dialect=postgres.dialect)
+        with postgres.connect() as connection:
+            plan = [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + compiled.string, compiled.params)]
+        assert any(index in line for line in plan), plan
+        # the rows come in index order, an Incremental Sort of the ties on id is fine but not a Sort of every match
+        assert not any(line.lstrip(' ->').startswith('Sort') for line in plan), plan
+
+
+def test_full_text_search_on_a_create_all_database(retreats, client):
+    # conftest.py only runs db.create_all(), the search index comes with the retreat table
+    response = client.get('/retreats/search?q=bali')
+    assert response.status_code == 200, response.json
+    assert sorted(retreat['id'] for retreat in response.json['retreats']) == [2, 4, 6]
+    # and goes with it, a new table doesn't find the old rows
+    with retreats.app_context():
+        db.drop_all()
+        db.create_all()
+    assert client.get('/retreats/search?q=bali').json['retreats'] == []
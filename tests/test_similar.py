@@ -0,0 +1,74 @@
+import random
+import pytest
+from app import db
+from app.models import SimilarRetreat
+
+numpy = pytest.importorskip('numpy')
+from app import similar  # noqa: E402
+
+
+def similar_rows(app):
+    with app.app_context():
+        rows = db.session.execute(db.select(SimilarRetreat).order_by(SimilarRetreat.retreat_id, SimilarRetreat.rank)).scalars()
+        return [(row.retreat_id, row.rank, row.similar_id, round(row.score, 9), row.co_bookings) for row in rows]
+
+
+def build(app, *args):
+    result = app.test_cli_runner().invoke(args=['similar-retreats', '--top', '3', *args])
+    assert result.exit_code == 0, result.output
+    return similar_rows(app)
+
+
+def new_retreat(client, headers, name):
+    response = client.post('/retreats', json={'name': name, 'location': 'Bali', 'date': '2025-05-01', 'description': '',
+                                              'duration': '3 days', 'cost': '$100'}, headers=headers)
+    assert response.status_code == 201, response.json
+    return response.json['id']
+
+
+def book(client, headers, retreat_id):
+    response = client.post(f'/retreats/book/{retreat_id}', headers=headers)
+    assert response.status_code == 200, response.json
+    return response.json['bookingId']
+
+
+def test_incremental_build_matches_full_after_deletes_and_reinserts(app, client, make_user, monkeypatch):
+    rng = random.Random(7)
+    owner, owner_headers = make_user('owner')
+    retreat_ids = [new_retreat(client, owner_headers, f'Retreat {i}') for i in range(40)]
+    users = [make_user(f'user{i}')[1] for i in range(30)]
+    bookings = {}
+    for headers in users:
+        for retreat_id in rng.sample(retreat_ids, 4):
+            bookings[book(client, headers, retreat_id)] = (headers, retreat_id)
+    build(app)
+
+    # cancel the newest booking and book the same retreat for someone else, SQLite hands out the same id again
+    booking_id = max(bookings)
+    headers, retreat_id = bookings.pop(booking_id)
+    assert client.delete(f'/bookings/{booking_id}', headers=headers).status_code == 200
+    other = next(user for user in users if (user, retreat_id) not in bookings.values())
+    assert book(client, other, retreat_id) == booking_id
+    booking_id = rng.choice(sorted(bookings))
+    headers, retreat_id = bookings.pop(booking_id)
+    assert client.delete(f'/bookings/{booking_id}', headers=headers).status_code == 200
+
+    # a retreat others list as similar is deleted, and so is the newest one, whose id the next retreat gets
+    rows = similar_rows(app)
+    listed = next(retreat_id for retreat_id in retreat_ids[:-1] if 0 < sum(row[2] == retreat_id for row in rows) <= 2)
+    for retreat_id in (listed, retreat_ids[-1]):
+        assert client.delete(f'/retreats/{retreat_id}', headers=owner_headers).status_code == 200
+    assert new_retreat(client, owner_headers, 'Reused id') == retreat_ids[-1]
+    assert client.get(f'/retreats/{retreat_ids[-1]}/similar').json['retreats'] == []
+    assert not [row for row in similar_rows(app) if {row[0], row[2]} & {listed, retreat_ids[-1]}]
+    book(client, users[0], retreat_ids[-1])
+
+    rebuilt = []
+    monkeypatch.setattr(similar, '_rebuild_changed', lambda connection, changed, *args: rebuilt.append(changed)
+                        or rebuild_changed(connection, changed, *args))
+    incremental = build(app)
+    assert rebuilt, 'the incremental build was not used'
+    assert incremental == build(app, '--full')
+
+
+rebuild_changed = similar._rebuild_changed
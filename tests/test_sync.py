@@ -0,0 +1,114 @@
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import pytest
+from app import db
+from app.models import Retreat, SyncState
+
+
+class Partner:
+    """A stub BookRetreats feed, pages of retreats with an ETag each."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def body(self, page):
+        return json.dumps({'retreats': self.pages[page - 1], 'totalPages': len(self.pages)}).encode()
+
+
+def handler_for(partner):
+    class Handler(BaseHTTPRequestHandler):
+        # kept-alive connections, like the real feed
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            page = int(parse_qs(urlsplit(self.path).query)['page'][0])
+            with partner.lock:
+                partner.requests.append((page, self.headers.get('If-None-Match')))
+                body = partner.body(page)
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def feed_retreat(number, **changes):
+    return {'id': f'br-{number}', 'title': f'Partner retreat {number}', 'location': 'Ubud, Bali',
+            'startDate': '2025-06-01T00:00:00Z', 'price': '$900', 'duration': '5 days', **changes}
+
+
+@pytest.fixture
+def partner(app):
+    partner = Partner([[feed_retreat(page * 10 + i) for i in range(4)] for page in range(3)])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_for(partner))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    partner.url = f'http://127.0.0.1:{server.server_address[1]}/api/'
+    yield partner
+    server.shutdown()
+    server.server_close()
+
+
+def sync(app, partner):
+    partner.requests = []
+    result = app.test_cli_runner().invoke(args=['sync-retreats', '--url', partner.url, '--concurrency', '2'])
+    assert result.exit_code == 0, result.output
+    stats = json.loads(result.output)
+    return {key: stats[key] for key in ('pagesFetched', 'pagesNotModified', 'inserted', 'updated', 'unchanged', 'errors')}
+
+
+def versions(app):
+    with app.app_context():
+        return dict(db.session.execute(db.select(Retreat.external_id, Retreat.version)).all())
+
+
+def test_sync_only_writes_what_changed(app, partner):
+    assert sync(app, partner) == {'pagesFetched': 3, 'pagesNotModified': 0, 'inserted': 12, 'updated': 0, 'unchanged': 0, 'errors': 0}
+    with app.app_context():
+        retreat = db.session.execute(db.select(Retreat).where(Retreat.external_id == 'br-1')).scalar_one()
+        assert (retreat.name, retreat.cost_cents, retreat.duration_days, str(retreat.date)) == ('Partner retreat 1', 90000, 5, '2025-06-01')
+        assert retreat.latitude is not None
+        # one state per page, each with the ETag it came with and the page count
+        states = db.session.execute(db.select(SyncState).order_by(SyncState.url)).scalars().all()
+        assert [state.url for state in states] == [f'{partner.url}retreats?page={page}' for page in (1, 2, 3)]
+        assert all(state.etag and state.total_pages == 3 for state in states)
+    before = versions(app)
+
+    # nothing changed, every page is a 304 and nothing is written
+    assert sync(app, partner) == {'pagesFetched': 0, 'pagesNotModified': 3, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+    assert all(etag is not None for page, etag in partner.requests)
+    assert versions(app) == before
+
+    # one retreat changed on page 2 and one new one on page 3, page 1 is still a 304 and still
+    # says how many pages there are
+    partner.pages[1][2] = feed_retreat(12, price='$950')
+    partner.pages[2].append(feed_retreat(99))
+    assert sync(app, partner) == {'pagesFetched': 2, 'pagesNotModified': 1, 'inserted': 1, 'updated': 1, 'unchanged': 7, 'errors': 0}
+    assert sorted(page for page, etag in partner.requests) == [1, 2, 3]
+    after = versions(app)
+    assert after.pop('br-99') == 1
+    assert {external_id for external_id in after if after[external_id] != before[external_id]} == {'br-12'}
+    with app.app_context():
+        assert db.session.scalar(db.select(Retreat.cost_cents).where(Retreat.external_id == 'br-12')) == 95000
+
+    # a page that changed only by a retreat that can't be used writes none of the others
+    partner.pages[0].append({'id': None, 'title': 'No id'})
+    assert sync(app, partner) == {'pagesFetched': 1, 'pagesNotModified': 2, 'inserted': 0, 'updated': 0, 'unchanged': 4, 'errors': 1}
+    assert versions(app) == {**after, 'br-99': 1}
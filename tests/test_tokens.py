@@ -0,0 +1,74 @@
+import pytest
+from app import db, token_cache, tokens
+from app.models import User, RevokedToken
+from tests.test_queries import statements
+
+
+@pytest.fixture
+def signed(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'TOKEN_MODE', 'signed')
+
+
+def test_deleted_user_token_stops_working(signed, client, make_user):
+    user, headers = make_user()
+    assert client.get('/users/me', headers=headers).status_code == 200
+
+    response = client.delete(f"/users/{user['id']}", headers=headers)
+    assert response.status_code == 200, response.json
+
+    assert client.get('/users/me', headers=headers).status_code == 401
+
+
+def test_signed_token_needs_no_database(signed, client, make_user):
+    user, headers = make_user()
+    response = client.get('/users/me', headers=headers)
+    assert response.status_code == 200
+    assert statements(response) == 1
+    # verified once, from the token cache after that
+    response = client.get('/users/me', headers=headers)
+    assert response.status_code == 200
+    assert statements(response) == 0
+
+
+def test_logout(signed, app, client, make_user):
+    user, headers = make_user()
+    other_user, other_headers = make_user('bob')
+    assert client.get('/users/me', headers=headers).status_code == 200
+    assert client.delete('/token', headers=headers).status_code == 200
+    assert client.get('/users/me', headers=headers).status_code == 401
+    assert client.get('/users/me', headers=other_headers).status_code == 200
+    # the other workers find it in the database
+    with app.app_context():
+        assert db.session.scalar(db.select(RevokedToken.jti)) is not None
+
+
+def test_logout_elsewhere_is_seen_when_the_cache_entry_expires(signed, app, client, make_user):
+    user, headers = make_user()
+    assert client.get('/users/me', headers=headers).status_code == 200
+    # as if another worker had logged the token out
+    payload = tokens.load_token(app.config['SECRET_KEY'], headers['Authorization'].split()[1])
+    with app.app_context():
+        db.session.add(RevokedToken(jti=payload['jti'], expires_at=payload['expires']))
+        db.session.commit()
+    assert client.get('/users/me', headers=headers).status_code == 200
+    # TOKEN_CACHE_TTL later
+    token_cache.clear()
+    assert client.get('/users/me', headers=headers).status_code == 401
+
+
+def test_user_deleted_elsewhere_gets_401(signed, app, client, make_user):
+    user, headers = make_user()
+    # as if another worker had deleted them
+    with app.app_context():
+        db.session.execute(db.delete(User).where(User.id == user['id']))
+        db.session.commit()
+    assert client.get('/users/me', headers=headers).status_code == 401
+    assert client.post('/retreats', json={'name': 'Yoga', 'location': 'Bali'}, headers=headers).status_code == 401
+
+
+def test_soft_deleted_user_gets_401(signed, app, client, make_user):
+    user, headers = make_user()
+    assert client.get('/bookings', headers=headers).status_code == 200
+    with app.app_context():
+        db.session.get(User, user['id']).soft_delete()
+    assert client.get('/bookings', headers=headers).status_code == 401